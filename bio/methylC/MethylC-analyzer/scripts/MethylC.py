@@ -7,6 +7,14 @@ import numpy as np
 #import seaborn as sns
 import os
 import random
+import gzip
+import re
+import hashlib
+import json
+import shutil
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import cgmap_binary
 
 # Get the directory where this script is located
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -25,6 +33,10 @@ from math import log
 from scipy import stats
 import scipy.stats as ss
 import time
+import traceback
+import resource
+import threading
+import fcntl
 import argparse
 import glob
 import pyBigWig
@@ -40,6 +52,7 @@ parser.add_argument("-r",help="Size of region. Default=500",dest='region',defaul
 parser.add_argument("-q",help="Minimum sites within a region. Default=4",dest='qualified',default=4)
 parser.add_argument("-context",help="Context used. Default=CG",dest='context',default='CG')
 parser.add_argument("-hc",help="Methylation cutoff of PCA & Heatmap. Default = 0.2",dest='heatmap_cutoff',default=0.2)
+parser.add_argument("-hmax",help="Maximum number of regions in PCA & Heatmap, the most variable ones above the cutoff. Default = 0 (all)",dest='heatmap_max',default=0)
 #parser.add_argument("-hcgc",help="PCA & Heatmap_CG_cutoff",dest='heatmap_cg_cutoff',default=0.2)
 #parser.add_argument("-hchgc",help="PCA & Heatmap_CHG_cutoff",dest='heatmap_chg_cutoff',default=0.2)
 #parser.add_argument("-hchhc",help="PCA & Heatmap_CHH_cutoff",dest='heatmap_chh_cutoff',default=0.2)
@@ -49,9 +62,12 @@ parser.add_argument("-dmrc",help="Methylation cutoff of DMR. Default = 0.1",dest
 #parser.add_argument("-dmrchh",help="DMR_CHH_cutoff",dest='dmr_chh_cutoff',default=0.1)
 parser.add_argument("-test",help="DMR testing method. 0:TTest, 1:KS, 2:MWU. Default=0",dest='testMethod',default=0)
 parser.add_argument("-pvalue",help="p-value cutoff for identifying DMR. Default = 0.05",dest='pvalue',default=0.05)
-#parser.add_argument("-fdr",help="fdr for identifying DMR",dest='fdr',default=0.05)
+parser.add_argument("-fdr",help="FDR (Benjamini-Hochberg) cutoff for identifying DMR, used instead of -pvalue when given",dest='fdr',default=None)
 parser.add_argument("-bs",help="Bin size of chrView and Metaplot. Default = 1000000",dest='bin_size',default=1000000)
 parser.add_argument("-p",help="promoter_size",dest='promoter_size',default=2000)
+parser.add_argument("-w",help="Number of worker processes, also the number of stages run at the same time. Default = all CPUs",dest='workers',default=0)
+parser.add_argument("-cache",help="Columnar cache of Unionsite/CommonRegion tables: none, parquet or feather (needs pyarrow). Default = none",dest='cache',default='none',choices=['none','parquet','feather'])
+parser.add_argument("-force",help="Rerun every stage, ignoring recorded fingerprints",dest='force',action='store_true')
 parser.add_argument("command",help="commands of MethylC-Analyser")
 parser.add_argument("samples_list",help="samples CGmap description")
 parser.add_argument("input_gtf_file",help="path of gene annotation")
@@ -63,6 +79,7 @@ depth=int(args.depth)
 region=int(args.region)
 qualifiedSite=int(args.qualified)
 pca_heat_cut=float(args.heatmap_cutoff)
+pca_heat_max=int(args.heatmap_max)
 #pca_heat_cg_cut=float(args.heatmap_cg_cutoff)
 #pca_heat_chh_cut=float(args.heatmap_chh_cutoff)
 #pca_heat_chg_cut=float(args.heatmap_chg_cutoff)
@@ -73,9 +90,19 @@ dmr_cut=float(args.dmr_cutoff)
 pvalue = float(args.pvalue)
 testmethod = int(args.testMethod)
 context = args.context.upper() if args.context.upper() in ['CG','CHG','CHH'] else 'CG'
-#fdr = float(args.fdr)
+fdr = float(args.fdr) if args.fdr is not None else None
 binSize=int(args.bin_size)
 promoter_size=int(args.promoter_size)
+workers=int(args.workers) or os.cpu_count()
+cache_format=args.cache
+force=args.force
+if cache_format != 'none':
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        print('pyarrow not found, columnar cache disabled')
+        cache_format = 'none'
 #input_gene=pd.read_csv(str(args.input_gtf_file),sep='\t',header=None)
 path_to_files=str(args.path_to_files)
 samples_list=path_to_files+str(args.samples_list)
@@ -103,9 +130,434 @@ DMR_ctrl=args.group2
 #     df = pd.read_csv("CommonRegion_"+context+".txt",sep="\t")
 
 def bed_form(inputxt):
-    subprocess.call('''awk '{if (NR!=1) print $1"\t"$2"\t"$3}' %s > %s'''%(inputxt, inputxt+".bed"), shell=True)
+    read_intervals(inputxt, header=True).fields.iloc[:, :3].to_csv(inputxt+".bed", sep='\t', header=False, index=False)
     return inputxt+".bed"
 
+#in-memory interval index, in place of bedtools intersect.
+#intervals are half-open like BED and kept per chromosome as start-sorted arrays;
+#fields holds the columns of the file as text, for writing hits back out
+class Intervals:
+    def __init__(self, fields):
+        self.fields = fields.reset_index(drop=True)
+        self.start = self.fields[1].astype(np.int64).to_numpy() if len(self.fields) else np.zeros(0, dtype=np.int64)
+        self.end = self.fields[2].astype(np.int64).to_numpy() if len(self.fields) else np.zeros(0, dtype=np.int64)
+        self.chroms = {}
+        for chrom, idx in self.fields.groupby(0, sort=False).indices.items():
+            idx = idx[np.argsort(self.start[idx], kind='stable')]
+            self.chroms[chrom] = (idx, self.start[idx], self.end[idx])
+
+    def __len__(self):
+        return len(self.fields)
+
+    def size(self):
+        return int((self.end - self.start).sum())
+
+    #summed length of the overlap of every pair of intervals (what intersect | sum of $3-$2 gave):
+    #a sweep over all breakpoints of a chromosome, integrating depth of self x depth of other
+    def overlap_size(self, other):
+        total = 0
+        for chrom, (idx, start, end) in self.chroms.items():
+            if chrom not in other.chroms: continue
+            oidx, ostart, oend = other.chroms[chrom]
+            points = np.unique(np.r_[start, end, ostart, oend])
+            x = points[:-1]
+            depth = np.searchsorted(start, x, 'right') - np.searchsorted(np.sort(end), x, 'right')
+            odepth = np.searchsorted(ostart, x, 'right') - np.searchsorted(np.sort(oend), x, 'right')
+            total += int((depth * odepth * np.diff(points)).sum())
+        return total
+
+    #every overlapping pair as (row in self, row in other), ordered like intersect -wo reports them:
+    #by row of self, then by start of the other interval
+    def pairs(self, other):
+        hits = []
+        for chrom, (idx, start, end) in self.chroms.items():
+            if chrom not in other.chroms: continue
+            oidx, ostart, oend = other.chroms[chrom]
+            #an interval of other that overlaps starts before our end, and after our start - its longest length
+            lo = np.searchsorted(ostart, start - (oend - ostart).max(), 'right')
+            hi = np.searchsorted(ostart, end, 'left')
+            n = np.maximum(hi - lo, 0)
+            a = np.repeat(np.arange(len(idx)), n)
+            b = np.repeat(lo - np.r_[0, np.cumsum(n)[:-1]], n) + np.arange(n.sum())
+            hit = (oend[b] > start[a]) & (end[a] > start[a]) & (oend[b] > ostart[b])
+            hits.append(np.column_stack((idx[a[hit]], oidx[b[hit]])))
+        if not hits:
+            return np.zeros((0, 2), dtype=np.int64)
+        hits = np.concatenate(hits)
+        return hits[np.argsort(hits[:, 0], kind='stable')]
+
+def read_intervals(path, header=False):
+    try:
+        fields = pd.read_csv(path, sep='\t', header=None, skiprows=1 if header else 0, dtype=str, na_filter=False)
+    except pd.errors.EmptyDataError:
+        fields = pd.DataFrame(columns=[0, 1, 2])
+    return Intervals(fields)
+
+#parsed CGmap store
+#every CGmap is parsed once into flat binary columns (pos, context code, ratio, depth) in file order under
+#<path_to_files>/cgmap_store/<CGmap name>/, plus a meta.json with the chromosome runs and context names.
+#stages memory-map the columns; the store is rebuilt only when the CGmap's size or mtime changes.
+#the depth filter is pushed down into the parse: only sites with depth >= -d are kept, and a store
+#filtered at a higher depth than a later run asks for is rebuilt. chunks are parsed with chr/context
+#as categoricals and narrow numeric dtypes.
+#a binary CGmap container (methcalls2cgmap.py -o binary) is copied in through its index instead of parsed,
+#each chromosome in position order.
+#stages running in parallel may find the same store stale: it is rebuilt under a lock on
+#<store>.lock, in a directory of the building process, by the first of them and reopened by the others.
+store_columns = [('pos', np.uint32), ('context', np.int8), ('ratio', np.float64), ('depth', np.int32)]
+
+def store_dir(cgmap_name):
+    return path_to_files + 'cgmap_store/' + cgmap_name.replace('/', '_') + '/'
+
+def build_cgmap_store(cgmap_file, outdir, min_depth):
+    st = os.stat(cgmap_file)
+    tmpdir = outdir.rstrip('/') + '.tmp.%d/' % os.getpid()
+    shutil.rmtree(tmpdir, ignore_errors=True)
+    os.makedirs(tmpdir)
+    outs = {name: open(tmpdir + name + '.bin', 'wb') for name, dtype in store_columns}
+    meta = {'source': [st.st_size, st.st_mtime_ns], 'depth': min_depth, 'rows': 0, 'contexts': [], 'runs': [], 'sorted': {}}
+    cxt_code, lastPos = {}, {}
+    if cgmap_binary.is_binary(cgmap_file):
+        index = cgmap_binary.read_index(cgmap_file)
+        meta['contexts'] = index['contexts']
+        for chromosome in dict.fromkeys(x['chr'] for x in index['chunks']):
+            sites = cgmap_binary.read_slice(cgmap_file, chromosome, index=index)
+            keep = np.flatnonzero(sites['depth'] >= min_depth)
+            if len(keep) == 0: continue
+            order = keep[np.argsort(sites['pos'][keep], kind='stable')]
+            columns = {'pos': sites['pos'][order], 'context': sites['context'][order],
+                       'ratio': cgmap_binary.ratios(sites['ratio'][order]), 'depth': sites['depth'][order]}
+            for name, dtype in store_columns:
+                outs[name].write(np.ascontiguousarray(columns[name], dtype=dtype).tobytes())
+            meta['runs'].append([chromosome, meta['rows'], meta['rows'] + len(order)])
+            meta['sorted'][chromosome] = True
+            meta['rows'] += len(order)
+    else:
+        reader = pd.read_csv(cgmap_file, compression='gzip', header=None, sep="\t", usecols=[0,2,3,5,7],
+                             dtype={0:'category', 2:np.uint32, 3:'category', 5:np.float64, 7:np.int32}, chunksize=1 << 22)
+        for chunk in reader:
+            for cxt in pd.unique(chunk[3]):
+                if cxt not in cxt_code:
+                    cxt_code[cxt] = len(cxt_code)
+                    meta['contexts'].append(cxt)
+            chunk = chunk[chunk[7].to_numpy() >= min_depth]
+            if len(chunk) == 0: continue
+            chr_names = chunk[0].cat.categories
+            chrs = chunk[0].cat.codes.to_numpy()
+            pos = chunk[2].to_numpy(dtype=np.int64)
+            #runs of one chromosome; a run continuing from the previous chunk is extended
+            starts = np.flatnonzero(np.r_[True, chrs[1:] != chrs[:-1]])
+            for start, end in zip(starts.tolist(), np.r_[starts[1:], len(chrs)].tolist()):
+                chromosome = chr_names[chrs[start]]
+                run = pos[start:end]
+                inorder = bool((np.diff(run) >= 0).all() and run[0] >= lastPos.get(chromosome, 0))
+                meta['sorted'][chromosome] = meta['sorted'].get(chromosome, True) and inorder
+                lastPos[chromosome] = int(run.max())
+                if meta['runs'] and meta['runs'][-1][0] == chromosome and meta['runs'][-1][2] == meta['rows'] + start:
+                    meta['runs'][-1][2] = meta['rows'] + end
+                else:
+                    meta['runs'].append([chromosome, meta['rows'] + start, meta['rows'] + end])
+            cxt_codes = np.array([cxt_code[x] for x in chunk[3].cat.categories], dtype=np.int8)
+            columns = {'pos': pos, 'context': cxt_codes[chunk[3].cat.codes.to_numpy()],
+                       'ratio': chunk[5].to_numpy(), 'depth': chunk[7].to_numpy()}
+            for name, dtype in store_columns:
+                outs[name].write(np.ascontiguousarray(columns[name], dtype=dtype).tobytes())
+            meta['rows'] += len(chunk)
+    for f in outs.values():
+        f.close()
+    with open(tmpdir + 'meta.json', 'w') as f:
+        json.dump(meta, f)
+    shutil.rmtree(outdir, ignore_errors=True)
+    os.replace(tmpdir, outdir)
+
+class CGmapStore:
+    def __init__(self, cgmap_name):
+        self.dir = store_dir(cgmap_name)
+        cgmap_file = path_to_files + cgmap_name
+        self.meta = self.current_meta(cgmap_file)
+        if self.meta is None:
+            os.makedirs(os.path.dirname(self.dir.rstrip('/')), exist_ok=True)
+            with open(self.dir.rstrip('/') + '.lock', 'w') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                #another process may have rebuilt it while this one waited
+                self.meta = self.current_meta(cgmap_file)
+                if self.meta is None:
+                    print("Now processing " + cgmap_name)
+                    build_cgmap_store(cgmap_file, self.dir, depth)
+                    with open(self.dir + 'meta.json') as f:
+                        self.meta = json.load(f)
+        self.contexts = self.meta['contexts']
+        self.runs = {}
+        for c, a, b in self.meta['runs']:
+            self.runs.setdefault(c, []).append((a, b))
+        self.columns = {}
+        for name, dtype in store_columns:
+            if self.meta['rows']:
+                self.columns[name] = np.memmap(self.dir + name + '.bin', dtype=dtype, mode='r', shape=(self.meta['rows'],))
+            else:
+                self.columns[name] = np.zeros(0, dtype=dtype)
+
+    #meta.json of the store, None when it is missing or stale
+    def current_meta(self, cgmap_file):
+        st = os.stat(cgmap_file)
+        try:
+            with open(self.dir + 'meta.json') as f:
+                meta = json.load(f)
+        except (IOError, ValueError):
+            return None
+        if meta['source'] != [st.st_size, st.st_mtime_ns] or meta.get('depth', 0) > depth:
+            return None
+        return meta
+
+    #chromosomes in order of first appearance
+    def chromosomes(self):
+        return list(self.runs)
+
+    def sorted(self, chromosome):
+        return self.meta['sorted'].get(chromosome, True)
+
+    #columns of one chromosome in file order; a slice of the memory map when it is one run
+    def sites(self, chromosome):
+        runs = self.runs[chromosome]
+        if len(runs) == 1:
+            return {name: col[runs[0][0]:runs[0][1]] for name, col in self.columns.items()}
+        return {name: np.concatenate([col[a:b] for a, b in runs]) for name, col in self.columns.items()}
+
+    #chromosome code of every row, codes in order of first appearance
+    def chr_codes(self):
+        names = {c: i for i, c in enumerate(self.chromosomes())}
+        codes = np.empty(self.meta['rows'], dtype=np.int64)
+        for c, a, b in self.meta['runs']:
+            codes[a:b] = names[c]
+        return codes
+
+def open_stores(cgmap_names):
+    if workers > 1 and len(cgmap_names) > 1:
+        #parse the CGmaps in parallel; the stores are reopened (memory-mapped) in this process
+        with ProcessPoolExecutor(max_workers=min(workers, len(cgmap_names)), mp_context=multiprocessing.get_context('fork')) as pool:
+            list(pool.map(CGmapStore, cgmap_names))
+    return [CGmapStore(x) for x in cgmap_names]
+
+#union of all samples, written one chromosome window at a time.
+#rows come out ordered like the old outer merge + sort_values(['chr','pos']):
+#chr as string, then pos, then context; missing samples are written as '-'.
+#with -cache the same rows also go to the Unionsite cache, one record batch at a time
+union_window = 1 << 20
+
+def write_unionsite(samples, outfile, depth):
+    names = [str(x) for x in samples[0]]
+    stores = open_stores(samples[1].tolist())
+    count_rows(sum(s.meta['rows'] for s in stores))
+    chromosomes = sorted(set().union(*[s.chromosomes() for s in stores]))
+    cxts = sorted(set().union(*[s.contexts for s in stores]))
+    #store context codes -> rank of the context name, so codes sort like the names
+    ranks = [np.array([cxts.index(c) for c in s.contexts] or [0], dtype=np.int64) for s in stores]
+    cache = UnionCache(names, chromosomes, cxts) if cache_format != 'none' else None
+
+    with open(outfile, 'w') as of:
+        of.write('\t'.join(['chr','pos','context'] + names) + '\n')
+        for chromosome in chromosomes:
+            sites = []
+            for store in stores:
+                if chromosome not in store.runs:
+                    sites.append(None)
+                    continue
+                site = store.sites(chromosome)
+                if not store.sorted(chromosome):
+                    order = np.argsort(site['pos'], kind='stable')
+                    site = {name: col[order] for name, col in site.items()}
+                sites.append(site)
+            last = max(int(x['pos'][-1]) for x in sites if x is not None and len(x['pos']))
+            for lo in range(0, last + 1, union_window):
+                keys, values = [], []
+                for i, site in enumerate(sites):
+                    if site is None: continue
+                    a, b = np.searchsorted(site['pos'], [lo, lo + union_window])
+                    keep = np.flatnonzero(site['depth'][a:b] >= depth) + a
+                    keys.append(site['pos'][keep].astype(np.int64) * len(cxts) + ranks[i][site['context'][keep]])
+                    values.append(site['ratio'][keep])
+                rows = np.unique(np.concatenate(keys))
+                if len(rows) == 0: continue
+                table = np.full((len(rows), len(names)), np.nan)
+                for i, key, value in zip([i for i, x in enumerate(sites) if x is not None], keys, values):
+                    table[np.searchsorted(rows, key), i] = value
+                pos, cxt = rows // len(cxts), rows % len(cxts)
+                block = pd.DataFrame(table)
+                block.insert(0, 'context', np.asarray(cxts, dtype=object)[cxt])
+                block.insert(0, 'pos', pos)
+                block.insert(0, 'chr', chromosome)
+                block.to_csv(of, sep='\t', header=False, index=False, na_rep='-', lineterminator='\n')
+                if cache: cache.add(chromosome, pos, cxt, table)
+    if cache: cache.close()
+
+#columnar cache of the intermediate tables (parquet or feather, through pyarrow).
+#chr/context are dictionary (categorical) columns, positions int32 and methylation float32;
+#the TSV files are still written for the R scripts
+def cache_file(name):
+    return path_to_files + name + '.' + cache_format
+
+class UnionCache:
+    batch_rows = 1 << 20
+
+    def __init__(self, names, chromosomes, cxts):
+        self.chr_index = {c: i for i, c in enumerate(chromosomes)}
+        self.chr_dict = pa.array(chromosomes, pa.string())
+        self.cxt_dict = pa.array(cxts, pa.string())
+        self.schema = pa.schema([('chr', pa.dictionary(pa.int32(), pa.string())), ('pos', pa.int32()),
+                                 ('context', pa.dictionary(pa.int8(), pa.string()))] +
+                                [(name, pa.float32()) for name in names])
+        if cache_format == 'parquet':
+            self.writer = pq.ParquetWriter(cache_file('Unionsite'), self.schema)
+        else:
+            self.writer = pa.ipc.new_file(cache_file('Unionsite'), self.schema)
+        self.chrs, self.pos, self.cxts, self.rows = [], [], [], []
+
+    def add(self, chromosome, pos, cxt, values):
+        self.chrs.append(np.full(len(pos), self.chr_index[chromosome], dtype=np.int32))
+        self.pos.append(pos)
+        self.cxts.append(cxt)
+        self.rows.append(values)
+        if sum(len(x) for x in self.pos) >= self.batch_rows:
+            self.flush()
+
+    def flush(self):
+        if not self.rows: return
+        values = np.concatenate(self.rows).astype(np.float32)
+        columns = [pa.DictionaryArray.from_arrays(pa.array(np.concatenate(self.chrs)), self.chr_dict),
+                   pa.array(np.concatenate(self.pos).astype(np.int32)),
+                   pa.DictionaryArray.from_arrays(pa.array(np.concatenate(self.cxts).astype(np.int8)), self.cxt_dict)]
+        columns += [pa.array(values[:, i]) for i in range(values.shape[1])]
+        self.writer.write_batch(pa.record_batch(columns, schema=self.schema))
+        self.chrs, self.pos, self.cxts, self.rows = [], [], [], []
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+def read_cache(name):
+    if cache_format == 'parquet':
+        return pd.read_parquet(cache_file(name))
+    return pd.read_feather(cache_file(name))
+
+#Unionsite from the cache; float32 methylation goes back to the float64 values
+#read_csv gives for the TSV (CGmap ratios carry at most 6 decimals)
+def read_union_cache():
+    union = read_cache('Unionsite')
+    for col in union.columns[3:]:
+        union[col] = np.round(union[col].to_numpy(dtype=np.float64), 6)
+    return union
+
+def write_common_region_cache(bins, sample_cols):
+    table = bins[['context','chr','start','end'] + sample_cols].astype(
+        {'context': 'category', 'chr': 'category', 'start': np.int32, 'end': np.int32, **{c: np.float32 for c in sample_cols}})
+    if cache_format == 'parquet':
+        table.to_parquet(cache_file('CommonRegion'), index=False)
+    else:
+        table.to_feather(cache_file('CommonRegion'))
+
+#row-wise float sum with numpy's 1-d pairwise summation order (8 accumulators,
+#blocks of 128), so results match Series.sum()/mean() bit for bit
+def pairwise_sum(m):
+    n = m.shape[1]
+    if n < 8:
+        res = np.zeros(m.shape[0])
+        for i in range(n):
+            res = res + m[:, i]
+        return res
+    if n <= 128:
+        r = m[:, :8].copy()
+        stop = n - n % 8
+        for i in range(8, stop, 8):
+            r += m[:, i:i + 8]
+        res = ((r[:, 0] + r[:, 1]) + (r[:, 2] + r[:, 3])) + ((r[:, 4] + r[:, 5]) + (r[:, 6] + r[:, 7]))
+        for i in range(stop, n):
+            res = res + m[:, i]
+        return res
+    n2 = n // 2
+    n2 -= n2 % 8
+    return pairwise_sum(m[:, :n2]) + pairwise_sum(m[:, n2:])
+
+#sums of values[:, first[i]:first[i]+nsites[i]] for every group i, shape (groups, rows of values).
+#groups of equal length are summed together with the same pairwise scheme pandas' mean
+#of a single group goes through, so the results are bit-identical to a per-group .mean()
+def grouped_sums(values, first, nsites):
+    values = np.ascontiguousarray(values)
+    sums = np.empty((len(first), values.shape[0]))
+    for n in np.unique(nsites):
+        sel = np.flatnonzero(nsites == n)
+        block = values[:, first[sel, None] + np.arange(n)].reshape(-1, n)
+        sums[sel] = pairwise_sum(block).reshape(values.shape[0], -1).T
+    return sums
+
+#region binning engine
+#every site of union gets an integer bin id and all contexts/chromosomes are reduced in one pass.
+#bins are the ones pd.cut(pos, range(0,maxPos,region)) produced: right-closed (k*region,(k+1)*region],
+#so the id is (pos-1)//region, and the bin holding maxPos of a chromosome/context is never emitted.
+#returns (bins, order): bins has context, chr, start, end, per-sample means, and first/nsites
+#pointing at the sites of each bin in union.iloc[order]; only bins where every sample has
+#at least `qualified` sites are kept.
+def bin_regions(union, region, qualified):
+    sample_cols = union.columns.values.tolist()[3:]
+    ctx_code = pd.Categorical(union['context'], categories=contexts).codes.astype(np.int64)
+    chr_code, chr_names = pd.factorize(union['chr'])
+    pos = union['pos'].to_numpy(dtype=np.int64)
+    bin_id = (pos - 1) // region
+
+    maxPos = union['pos'].groupby([ctx_code, chr_code]).transform('max').to_numpy(dtype=np.int64)
+    keep = np.flatnonzero((ctx_code >= 0) & (pos >= 1) & ((bin_id + 1) * region < maxPos))
+    #lexsort is stable, so sites keep their union order inside a bin
+    order = keep[np.lexsort((bin_id[keep], chr_code[keep], ctx_code[keep]))]
+    columns = ['context', 'chr', 'start', 'end'] + sample_cols + ['first', 'nsites']
+    if len(order) == 0:
+        return pd.DataFrame(columns=columns), order
+
+    keys = np.column_stack((ctx_code[order], chr_code[order], bin_id[order]))
+    first = np.flatnonzero(np.r_[True, (keys[1:] != keys[:-1]).any(axis=1)])
+    nsites = np.diff(np.r_[first, len(order)])
+
+    values = union[sample_cols].to_numpy(dtype=float)[order]
+    counts = np.add.reduceat((~np.isnan(values)).astype(np.int64), first, axis=0)
+    qualify = counts.min(axis=1) >= qualified
+    first, nsites, counts = first[qualify], nsites[qualify], counts[qualify]
+
+    means = grouped_sums(np.nan_to_num(values, nan=0.0).T, first, nsites) / counts
+
+    head = keys[first]
+    bins = pd.DataFrame(means, columns=sample_cols)
+    bins.insert(0, 'context', np.asarray(contexts)[head[:, 0]])
+    bins.insert(1, 'chr', np.asarray(chr_names)[head[:, 1]])
+    bins.insert(2, 'start', head[:, 2] * region)
+    bins.insert(3, 'end', (head[:, 2] + 1) * region)
+    bins['first'] = first
+    bins['nsites'] = nsites
+    return bins, order
+
+def write_common_regions(bins, sample_cols):
+    for cxt in contexts:
+        with open(path_to_files+ 'CommonRegion_' + cxt + '.txt','w') as of:
+            of.write('\t'.join(['chr','start','end'] + sample_cols) + "\n")
+            bins.loc[bins['context'] == cxt, ['chr','start','end'] + sample_cols].to_csv(
+                of, sep='\t', header=False, index=False, float_format='%.3f', lineterminator='\n')
+
+#regions of CommonRegion_<ctx>.txt whose methylation range across samples (max - min, at the 3 decimals
+#of the file) is above the PCA & heatmap cutoff, written for heatmap_PCA_all.R as int32 version, rows,
+#columns, the sample names (NUL terminated), then the values column by column (float64), little endian.
+#with max_regions > 0 only the max_regions with the largest variance are kept, in file order
+def write_variable_regions(infile, outfile, cutoff, max_regions):
+    common = pd.read_csv(infile, sep='\t', dtype={'chr': str}, float_precision='round_trip')
+    names = common.columns.values.tolist()[3:]
+    values = common[names].to_numpy(dtype=np.float64)
+    count_rows(len(values))
+    if len(values) and len(names):
+        values = values[np.round(values.max(axis=1) - values.min(axis=1), 3) > cutoff]
+    if 0 < max_regions < len(values):
+        variance = values.var(axis=1, ddof=1) if len(names) > 1 else np.zeros(len(values))
+        values = values[np.sort(np.argsort(-variance, kind='stable')[:max_regions])]
+    with open(outfile, 'wb') as f:
+        f.write(np.array([1, len(values), len(names)], dtype='<i4').tobytes())
+        f.write(b''.join(str(x).encode() + b'\0' for x in names))
+        f.write(np.asarray(values, dtype='<f8').tobytes(order='F'))
+
 # def Find_DMR(context, cutoff):
 #     file1=pd.read_csv("CommonRegion_"+context+".txt",sep="\t",dtype =
 #             {0:str,1:int,2:int},index_col=[0,1,2])
@@ -141,45 +593,84 @@ def bed_form(inputxt):
 #     sig_all[sig_all.Delta >0].to_csv('DMR_'+context+'_hyper_'+str(cutoff)+'.txt',sep='\t')
 #     sig_all[sig_all.Delta <0].to_csv('DMR_'+context+'_hypo_'+ str(cutoff)+'.txt',sep='\t')
 
+#KS (test_method 1) or MWU (test_method 2) p-values for the bins of one chromosome;
+#exp/ctrl hold the sites of those bins back to back and first marks where each bin starts
+def dmr_site_tests(exp, ctrl, first, test_method):
+    test = stats.kstest if test_method == 1 else stats.mannwhitneyu
+    bounds = np.r_[first, len(exp)]
+    pvals = []
+    for a, b in zip(bounds[:-1], bounds[1:]):
+        expValue = exp[a:b].ravel()
+        expValue = expValue[~np.isnan(expValue)]
+        ctrlValue = ctrl[a:b].ravel()
+        ctrlValue = ctrlValue[~np.isnan(ctrlValue)]
+        pvals.append(test(expValue, ctrlValue)[1])
+    return pvals
+
+#Benjamini-Hochberg adjusted p-values; NaN p-values are left out and stay NaN
+def bh_fdr(pvals):
+    pvals = np.asarray(pvals, dtype=float)
+    fdr = np.full(len(pvals), np.nan)
+    tested = np.flatnonzero(~np.isnan(pvals))
+    order = tested[np.argsort(pvals[tested], kind='stable')]
+    ranked = pvals[order] * len(order) / np.arange(1, len(order) + 1)
+    fdr[order] = np.minimum(np.minimum.accumulate(ranked[::-1])[::-1], 1.0)
+    return fdr
+
+#DMR engine: bins come from bin_regions and only the selected test is computed.
+#the t-test runs axis-wise over the bins x samples mean matrix, the site-level
+#KS/MWU tests are spread over a process pool one chromosome at a time.
+#bins are called on FDR when -fdr is given, on the raw p-value otherwise
 def Find_DMR2(context, cutoff, test_method):
 #    union=pd.read_csv('Unionsite.txt',sep='\t',na_values='-')
 #    expgroup = samples[samples[2] == 'WT'][0].to_list()
 #    ctrlgroup = samples[samples[2] == 'met1'][0].to_list()
-    chrs = union['chr'].unique()
-    data_holder = []
-    positions = []
-    meanMaths = []
-    pvalues = []
-    for chromosome in chrs:
-        subset = union[(union['context'] == context) & (union['chr'] == chromosome)]
-        if subset.shape[0] == 0: continue 
-        maxPos = subset['pos'].max()
-        bins = range(0,maxPos,region)
-        groups = subset.groupby(pd.cut(subset['pos'], bins))
-        for sRange,sValues in groups:
-            minDepth = sValues.iloc[:,3:].count().min()
-            if minDepth >= qualifiedSite:
-                expValue = sValues.loc[:,expgroup]
-                expValue2 = [x for sublist in expValue.values for x in sublist if math.isnan(x) == False]
-                ctrlValue = sValues.loc[:,ctrlgroup]
-                ctrlValue2 = [x for sublist in ctrlValue.values for x in sublist if math.isnan(x) == False]
-                pKS = stats.kstest(expValue2,ctrlValue2)[1]
-                pMWU = stats.mannwhitneyu(expValue2,ctrlValue2)[1]
-                meanMeth = sValues.iloc[:,3:].astype(float).mean()
-                meanMeth2 = [("%.3f" %x) for x in meanMeth]
-                meanMeth3 = meanMeth + [random.random() * 0.00001 for x in meanMeth]
-                pTTest = 1.0 if meanMeth.sum() == 0 else stats.ttest_ind(meanMeth3.loc[expgroup],meanMeth3.loc[ctrlgroup])[1]
-                methMeth = sValues.iloc[:,3:].astype(float).mean().tolist()
-                start = sRange.left
-                end = sRange.right
-                deltaMean = meanMeth.loc[expgroup].mean() - meanMeth.loc[ctrlgroup].mean()
-                out = [chromosome,start,end] + meanMeth2  + [deltaMean,pTTest,pKS,pMWU]
-                data_holder.append(out)
-
-    merge = pd.DataFrame(data_holder,columns = ['Chr','Start','End'] + samples[0].tolist() + ['DeltaMean','pTTest','pKS','pMWU'])
+    sample_cols = union.columns.values.tolist()[3:]
+    exp_idx = [sample_cols.index(x) for x in expgroup]
+    ctrl_idx = [sample_cols.index(x) for x in ctrlgroup]
+    bins = region_bins[region_bins['context'] == context].reset_index(drop=True)
+    means = bins[sample_cols].to_numpy(dtype=float)
+    count_rows(len(bins))
+
+    if test_method == 0:
+        #same jitter, drawn in the same order, as the per-bin loop used
+        jitter = np.array([random.random() * 0.00001 for x in range(means.size)]).reshape(means.shape)
+        meanMeth3 = means + jitter
+        pvals = np.ones(len(bins))
+        test = means.sum(axis=1) != 0
+        if test.any():
+            pvals[test] = stats.ttest_ind(meanMeth3[test][:, exp_idx], meanMeth3[test][:, ctrl_idx], axis=1)[1]
+    else:
+        #sites of every bin, back to back
+        nsites = bins['nsites'].to_numpy(dtype=np.int64)
+        offsets = np.r_[0, np.cumsum(nsites)]
+        site = np.repeat(bins['first'].to_numpy(dtype=np.int64) - offsets[:-1], nsites) + np.arange(offsets[-1])
+        values = union[sample_cols].to_numpy(dtype=float)[region_order[site]]
+        exp, ctrl = values[:, exp_idx], values[:, ctrl_idx]
+
+        chunks = np.flatnonzero(np.r_[True, bins['chr'].to_numpy()[1:] != bins['chr'].to_numpy()[:-1]])
+        chunks = list(zip(chunks, np.r_[chunks[1:], len(bins)])) if len(bins) else []
+        jobs = [(exp[offsets[a]:offsets[b]], ctrl[offsets[a]:offsets[b]], offsets[a:b] - offsets[a], test_method) for a, b in chunks]
+        if workers > 1 and len(jobs) > 1:
+            with ProcessPoolExecutor(max_workers=min(workers, len(jobs)), mp_context=multiprocessing.get_context('fork')) as pool:
+                results = list(pool.map(dmr_site_tests, *zip(*jobs)))
+        else:
+            results = [dmr_site_tests(*job) for job in jobs]
+        pvals = np.array([p for r in results for p in r], dtype=float)
+
+    deltaMean = pairwise_sum(means[:, exp_idx]) / len(exp_idx) - pairwise_sum(means[:, ctrl_idx]) / len(ctrl_idx)
+
+    merge = pd.DataFrame({'Chr': bins['chr'], 'Start': bins['start'], 'End': bins['end']})
+    for name, col in zip(samples[0].tolist(), means.T):
+        merge[name] = [("%.3f" %x) for x in col]
+    merge['DeltaMean'] = deltaMean
     tests_methods = {0:'pTTest',1:'pKS',2:'pMWU'}
-    pvals = merge.loc[:,tests_methods[test_method]]
-    sig = merge[pvals <= pvalue]
+    merge[tests_methods[test_method]] = pvals
+    merge['FDR'] = bh_fdr(pvals)
+    if fdr is not None:
+        sig = merge[merge.FDR <= fdr]
+    else:
+        sig = merge[merge[tests_methods[test_method]] <= pvalue]
     sig_all = sig[(sig.DeltaMean >= cutoff) | (sig.DeltaMean <= -1*cutoff)]
     sig_all.to_csv(path_to_files +'DMR_'+context+'_all_'+str(cutoff)+'.txt', sep='\t',index = False)
     sig_all[sig_all.DeltaMean >0].to_csv(path_to_files +'DMR_'+context+'_hyper_'+str(cutoff)+'.txt',sep='\t',index = False)
@@ -255,26 +746,28 @@ def DMR_DMGPlot(Context,cutoff):
 #enrichment
 #1. overlap with dmr
 def overlap(bed1,bed2):
-        overlap=subprocess.check_output("bedtools intersect -a %s -b %s |awk '{size+=$3 - $2}END{print size}' "%(bed1,bed2), shell=True)
-        if len(overlap)<2:
+        overlap=bed1.overlap_size(bed2)
+        if overlap == 0:
                 return 1
         else:
-                return int(overlap)
+                return overlap
 #enrichment plot
 def Enrichment(tag, Cut):
     savefile=pd.DataFrame(columns=["dmr","feature","overlap_size","dmr_size","feature_size","genome_size","enrichment"])
     dmr=path_to_files +"DMR_"+tag+"_all_"+str(Cut)+".txt"
+    dmr_bed=read_intervals(dmr, header=True)
+    region_bed=read_intervals(path_to_files +"CommonRegion_"+tag+".txt", header=True)
+    count_rows(len(dmr_bed))
+    genome_size=region_bed.size()*1.0
+    if len(dmr_bed)<=1:
+        dmr_size=1000000000000
+    else:
+        dmr_size=dmr_bed.size()
     for i in annotation_name:
         feature=str(i)
-        overlap_size=overlap(input_gene_name +'_'+i+'_merge.bed',bed_form(dmr))
-        dmrlen=pd.read_csv(dmr,sep='\t')
-        if len(dmrlen)<=1:
-            dmr_size=1000000000000
-        else:
-            dmr_size=int(subprocess.check_output('''awk '{size+=$3-$2}END{print size}' %s'''%(bed_form(dmr)), shell=True))
-
-        feature_size=overlap(bed_form(path_to_files +"CommonRegion_"+tag+".txt"),bed_form(input_gene_name +'_'+i+'_merge.bed'))
-        genome_size=int(subprocess.check_output('''awk '{size+=$3-$2}END{print size}' %s'''%(bed_form(path_to_files +"CommonRegion_"+tag+".txt")), shell=True))*1.0
+        overlap_size=overlap(read_intervals(input_gene_name +'_'+i+'_merge.bed'),dmr_bed)
+        #feature size is taken without the first feature, as the bed_form() pass over the merge bed had it
+        feature_size=overlap(region_bed,read_intervals(input_gene_name +'_'+i+'_merge.bed', header=True))
 
         enrichment= math.log(((float(overlap_size)/float(dmr_size))/(float(feature_size)/float(genome_size))),2)
         out = [dmr,feature,overlap_size,dmr_size,feature_size,genome_size,enrichment]
@@ -299,178 +792,637 @@ def Enrichment(tag, Cut):
         #plt.close(fig)
 
 ###generating metaplot_delta files
-def Delta_Meta(context):
-
-    #sample_list=pd.read_csv("chrView_list.txt",header=None,sep='\t')
-    
-    expData = samples[samples[2] == metaplot_exp][0]
-    ctrlData = samples[samples[2] == metaplot_ctrl][0]
-    # read chrview files in two group 
+def Delta_Meta(context, regions, matrices):
 
-    exp_df = []
-    for expfile in expData:
-        exp_df.append(pd.read_csv(path_to_files+expfile+"_"+ context +".matrix.gz" ,sep='\t', skiprows=1,compression ='gzip',na_values='-',header =None))
+    expData = samples[samples[2] == metaplot_exp][0].astype(str)
+    ctrlData = samples[samples[2] == metaplot_ctrl][0].astype(str)
 
-    ctrl_df = []
-    for ctrlfile in ctrlData:
-        ctrl_df.append(pd.read_csv(path_to_files+ctrlfile+"_"+ context +".matrix.gz" ,sep='\t', skiprows=1,compression ='gzip',na_values='-',header =None))
-    
     #sum all valuew in each row in 3 context
     mexp,mctrl=0,0
-    for j in range(0,len(expData)):
-        mexp+=exp_df[j].iloc[:,6:86]
-    
-    for k in range(0,len(ctrlData)):
-        mctrl+=ctrl_df[k].iloc[:,6:86]
-        
+    for expname in expData:
+        mexp+=matrices[expname][context]
+
+    for ctrlname in ctrlData:
+        mctrl+=matrices[ctrlname][context]
 
    # get average M level in each row (gene)
     mexp/=len(expData)
     mctrl/=len(ctrlData)
 
-
     ## delta m level in 3 context
-    deltaexp =0
-
     delta=mexp-mctrl
-    
-    #generate delta report
-    exp_df[0].iloc[:,6:86]=delta
 
-    report = exp_df[0]
+    #generate delta report
+    report = pd.concat([regions.reset_index(drop=True), pd.DataFrame(delta)], axis=1)
+    report.columns = range(report.shape[1])
     report.to_csv(path_to_files+'metaplot_delta_'+context+'.txt',sep='\t',index=False)
 
     pd.DataFrame([[metaplot_exp+' - '+metaplot_ctrl,path_to_files+'metaplot_delta.txt']]).to_csv(path_to_files+'metaplot_delta_list.txt',sep='\t',index=False,header=None)
 
-     
+#bigWig header shared by all samples: every chromosome of the union, sorted by name,
+#with the last position any sample covers at the minimum depth
+def bigwig_header(stores, depth):
+    maxPos = {}
+    for store in stores:
+        for chromosome in store.chromosomes():
+            site = store.sites(chromosome)
+            pos = site['pos'][site['depth'] >= depth]
+            if len(pos):
+                maxPos[chromosome] = max(maxPos.get(chromosome, 0), int(pos.max()))
+    return [(x, maxPos[x]) for x in sorted(maxPos)]
+
+#scale-regions layout of the metaplot, as computeMatrix -b 2000 -m 4000 -a 2000 -bs 100 used it
+metaplot_layout = {'upstream': 2000, 'body': 4000, 'downstream': 2000, 'bin size': 100}
+
+#gene regions of the metaplot (BED6) and the 81 bin edges of every region: upstream flank,
+#the body scaled into body/bin size bins, downstream flank. regions on chromosomes without
+#sites or shorter than the number of body bins are skipped, as computeMatrix does;
+#the profile of a '-' strand region is reversed
+def metaplot_regions(bedfile, chromosomes):
+    columns = ['chrom', 'start', 'end', 'name', 'score', 'strand']
+    if not os.path.exists(bedfile) or os.path.getsize(bedfile) == 0:
+        regions = pd.DataFrame(columns=columns)
+    else:
+        regions = pd.read_csv(bedfile, sep='\t', header=None, dtype=str).iloc[:, :6]
+        regions.columns = columns[:regions.shape[1]]
+        for col in columns[regions.shape[1]:]:
+            regions[col] = '.' if col != 'score' else '0'
+    regions['start'] = regions['start'].astype(np.int64)
+    regions['end'] = regions['end'].astype(np.int64)
+    regions['strand'] = regions['strand'].where(regions['strand'].isin(['+', '-']), '.')
+    nbody = metaplot_layout['body'] // metaplot_layout['bin size']
+    regions = regions[regions['chrom'].isin(chromosomes) & (regions['end'] - regions['start'] >= nbody)].reset_index(drop=True)
+
+    bs = metaplot_layout['bin size']
+    minus = (regions['strand'] == '-').to_numpy()
+    start, end = regions['start'].to_numpy()[:, None], regions['end'].to_numpy()[:, None]
+    #both flanks are 2000 bp, so '-' regions share the '+' edges
+    edges = np.hstack([start + np.arange(-(metaplot_layout['upstream'] // bs), 0) * bs,
+                       start + ((end - start) * np.arange(nbody)) // nbody,
+                       end + np.arange(metaplot_layout['downstream'] // bs + 1) * bs])
+    return regions, edges, minus
+
+#one sample's metaplot inputs, in one pass over its CGmap store:
+#<sample>_CG/CHG/CHH.bw, and the scale-regions profile of every region per context.
+#the sites of a chromosome are grouped by context once and passed to pyBigWig as arrays;
+#sites without a methylation value are not written, and of a site listed twice the last
+#record is kept, as in the union. a profile bin is the mean of the (float32, as stored in
+#the bigWig) values of the sites inside it, NaN when there are none.
+#the profiles are also written as <sample>_<context>.matrix.gz for metaplot.R
+def metaplot_sample(cgmap_name, sample_name, bwheader, depth, regions, edges, minus):
+    store = CGmapStore(cgmap_name)
+    codes = [store.contexts.index(x) if x in store.contexts else -1 for x in contexts]
+    bws = []
+    for cxt in contexts:
+        bw = pyBigWig.open(path_to_files+sample_name+"_"+cxt+".bw","w")
+        bw.addHeader(bwheader)
+        bws.append(bw)
+    profiles = {cxt: np.full((len(regions), edges.shape[1] - 1), np.nan) for cxt in contexts}
+    region_chrom = regions['chrom'].to_numpy()
+
+    for chromosome, size in bwheader:
+        if chromosome not in store.runs: continue
+        site = store.sites(chromosome)
+        keep = np.flatnonzero((site['depth'] >= depth) & ~np.isnan(site['ratio']))
+        pos = site['pos'][keep].astype(np.int64)
+        cxt = site['context'][keep]
+        if store.sorted(chromosome):
+            order = np.argsort(cxt, kind='stable')
+        else:
+            order = np.lexsort((pos, cxt))
+        pos, cxt, ratio = pos[order], cxt[order], site['ratio'][keep][order]
+        last = np.r_[(pos[1:] != pos[:-1]) | (cxt[1:] != cxt[:-1]), True]
+        pos, cxt, ratio = pos[last], cxt[last], ratio[last]
+        rows = np.flatnonzero(region_chrom == chromosome)
+
+        for bw, code, name in zip(bws, codes, contexts):
+            a, b = np.searchsorted(cxt, code, 'left'), np.searchsorted(cxt, code, 'right')
+            if a == b: continue
+            starts, values = pos[a:b] - 1, ratio[a:b]
+            if len(rows):
+                csum = np.r_[0, np.cumsum(values.astype(np.float32).astype(np.float64))]
+                idx = np.searchsorted(starts, edges[rows], 'left')
+                counts = np.diff(idx, axis=1)
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    profiles[name][rows] = np.where(counts > 0, np.diff(csum[idx], axis=1) / counts, np.nan)
+            if not pyBigWig.numpy:
+                starts, values = starts.tolist(), values.tolist()
+            bw.addEntries(chromosome, starts, values=values, span=1)
+
+    for bw in bws:
+        bw.close()
+
+    for cxt in contexts:
+        profile = profiles[cxt]
+        profile[minus] = profile[minus, ::-1]
+        with gzip.open(path_to_files+sample_name+"_"+cxt+".matrix.gz", 'wt') as f:
+            f.write('@' + json.dumps({k: [v] for k, v in metaplot_layout.items()}, separators=(',', ':')) + '\n')
+            for region, values in zip(regions.itertuples(index=False), np.char.mod('%f', profile)):
+                f.write('\t'.join(map(str, region)) + '\t' + '\t'.join(values) + '\n')
+    #deltas are taken from the profiles at the precision of the matrix files
+    return {cxt: np.round(profiles[cxt], 6) for cxt in contexts}
+
+#chromosome names in the order sort -V gives: digit runs compare as numbers,
+#letters sort before other characters
+def natural_key(name):
+    parts = re.split(r'(\d+)', str(name))
+    return [int(x) if i % 2 else tuple(ord(c) if c.isalpha() else ord(c) + 256 for c in x) for i, x in enumerate(parts)]
+
+#chrView of one sample: mean CG/CHG/CHH level of every bin of every chromosome in one grouped reduction.
+#bins are the ones pd.cut(pos, range(0,maxPos,bin_size)) produced, empty bins included;
+#Position numbers bins in file order of the chromosomes, rows are written naturally sorted by chromosome.
+def chrview_sample(cgmap_name, outfile, depth, bin_size):
+    store = CGmapStore(cgmap_name)
+    chr_names = store.chromosomes()
+    keep = np.flatnonzero(store.columns['depth'] >= depth)
+    chr_code = store.chr_codes()[keep]
+    pos = store.columns['pos'][keep].astype(np.int64)
+    ratio = store.columns['ratio'][keep]
+    cxt = store.columns['context'][keep]
+
+    maxPos = np.zeros(len(chr_names), dtype=np.int64)
+    np.maximum.at(maxPos, chr_code, pos)
+    present = np.zeros(len(chr_names), dtype=bool)
+    present[chr_code] = True
+    nbins = np.where(present, np.maximum(maxPos - 1, 0) // bin_size, 0)
+    offset = np.r_[0, np.cumsum(nbins)]
+
+    #row of every site in the chrView table, sites past the last full bin are dropped
+    bin_id = (pos - 1) // bin_size
+    inside = (bin_id >= 0) & (bin_id < nbins[chr_code])
+    row = offset[chr_code] + bin_id
+
+    savefile = pd.DataFrame({'Position': np.arange(1, offset[-1] + 1),
+                             'chromosome': np.asarray(chr_names, dtype=object)[np.repeat(np.arange(len(chr_names)), nbins)],
+                             'start': (np.arange(offset[-1]) - np.repeat(offset[:-1], nbins)) * bin_size})
+    savefile['end'] = savefile['start'] + bin_size
+    for name in ['CG', 'CHG', 'CHH']:
+        sel = np.flatnonzero(inside & (cxt == store.contexts.index(name))) if name in store.contexts else np.zeros(0, dtype=np.int64)
+        #stable, so sites stay in file order inside a bin
+        sel = sel[np.argsort(row[sel], kind='stable')]
+        first = np.flatnonzero(np.r_[True, row[sel][1:] != row[sel][:-1]]) if len(sel) else np.zeros(0, dtype=np.int64)
+        nsites = np.diff(np.r_[first, len(sel)])
+        values = ratio[sel]
+        counts = np.add.reduceat((~np.isnan(values)).astype(np.int64), first) if len(sel) else np.zeros(0)
+        mean = np.full(offset[-1], np.nan)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean[row[sel][first]] = grouped_sums(np.nan_to_num(values, nan=0.0)[None, :], first, nsites)[:, 0] / counts
+        savefile['mean'+name] = mean
+
+    order = sorted(range(len(chr_names)), key=lambda i: natural_key(chr_names[i]))
+    rows = np.concatenate([np.arange(offset[i], offset[i+1]) for i in order]) if len(order) else np.zeros(0, dtype=np.int64)
+    savefile.iloc[rows].to_csv(outfile, sep='\t', index=None)
+
+###genomic region annotation
+#the GTF is parsed once; transcript regions follow extract_transcript_regions.py + bed12ToBed6 -n,
+#gene body/promoter/IGR the rules of the pandas version, and every region is merged like
+#bedtools sort | bedtools merge -c 4,5,6 -o collapse,collapse,collapse.
+#results are kept under <path_to_files>/annotation_cache/<GTF sha256>_<promoter size>/
+
+#value of one attribute (gene_id "X"; ...) without splitting the whole column
+def gtf_attribute(attributes, key):
+    i = attributes.find(key + ' ')
+    while i > 0 and attributes[i-1] not in ' ;':
+        i = attributes.find(key + ' ', i + 1)
+    if i < 0:
+        return None
+    value = attributes[i+len(key)+1:]
+    end = value.find(';')
+    return (value if end < 0 else value[:end]).strip().strip('"\'')
+
+#transcripts keyed by transcript_id in order of appearance as [chr, strand, cdsStart, cdsEnd, exon starts, exon ends],
+#and the exon lines as (chr, start, end, score, strand, gene_id) for the gene bodies
+def read_gtf(gtf_file):
+    transcripts = {}
+    exons = []
+    with (gzip.open(gtf_file, 'rt') if gtf_file.endswith('.gz') else open(gtf_file)) as f:
+        for line in f:
+            if line.startswith('#'): continue
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) < 9: continue
+            feature = fields[2]
+            if feature not in ('exon', 'CDS', 'start_codon', 'stop_codon'): continue
+            start, end = int(fields[3]), int(fields[4])
+            if feature == 'exon':
+                exons.append((fields[0], start, end, fields[5], fields[6], gtf_attribute(fields[8], 'gene_id')))
+            tx_id = gtf_attribute(fields[8], 'transcript_id')
+            if tx_id is None: continue
+            tx = transcripts.get(tx_id)
+            if tx is None:
+                tx = transcripts[tx_id] = [fields[0], fields[6], 0, 0, [], []]
+            #same comparisons as createGTFTranscript
+            if feature == 'CDS':
+                if tx[2] == 0 or start < tx[2]: tx[2] = start - 1
+                if tx[3] == 0 or end > tx[3]: tx[3] = end
+            elif feature == 'exon':
+                tx[4].append(start - 1)
+                tx[5].append(end)
+    return transcripts, exons
+
+#exon/intron/5'UTR/CDS/3'UTR blocks of one transcript, as Transcript.computeMetadata splits them
+def transcript_regions(strand, cds_start, cds_end, starts, ends):
+    regions = {'exons':[], 'introns':[], '5utr':[], 'cds':[], '3utr':[]}
+    if strand not in ('+', '-'):
+        return regions
+    left, right = ('5utr', '3utr') if strand == '+' else ('3utr', '5utr')
+    starts, ends = sorted(starts), sorted(ends)
+    for i in range(len(starts)):
+        s, e = starts[i], ends[i]
+        if cds_start != cds_end:
+            if s < cds_start and e > cds_end:
+                regions[left].append((s, cds_start))
+                regions['cds'].append((cds_start, cds_end))
+                regions[right].append((cds_end, e))
+            elif s < cds_start and e >= cds_start:
+                regions[left].append((s, cds_start))
+                regions['cds'].append((cds_start, e))
+            elif s >= cds_start and s <= cds_end and e > cds_end:
+                regions['cds'].append((s, cds_end))
+                regions[right].append((cds_end, e))
+            elif s < cds_start and e < cds_start:
+                regions[left].append((s, e))
+            elif s >= cds_start and e <= cds_end:
+                regions['cds'].append((s, e))
+            elif s > cds_end and e > cds_end:
+                regions[right].append((s, e))
+        regions['exons'].append((s, e))
+        if i < len(starts) - 1:
+            regions['introns'].append((e, starts[i+1]))
+    #a transcript without any length in a region writes no bed12 line for it
+    for name, blocks in regions.items():
+        if sum(e - s for s, e in blocks) <= 0:
+            regions[name] = []
+    return regions
+
+#bed6 rows of every transcript region, one per block, scored by block number counted along the strand
+def transcript_beds(transcripts):
+    rows = {name:[] for name in bed12}
+    suffix = {'exons':'_exon', 'introns':'_intron', '5utr':'_5utr', 'cds':'_cds', '3utr':'_3utr'}
+    for tx_id, (chrom, strand, cds_start, cds_end, starts, ends) in transcripts.items():
+        for name, blocks in transcript_regions(strand, cds_start, cds_end, starts, ends).items():
+            n = len(blocks)
+            for k, (s, e) in enumerate(blocks):
+                rows[name].append((chrom, s, e, tx_id+suffix[name], n - k if strand == '-' else k + 1, strand))
+    return {name:pd.DataFrame(x, columns=['chr','g_str','g_end','gene_id','g_score','g_dir']) for name, x in rows.items()}
+
+#gene body, promoter and IGR bed6 from the exon lines
+def gene_beds(exons):
+    gene_bed = pd.DataFrame(exons, columns=['chr','g_str','g_end','g_score','g_dir','gene_id'])
+    gene_bed = gene_bed.loc[:,['chr', 'g_str', 'g_end', 'gene_id','g_score','g_dir']]
+    #keep only one g_str, g_end site, ex:
+    gene_bed=gene_bed.drop_duplicates(subset=['g_str','g_end'],keep='first')
+    gene_bed=gene_bed.sort_values(['chr','g_str'],ascending=[True,True])
+    gene_bed=gene_bed.drop_duplicates(subset=['g_str'],keep='last')
+    # combine gene exons, and keep mininum g_str and maximum g_end
+    gene_group=gene_bed.groupby(['chr','gene_id','g_score','g_dir']).agg({'g_str':'min', 'g_end':'max'}).reset_index()
+    gene_group = gene_group.drop_duplicates(subset=['g_str','g_end'],keep='first')
+    gene_body=gene_group.sort_values(['chr','g_str'],ascending=[True,True])
+    gene_body=gene_body.drop_duplicates(subset=['g_str'],keep='last')
+    #redo the order of columns
+    gene_body = gene_body.loc[:,['chr', 'g_str', 'g_end', 'gene_id','g_score','g_dir']]
+    gene_body=gene_body[~gene_body.gene_id.str.contains('MI')]
+
+    #find promoter.bed
+    gene_promoter = gene_body.copy()
+    gene_promoter['g_str'] = np.where(gene_body.g_dir == '+', gene_body.g_str - promoter_size, gene_body.g_end - 0).clip(min=0)
+    gene_promoter['g_end'] = np.where(gene_body.g_dir == '+', gene_body.g_str + 0, gene_body.g_end + promoter_size).clip(min=0)
+
+    #find igr.bed
+    igrcol = pd.DataFrame({'chr':gene_body['chr'].shift(1).fillna('chr1'), 'g_str':gene_body['g_str'],
+                           'igr_str':gene_body['g_end'].shift(1).fillna(0).astype(int)+1, 'igr_end':gene_body['g_str']-1})
+    geneigr = pd.merge(gene_body, igrcol, how='left', on=['chr', 'g_str'])
+    geneigr.igr_str=geneigr.igr_str.fillna(0).astype(int)
+    geneigr.igr_end=geneigr.igr_end.fillna(geneigr.g_str-1).astype(int)
+    geneigr = geneigr.loc[:,['chr', 'igr_str','igr_end', 'gene_id','g_score', 'g_dir']]
+    geneigr = geneigr[geneigr['igr_str']<geneigr['igr_end']]
+    geneigr=geneigr.drop_duplicates(subset=['igr_str','igr_end'],keep='first')
+    geneigr.columns = gene_body.columns
+    return gene_body, gene_promoter, geneigr
+
+#overlapping and book-ended intervals merged, names/scores/strands collapsed with ','
+def merge_bed(bed):
+    if len(bed) == 0:
+        return bed
+    bed = bed.sort_values(['chr','g_str'], kind='stable').reset_index(drop=True)
+    chr_code = pd.factorize(bed['chr'])[0].astype(np.int64) << 40
+    start = chr_code + bed['g_str'].to_numpy(np.int64)
+    end = np.maximum.accumulate(chr_code + bed['g_end'].to_numpy(np.int64))
+    group = np.cumsum(np.r_[True, start[1:] > end[:-1]])
+    return bed.astype({'gene_id':str, 'g_score':str, 'g_dir':str}).groupby(group, sort=False).agg(
+        {'chr':'first', 'g_str':'min', 'g_end':'max', 'gene_id':','.join, 'g_score':','.join, 'g_dir':','.join})
+
+def annotation_cache_dir():
+    return path_to_files+'annotation_cache/'+file_digest(input_gtf_file)+'_'+str(promoter_size)+'/'
+
+def build_annotation(outdir):
+    tmpdir = outdir.rstrip('/')+'.tmp/'
+    shutil.rmtree(tmpdir, ignore_errors=True)
+    os.makedirs(tmpdir)
+    transcripts, exons = read_gtf(input_gtf_file)
+    beds = transcript_beds(transcripts)
+    beds[gene], beds[promoter], beds[igr] = gene_beds(exons)
+    for name in [gene, promoter, igr]:
+        beds[name].to_csv(tmpdir+name+'_bed6.bed', sep='\t', index=False, header=None)
+    for name in annotation_name:
+        merge_bed(beds[name]).to_csv(tmpdir+name+'_merge.bed', sep='\t', index=False, header=None)
+    shutil.rmtree(outdir, ignore_errors=True)
+    os.replace(tmpdir, outdir)
+
+###run profile, written to profile.json: wall time, CPU time (this process and its reaped children,
+#that is worker pools and subprocesses), peak memory and rows read of every stage, and the same for
+#every external command a stage runs. peak_rss_mb is this process during the stage; tree_peak_mb the
+#proportional set size of this process and all of its workers and subprocesses together, sampled
+#every 0.1 s, which is what a node running the stage has to hold
+profile = {'command': command, 'argv': sys.argv[1:], 'workers': workers, 'stages': []}
+profile_stage = None
+profile_start = time.time()
+
+def peak_rss_mb():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024.0
+    except IOError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+#start measuring the peak RSS again from the current RSS (linux)
+def reset_peak_rss():
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except IOError:
+        pass
+
+#memory of a process and its descendants (linux); pages shared by forked processes are split between them
+def tree_memory_mb(pid):
+    total, todo = 0, [pid]
+    while todo:
+        p = todo.pop()
+        try:
+            with open('/proc/%d/smaps_rollup' % p) as f:
+                total += sum(int(line.split()[1]) for line in f if line.startswith('Pss:'))
+            for task in os.listdir('/proc/%d/task' % p):
+                with open('/proc/%d/task/%s/children' % (p, task)) as f:
+                    todo += [int(x) for x in f.read().split()]
+        except (IOError, OSError, ValueError):
+            pass
+    return total / 1024.0
+
+class MemorySampler(threading.Thread):
+    def __init__(self, pid, interval=0.1):
+        threading.Thread.__init__(self, daemon=True)
+        self.pid, self.interval, self.peak = pid, interval, 0.0
+        self.done = threading.Event()
+
+    def run(self):
+        while not self.done.is_set():
+            self.peak = max(self.peak, tree_memory_mb(self.pid))
+            self.done.wait(self.interval)
+
+    def stop(self):
+        self.done.set()
+        self.join()
+        return round(self.peak, 1)
+
+def cpu_seconds():
+    t = os.times()
+    return t.user + t.system + t.children_user + t.children_system
+
+#rows read by the running stage
+def count_rows(n):
+    if profile_stage is not None:
+        profile_stage['rows'] = (profile_stage['rows'] or 0) + int(n)
+
+#subprocess.call(cmd, shell=True), with the command's time and peak memory added to the running stage;
+#a nonzero exit code fails the stage
+def call_command(cmd):
+    start = time.time()
+    proc = subprocess.Popen(cmd, shell=True)
+    sampler = MemorySampler(proc.pid)
+    sampler.start()
+    pid, status, usage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    if profile_stage is not None:
+        profile_stage['subprocesses'].append({'command': cmd, 'returncode': proc.returncode,
+                                              'wall_s': round(time.time() - start, 3),
+                                              'cpu_s': round(usage.ru_utime + usage.ru_stime, 3),
+                                              'peak_mb': sampler.stop()})
+    else:
+        sampler.stop()
+    if proc.returncode != 0:
+        raise RuntimeError("command failed with exit code %d: %s" % (proc.returncode, cmd))
+    return proc.returncode
+
+#call_command in a thread, for plots that do not wait on each other's output; finish_command() the thread returned
+def start_command(cmd):
+    def run():
+        try:
+            thread.returncode = call_command(cmd)
+        except Exception as e:
+            thread.error = e
+    thread = threading.Thread(target=run)
+    thread.returncode, thread.error = None, None
+    thread.start()
+    return thread
+
+#wait for a start_command thread; its command failing fails the stage
+def finish_command(thread):
+    thread.join()
+    if thread.error is not None:
+        raise thread.error
+
+#run a stage; returns its profile entry and the exception it raised, if any
+def profiled(name, func):
+    global profile_stage
+    profile_stage = entry = {'name': name, 'status': 'run', 'rows': None, 'subprocesses': []}
+    reset_peak_rss()
+    sampler = MemorySampler(os.getpid())
+    sampler.start()
+    start, cpu = time.time(), cpu_seconds()
+    error = None
+    try:
+        func()
+    except Exception as e:
+        entry['status'], error = 'failed', e
+    entry['wall_s'] = round(time.time() - start, 3)
+    entry['cpu_s'] = round(cpu_seconds() - cpu, 3)
+    entry['peak_rss_mb'] = round(peak_rss_mb(), 1)
+    entry['tree_peak_mb'] = sampler.stop()
+    profile_stage = None
+    return entry, error
+
+def write_profile():
+    profile['wall_s'] = round(time.time() - profile_start, 3)
+    tmp = path_to_files+'profile.json.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(profile, f, indent=1)
+    os.replace(tmp, path_to_files+'profile.json')
+
+def print_profile():
+    print("%-20s %-8s %9s %9s %9s %9s %12s %5s" % ('stage', 'status', 'wall s', 'cpu s', 'rss MB', 'tree MB', 'rows', 'subp'))
+    for x in profile['stages']:
+        if x['status'] == 'skipped':
+            print("%-20s %s" % (x['name'], x['status']))
+            continue
+        print("%-20s %-8s %9.1f %9.1f %9.0f %9.0f %12s %5d" % (x['name'], x['status'], x['wall_s'], x['cpu_s'], x['peak_rss_mb'],
+              x['tree_peak_mb'], '-' if x['rows'] is None else x['rows'], len(x['subprocesses'])))
+    print("%-20s %-8s %9.1f" % ('total', '', profile['wall_s']))
+
+###stage fingerprints, kept in the work directory so unchanged stages are skipped
+def load_stage_state():
+    try:
+        with open(path_to_files+'methylc_stages.json') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {'stages':{}, 'files':{}}
+
+def save_stage_state():
+    tmp = path_to_files+'methylc_stages.json.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(stage_state, f, indent=1, sort_keys=True)
+    os.replace(tmp, path_to_files+'methylc_stages.json')
+
+#content hash, only recomputed when size or mtime changed
+def file_digest(path):
+    st = os.stat(path)
+    known = stage_state['files'].get(path)
+    if known and known[0] == st.st_size and known[1] == st.st_mtime_ns:
+        return known[2]
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    stage_state['files'][path] = [st.st_size, st.st_mtime_ns, h.hexdigest()]
+    return h.hexdigest()
+
+def stage_fingerprint(inputs, params):
+    h = hashlib.sha256(json.dumps(params, sort_keys=True).encode())
+    for path in inputs:
+        h.update(path.encode())
+        h.update((file_digest(path) if os.path.exists(path) else '-').encode())
+    return h.hexdigest()
+
+#whether a stage's inputs, parameters and outputs are as recorded by the last completed run
+def stage_current(name, fingerprint, outputs):
+    done = stage_state['stages'].get(name)
+    if not force and done and done['fingerprint'] == fingerprint and \
+            all(os.path.exists(x) and file_digest(x) == done['outputs'].get(x) for x in outputs):
+        print("Skipping "+name+": inputs and parameters unchanged")
+        profile['stages'].append({'name': name, 'status': 'skipped'})
+        write_profile()
+        return True
+    stage_state['stages'].pop(name, None)
+    save_stage_state()
+    return False
+
+def stage_finished(name, fingerprint, outputs, entry):
+    profile['stages'].append(entry)
+    write_profile()
+    if entry['status'] == 'run':
+        stage_state['stages'][name] = {'fingerprint':fingerprint,
+                                       'outputs':{x:file_digest(x) for x in outputs if os.path.exists(x)}}
+        save_stage_state()
+
+#run a stage unless it is current
+def run_stage(name, func, inputs, outputs, params):
+    fingerprint = stage_fingerprint(inputs, params)
+    if stage_current(name, fingerprint, outputs):
+        return
+    entry, error = profiled(name, func)
+    stage_finished(name, fingerprint, outputs, entry)
+    if error is not None:
+        raise error
+
+###stage scheduler: stages are declared with the stages whose outputs they read and run as soon as
+#those are done, up to -w stages at a time, each in its own (forked) process. a stage's own worker
+#pools are started inside that process. stages after a failed stage are not run.
+#with -w 1 the stages run one after another in this process, in the order they were declared
+stage_graph = {}
+
+def add_stage(name, func, inputs, outputs, params, after=()):
+    #stages the command does not run are not waited for
+    stage_graph[name] = (func, inputs, outputs, params, [x for x in after if x in stage_graph])
+
+#a stage in a scheduler process; the exception goes back as text, its traceback is printed here
+def stage_process(name, func):
+    entry, error = profiled(name, func)
+    if error is not None:
+        traceback.print_exception(type(error), error, error.__traceback__)
+        return entry, repr(error)
+    return entry, None
+
+def run_stages():
+    if workers <= 1:
+        for name, (func, inputs, outputs, params, after) in stage_graph.items():
+            run_stage(name, func, inputs, outputs, params)
+        return
+    pending = dict(stage_graph)
+    done, failed, running, errors = set(), set(), {}, []
+    with ProcessPoolExecutor(max_workers=min(workers, len(stage_graph)), mp_context=multiprocessing.get_context('fork')) as pool:
+        while pending or running:
+            #declared in dependency order, so a stage is seen after the stages it waits for
+            for name in list(pending):
+                func, inputs, outputs, params, after = pending[name]
+                if any(x in failed for x in after):
+                    print("Not running "+name+": "+', '.join(x for x in after if x in failed)+" failed")
+                    failed.add(name)
+                    del pending[name]
+                elif all(x in done for x in after):
+                    del pending[name]
+                    fingerprint = stage_fingerprint(inputs, params)
+                    if stage_current(name, fingerprint, outputs):
+                        done.add(name)
+                    else:
+                        running[pool.submit(stage_process, name, func)] = (name, fingerprint, outputs)
+            if not running:
+                continue
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name, fingerprint, outputs = running.pop(future)
+                entry, error = future.result()
+                stage_finished(name, fingerprint, outputs, entry)
+                if error is None:
+                    done.add(name)
+                else:
+                    failed.add(name)
+                    errors.append(name+": "+error)
+    if errors:
+        raise RuntimeError("stages failed: "+'; '.join(errors))
+
+
 ###processing start, generating common regions
 
 contexts=["CG","CHG","CHH"]
 #unionsite
 
-combined = pd.DataFrame()
 samples = pd.read_csv(samples_list,header=None,sep="\t")
 #define groups
 expgroup = samples[samples[2] == DMR_exp][0].to_list()
 ctrlgroup = samples[samples[2] == DMR_ctrl][0].to_list()
+cgmaps = [path_to_files+x for x in samples[1]]
+stage_state = load_stage_state()
 
+# generated BED for each genomic region
+gene = "Genebody"
+exon = "exons"
+intron = "introns"
+utr3 = "3utr"
+utr5 = "5utr"
+cds = "cds"
+promoter = "Promoter"
+igr = "IGR"
+bed12=[exon,intron,utr5,cds,utr3]
 
-for sample in samples.itertuples():
-    print("Now processing " + sample[2])
-    CGmap = pd.read_csv(path_to_files+sample[2], header=None,sep="\t",dtype =
-            {0:str,2:str,3:str,5:str,6:str,7:int},usecols=[0,2,3,5,6,7],index_col=[0,1,2],compression='gzip')
-
-    CGmap = CGmap.loc[CGmap[7] >= depth,5:5]
-
-    sample_col = [sample[1]]
-    #sample_col = [sample[1] + '_meth',sample[1] + '_mC',sample[1] + '_C']
-    CGmap.columns = sample_col
-    if len(combined) == 0:
-        combined = CGmap
-    else:
-        combined = pd.merge(combined,CGmap,left_index=True,right_index=True,how = 'outer')
-
-
-combined.reset_index(inplace=True)
-combined.rename(columns = {0:'chr', 2:'pos', 3: 'context'},inplace=True)
-combined[['pos']] = combined[['pos']].astype(int)
-#process chromosome name
-#deleted
-
-#combined[['chr']] = combined[['chr']].astype(int)
-
-combined = combined.sort_values(['chr','pos'],ascending=[True,True])
-combined.to_csv(path_to_files+'Unionsite.txt',sep = '\t',na_rep='-',index=False)
-
-
-#common region
+annotation_name=[promoter,gene,exon,intron,utr5,cds,utr3,igr]
+annotation_beds = [input_gene_name+'_'+i+'_merge.bed' for i in annotation_name]
 
-union=pd.read_csv(path_to_files+'Unionsite.txt',sep='\t',na_values='-')
-#union=combined
-#1.unionsite --> combined
-chrs = union['chr'].unique()
-
-
-#context one by one
-for cxt in contexts:
-        outfile = path_to_files+ 'CommonRegion_' + cxt + '.txt'
-        with open(outfile,'w') as of:
-                of.write('\t'.join(['chr','start','end'] + union.columns.values.tolist()[3:]) + "\n")
-                for chromosome in chrs:
-                        subset = union[(union['context'] == cxt) & (union['chr'] == chromosome)]
-                        if subset.shape[0] == 0: continue 
-                        maxPos = subset['pos'].max()
-                        bins = range(0,maxPos,region)
-                        groups = subset.groupby(pd.cut(subset['pos'], bins))
-                        for sRange,sValues in groups:
-                            #rows, columns = sValues.shape
-                            #with a region find out minimun sites, less than depthcutoff
-                                minDepth = sValues.iloc[:,3:].count().min()
-                                if minDepth >= qualifiedSite:
-                                        methMeth = sValues.iloc[:,3:].astype(float).mean().tolist()
-                                        methMeth2 = [("%.3f" %x) for x in methMeth]
-                                        start = sRange.left
-                                        end = sRange.right
-                                        out = map(str,[chromosome,start,end] + methMeth2)
-                                        outStr = '\t'.join(out)
-                                        of.write(outStr + "\n")
-
-                                else:
-                                        pass
-
-##The Average Methylaion level
-cg = pd.read_csv(path_to_files+"CommonRegion_CG.txt",sep="\t")
-chg = pd.read_csv(path_to_files+"CommonRegion_CHG.txt",sep="\t")
-chh = pd.read_csv(path_to_files+"CommonRegion_CHH.txt",sep="\t")
-
-# Get the expected columns from the first non-empty file
-sample_columns = None
-for df in [cg, chg, chh]:
-    if len(df) > 0:
-        sample_columns = df.columns[3:]
-        break
-
-# Process all three contexts, using 0 for empty contexts
-if sample_columns is not None:
-    # CG context
-    if len(cg) > 0:
-        end = cg.shape[1]
-        cgdf = pd.DataFrame(cg.iloc[:,3:end].mean())
-        cgdf['context'] = 'CG'
-    else:
-        # Create dataframe with 0 values for all samples
-        cgdf = pd.DataFrame(0.0, index=sample_columns, columns=[0])
-        cgdf['context'] = 'CG'
-
-    # CHG context
-    if len(chg) > 0:
-        end = chg.shape[1]
-        chgdf = pd.DataFrame(chg.iloc[:,3:end].mean())
-        chgdf['context'] = 'CHG'
-    else:
-        # Create dataframe with 0 values for all samples
-        chgdf = pd.DataFrame(0.0, index=sample_columns, columns=[0])
-        chgdf['context'] = 'CHG'
-
-    # CHH context
-    if len(chh) > 0:
-        end = chh.shape[1]
-        chhdf = pd.DataFrame(chh.iloc[:,3:end].mean())
-        chhdf['context'] = 'CHH'
-    else:
-        # Create dataframe with 0 values for all samples
-        chhdf = pd.DataFrame(0.0, index=sample_columns, columns=[0])
-        chhdf['context'] = 'CHH'
-
-    merge1 = pd.concat([cgdf,chgdf])
-    merge2 = pd.concat([merge1,chhdf])
-    merge2['sample'] = merge2.index
-    merge2.columns =['methylation level', 'context', 'sample']
-    merge2['methylation level'] = merge2['methylation level']*100
-    merge2['group'] = merge2.index.map(samples.set_index(0)[2])
-else:
-    # All files are empty - create empty DataFrame
-    merge2 = pd.DataFrame(columns=['methylation level', 'context', 'sample', 'group'])
+chrview_exp= DMR_exp
+chrview_ctrl= DMR_ctrl
+metaplot_exp=DMR_exp
+metaplot_ctrl=DMR_ctrl
+metaplot_gene_feature=str('Genebody')
 
 #ploting barplot
 import seaborn as sns
@@ -485,172 +1437,197 @@ import matplotlib as mpl
 matplotlib.rcParams['pdf.fonttype'] = 42
 matplotlib.rcParams['ps.fonttype'] = 42
 
-# Only plot if we have data
-if len(merge2) > 0:
-    sns.set_style("whitegrid")
-    # sns.set_context("talk")
-    sns.set_context("notebook", font_scale=2, rc={"lines.linewidth": 2.5})
+#stages
+union = None
+region_bins = None
 
-    plt.figure(figsize=(8,6))
-
-    # fig.set_size_inches(8,6)
-    g = sns.catplot(
-        data=merge2, kind="bar",
-        x="context", y= 'methylation level', hue='group', palette="dark",
-        alpha=.6, height=6, legend = False)
-
-    plt.legend(fontsize = 15,
-                   bbox_to_anchor= (1.3, 1),
-                   title="",
-                   shadow = False,
-                   facecolor = 'white')
-    ax = g.facet_axis(0,0)
-    for p in ax.patches:
-        ax.text(p.get_x() - 0.001,
-                p.get_height() * 1.05,
-               '{0:.1f}'.format(p.get_height()),   #Used to format it K representation
-                color='black',
-                rotation='horizontal',
-                size='x-small')
-
-    g.set_axis_labels("", "Methylation level (%)")
-    mpl.rcParams['pdf.fonttype'] = 42
-    mpl.rcParams['ps.fonttype'] = 42
-    mpl.rcParams["axes.labelsize"] = 40
+def load_union():
+    global union
+    if union is None:
+        if cache_format != 'none':
+            union=read_union_cache()
+        else:
+            union=pd.read_csv(path_to_files+'Unionsite.txt',sep='\t',na_values='-')
+    return union
+
+#the bins of common_region, with the site order the KS/MWU tests of dmr index union with,
+#are kept as plain arrays in cgmap_store/region_bins.npz so dmr, in its own process with -w > 1,
+#does not bin again
+def region_bins_file():
+    return path_to_files+'cgmap_store/region_bins.npz'
+
+def save_region_bins(bins, order):
+    sample_cols = bins.columns.values.tolist()[4:-2]
+    os.makedirs(os.path.dirname(region_bins_file()), exist_ok=True)
+    with open(region_bins_file()+'.tmp', 'wb') as f:
+        np.savez(f, samples=np.asarray(sample_cols, dtype=str),
+                 context=bins['context'].to_numpy(dtype=str), chr=bins['chr'].to_numpy(dtype=str),
+                 start=bins['start'].to_numpy(dtype=np.int64), end=bins['end'].to_numpy(dtype=np.int64),
+                 means=bins[sample_cols].to_numpy(dtype=np.float64).reshape(len(bins), len(sample_cols)),
+                 first=bins['first'].to_numpy(dtype=np.int64), nsites=bins['nsites'].to_numpy(dtype=np.int64),
+                 order=np.asarray(order, dtype=np.int64))
+    os.replace(region_bins_file()+'.tmp', region_bins_file())
+
+def load_region_bins():
+    global region_bins, region_order
+    if region_bins is None:
+        with np.load(region_bins_file(), allow_pickle=False) as saved:
+            region_bins = pd.DataFrame(saved['means'], columns=saved['samples'].tolist())
+            region_bins.insert(0, 'context', saved['context'].astype(object))
+            region_bins.insert(1, 'chr', saved['chr'].astype(object))
+            region_bins.insert(2, 'start', saved['start'])
+            region_bins.insert(3, 'end', saved['end'])
+            region_bins['first'] = saved['first']
+            region_bins['nsites'] = saved['nsites']
+            region_order = saved['order']
+    return region_bins
+
+def stage_union():
+    global union
+    union = None
+    write_unionsite(samples, path_to_files+'Unionsite.txt', depth)
 
-    plt.savefig(path_to_files +'Average_methylation_levels.pdf',dpi=300,bbox_inches="tight")
-else:
-    print("Warning: No data available to plot Average_methylation_levels. All CommonRegion files are empty.")
+#common region
+def stage_common_region():
+    global region_bins, region_order
+    #all three contexts in one pass
+    region_bins, region_order = bin_regions(load_union(), region, qualifiedSite)
+    save_region_bins(region_bins, region_order)
+    count_rows(len(union))
+    write_common_regions(region_bins, union.columns.values.tolist()[3:])
+    if cache_format != 'none':
+        write_common_region_cache(region_bins, union.columns.values.tolist()[3:])
+
+def stage_average_methylation():
+    if cache_format != 'none':
+        common = read_cache('CommonRegion')
+        cg, chg, chh = [common.loc[common['context'] == cxt, common.columns[1:]] for cxt in contexts]
+    else:
+        cg = pd.read_csv(path_to_files+"CommonRegion_CG.txt",sep="\t")
+        chg = pd.read_csv(path_to_files+"CommonRegion_CHG.txt",sep="\t")
+        chh = pd.read_csv(path_to_files+"CommonRegion_CHH.txt",sep="\t")
+    count_rows(len(cg) + len(chg) + len(chh))
+
+    # Get the expected columns from the first non-empty file
+    sample_columns = None
+    for df in [cg, chg, chh]:
+        if len(df) > 0:
+            sample_columns = df.columns[3:]
+            break
+
+    # Process all three contexts, using 0 for empty contexts
+    if sample_columns is not None:
+        # CG context
+        if len(cg) > 0:
+            end = cg.shape[1]
+            cgdf = pd.DataFrame(cg.iloc[:,3:end].mean())
+            cgdf['context'] = 'CG'
+        else:
+            # Create dataframe with 0 values for all samples
+            cgdf = pd.DataFrame(0.0, index=sample_columns, columns=[0])
+            cgdf['context'] = 'CG'
+
+        # CHG context
+        if len(chg) > 0:
+            end = chg.shape[1]
+            chgdf = pd.DataFrame(chg.iloc[:,3:end].mean())
+            chgdf['context'] = 'CHG'
+        else:
+            # Create dataframe with 0 values for all samples
+            chgdf = pd.DataFrame(0.0, index=sample_columns, columns=[0])
+            chgdf['context'] = 'CHG'
+
+        # CHH context
+        if len(chh) > 0:
+            end = chh.shape[1]
+            chhdf = pd.DataFrame(chh.iloc[:,3:end].mean())
+            chhdf['context'] = 'CHH'
+        else:
+            # Create dataframe with 0 values for all samples
+            chhdf = pd.DataFrame(0.0, index=sample_columns, columns=[0])
+            chhdf['context'] = 'CHH'
+
+        merge1 = pd.concat([cgdf,chgdf])
+        merge2 = pd.concat([merge1,chhdf])
+        merge2['sample'] = merge2.index
+        merge2.columns =['methylation level', 'context', 'sample']
+        merge2['methylation level'] = merge2['methylation level']*100
+        merge2['group'] = merge2.index.map(samples.set_index(0)[2])
+    else:
+        # All files are empty - create empty DataFrame
+        merge2 = pd.DataFrame(columns=['methylation level', 'context', 'sample', 'group'])
+
+    # Only plot if we have data
+    if len(merge2) > 0:
+        sns.set_style("whitegrid")
+        # sns.set_context("talk")
+        sns.set_context("notebook", font_scale=2, rc={"lines.linewidth": 2.5})
+
+        plt.figure(figsize=(8,6))
+
+        # fig.set_size_inches(8,6)
+        g = sns.catplot(
+            data=merge2, kind="bar",
+            x="context", y= 'methylation level', hue='group', palette="dark",
+            alpha=.6, height=6, legend = False)
+
+        plt.legend(fontsize = 15,
+                       bbox_to_anchor= (1.3, 1),
+                       title="",
+                       shadow = False,
+                       facecolor = 'white')
+        ax = g.facet_axis(0,0)
+        for p in ax.patches:
+            ax.text(p.get_x() - 0.001,
+                    p.get_height() * 1.05,
+                   '{0:.1f}'.format(p.get_height()),   #Used to format it K representation
+                    color='black',
+                    rotation='horizontal',
+                    size='x-small')
+
+        g.set_axis_labels("", "Methylation level (%)")
+        mpl.rcParams['pdf.fonttype'] = 42
+        mpl.rcParams['ps.fonttype'] = 42
+        mpl.rcParams["axes.labelsize"] = 40
+
+        plt.savefig(path_to_files +'Average_methylation_levels.pdf',dpi=300,bbox_inches="tight")
+    else:
+        print("Warning: No data available to plot Average_methylation_levels. All CommonRegion files are empty.")
 
 #heatmap_PCA
-if(command=='Heatmap_PCA' or command=='all'):
+def stage_heatmap_pca():
     print ("*------------------------*")
     print ("|generating Heatmap $ PCA|")
     print ("*------------------------*")
-    if context == 'CG':
-        subprocess.call('''Rscript --slave /MethylC-analyzer/scripts/heatmap_PCA_all.R %s %s %s'''%(path_to_files + "CommonRegion_CG.txt",pca_heat_cut,path_to_files), shell=True)
-    elif context == 'CHG':
-        subprocess.call('''Rscript --slave /MethylC-analyzer/scripts/heatmap_PCA_all.R %s %s %s'''%(path_to_files +"CommonRegion_CHG.txt",pca_heat_cut,path_to_files), shell=True)
-    elif context == 'CHH':
-        subprocess.call('''Rscript --slave /MethylC-analyzer/scripts/heatmap_PCA_all.R %s %s %s'''%(path_to_files +"CommonRegion_CHH.txt",pca_heat_cut,path_to_files ), shell=True)
-
-else:
-    pass
+    #the cutoff is applied here, R gets the variable regions only
+    write_variable_regions(path_to_files+"CommonRegion_"+context+".txt", path_to_files+"VariableRegion_"+context+".bin", pca_heat_cut, pca_heat_max)
+    call_command('''Rscript --slave /MethylC-analyzer/scripts/heatmap_PCA_all.R %s %s %s'''%(path_to_files +"VariableRegion_"+context+".bin",pca_heat_cut,path_to_files))
 
 # Identify DMR
-if(command=='DMR' or command=='all'):
+def stage_dmr():
 
     print ("*---------------*")
     print ("|Identifying DMR|")
     print ("*---------------*")
 
-    expgroup = samples[samples[2] == DMR_exp][0]
-    ctrlgroup = samples[samples[2] == DMR_ctrl][0]
-
-    Find_DMR2(context,dmr_cut,testmethod) 
-
-else:
-    pass
-
+    load_union()
+    load_region_bins()
+    Find_DMR2(context,dmr_cut,testmethod)
 
 # preprocessing for DMG, fold enrichment
-# generated BED for each genomic region
-
-
-gene = "Genebody"
-exon = "exons"
-intron = "introns"
-utr3 = "3utr"
-utr5 = "5utr"
-cds = "cds"
-promoter = "Promoter"
-igr = "IGR"
-bed12=[exon,intron,utr5,cds,utr3]
-
-annotation_name=[promoter,gene,exon,intron,utr5,cds,utr3,igr]
-
-subprocess.call('''python %s/extract_transcript_regions.py -i %s -o %s --gtf'''%(SCRIPT_DIR,input_gtf_file,input_gtf_file), shell=True)
-
-#Convert this blockbed (bed12) to bed6|
-for i in bed12:
-    subprocess.call('''cat %s | bed12ToBed6 -i stdin -n > %s'''%(input_gtf_file+'_'+i+'.bed',input_gtf_file+'_'+i+'_bed6.bed'),shell=True)
-    # print (i)
-
-subprocess.call('''rm %s*3utr.bed %s*5utr.bed %s*_cds.bed %s*_exons.bed %s*_introns.bed '''%(path_to_files,path_to_files,path_to_files,path_to_files,path_to_files),shell=True)
-subprocess.call('''rm %s*_coding*.bed %s*noncoding*.bed %s*5utr_start.bed'''%(path_to_files,path_to_files,path_to_files),shell=True)
-
-#find gene_body.bed
-genes = pd.read_csv(str(input_gtf_file), header=None, sep="\t",dtype = {0 :str}, comment='#')
-#input_gene=pd.read_csv(str(input_gtf_file),sep='\t',header=None)
-
-#genes=genes[genes[0].str.len()<=5]
-genes.columns=['chr','unknow', 'exon', 'g_str', 'g_end', 'g_score', 'g_dir','.', 'gene_name']
-genes=genes[genes.exon=='exon']
-
-genes.gene_name=' '+genes.gene_name
-
-gene_col=genes['gene_name'].str.split(';', expand=True) 
-#header=row1
-gene_col.columns=gene_col.iloc[1,:]
-#filter gene_col contains 'gene_id'
-gene_id = gene_col.filter(regex='gene_id')
-gene_id = gene_id.iloc[:,0].str.split(' ', expand=True)
-#remove head and end's character
-gene_id[2] = gene_id[2].map(lambda x: x.lstrip('"').rstrip('"'))
-gene_id.columns=['num','g_name','gene_id']
-gene_bed = genes.loc[:,['chr', 'g_str', 'g_end', 'g_score','g_dir']].join(gene_id['gene_id'])
-#change order
-gene_bed = gene_bed.loc[:,['chr', 'g_str', 'g_end', 'gene_id','g_score','g_dir']]
-#keep only one g_str, g_end site, ex:
-gene_bed=gene_bed.drop_duplicates(subset=['g_str','g_end'],keep='first')
-gene_bed=gene_bed.sort_values(['chr','g_str'],ascending=[True,True])
-gene_bed=gene_bed.drop_duplicates(subset=['g_str'],keep='last')
-# combine gene exons, and keep mininum g_str and maximum g_end
-gene_group=gene_bed.groupby(['chr','gene_id','g_score','g_dir']).agg({'g_str':'min', 'g_end':'max'}).reset_index()
-gene_group = gene_group.drop_duplicates(subset=['g_str','g_end'],keep='first')
-gene_body=gene_group.sort_values(['chr','g_str'],ascending=[True,True])
-gene_body=gene_body.drop_duplicates(subset=['g_str'],keep='last')
-#redo the order of columns
-gene_body = gene_body.loc[:,['chr', 'g_str', 'g_end', 'gene_id','g_score','g_dir']]
-gene_body=gene_body[~gene_body.gene_id.str.contains('MI')]
-gene_body.to_csv(input_gtf_file+'_Genebody_bed6.bed', sep='\t',index=False, header=None)
-
-#find promoter.bed
-gene_body['pro_str'] = np.where(gene_body.g_dir == '+', gene_body.g_str - promoter_size, gene_body.g_end - 0)
-gene_body['pro_end'] = np.where(gene_body.g_dir == '+', gene_body.g_str + 0, gene_body.g_end + promoter_size)
-num = gene_body._get_numeric_data()
-num[num<0]=0
-gene_promoter = gene_body.loc[:, ['chr','pro_str','pro_end','gene_id','g_score','g_dir']]
-gene_promoter.columns=['chr','g_str','g_end','gene_id','g_score','g_dir']
-
-gene_promoter.to_csv(input_gtf_file+"_Promoter_bed6.bed", sep='\t',index=False, header=None)
-
-
-#find igr.bed
-gene_body['igr_str'] = gene_body['g_end'].shift(1).fillna(0).astype(int)+1
-gene_body['igr_end'] = gene_body['g_str']-1
-gene_body['igr_chr'] = gene_body['chr'].shift(1).fillna('chr1')
-igrcol = gene_body.loc[:,['igr_chr','g_str','igr_str','igr_end']]
-igrcol.columns = ['chr', 'g_str', 'igr_str', 'igr_end']
-genecol=gene_body.loc[:,['chr','g_str','g_end','gene_id','g_score','g_dir']]
-geneigr = pd.merge(genecol, igrcol, how='left', on=['chr', 'g_str'])
-geneigr.igr_str=geneigr.igr_str.fillna(0).astype(int)
-geneigr.igr_end=geneigr.igr_end.fillna(geneigr.g_str-1).astype(int)
-geneigr = geneigr.loc[:,['chr', 'igr_str','igr_end', 'gene_id','g_score', 'g_dir']]
-geneigr = geneigr[geneigr['igr_str']<geneigr['igr_end']]
-geneigr=geneigr.drop_duplicates(subset=['igr_str','igr_end'],keep='first')
-geneigr.to_csv(input_gene_name+"_IGR_bed6.bed", sep="\t", index=False, header=None)
-
-
-for i in annotation_name:
-        subprocess.call('''bedtools sort -i %s|bedtools merge -c 4,5,6 -o collapse,collapse,collapse >%s '''%(input_gene_name+'_'+i+'_bed6.bed',input_gene_name +'_'+i+'_merge.bed'),shell=True)
-
-subprocess.call('''rm %s*3utr_bed6.bed %s*cds_bed6.bed %s*5utr_bed6.bed %s*exons_bed6.bed %s*gene_igr_bed6.bed %s*introns_bed6.bed '''%(path_to_files,path_to_files,path_to_files,path_to_files,path_to_files,path_to_files),shell=True)
-
-
+def stage_annotation():
+    outdir = annotation_cache_dir()
+    if os.path.isdir(outdir) and not force:
+        print("Using cached annotation "+outdir)
+    else:
+        build_annotation(outdir)
+    for name in annotation_name:
+        shutil.copyfile(outdir+name+'_merge.bed', input_gene_name+'_'+name+'_merge.bed')
+    for name in [gene, promoter, igr]:
+        shutil.copyfile(outdir+name+'_bed6.bed', input_gene_name+'_'+name+'_bed6.bed')
 
 #DMR enrichmet cal & plot
-if(command=='Fold_Enrichment' or command=='all'):
+def stage_enrichment():
     print ("*--------------------------------*")
     print ("|Applying DMR enrichment analysis|")
     print ("*--------------------------------*")
@@ -660,18 +1637,20 @@ if(command=='Fold_Enrichment' or command=='all'):
 #    Enrichment('CHG', dmr_CHG_cut)
 #    Enrichment('CHH', dmr_CHH_cut)
 
-else:
-    pass
-
 #DMG
 def dmg(tag,dmrfile,direction,cutoff):
-    subprocess.call('''bedtools intersect -a %s -b %s -wo >%s '''%(dmrfile,input_gene_name +'_Genebody_bed6.bed',path_to_files+"DMG_"+tag+"_"+direction+"_"+str(cutoff)+"_Genebody_list.txt"),shell=True)
-    subprocess.call('''bedtools intersect -a %s -b %s -wo >%s '''%(dmrfile,input_gene_name +'_Promoter_bed6.bed',path_to_files+"DMG_"+tag+"_"+direction+"_"+str(cutoff)+"_Promoter_list.txt"),shell=True)
-    
- 
-
-
-if(command=='DMG' or command=='all' ):
+    dmr_bed=read_intervals(dmrfile)
+    count_rows(len(dmr_bed))
+    for feature in ['Genebody','Promoter']:
+        gene_bed=read_intervals(input_gene_name +'_'+feature+'_bed6.bed')
+        hits=dmr_bed.pairs(gene_bed)
+        a, b = hits[:,0], hits[:,1]
+        #intersect -wo: fields of both intervals and the overlap in bp
+        overlap_bp=np.minimum(dmr_bed.end[a], gene_bed.end[b]) - np.maximum(dmr_bed.start[a], gene_bed.start[b])
+        out=pd.concat([dmr_bed.fields.iloc[a].reset_index(drop=True), gene_bed.fields.iloc[b].reset_index(drop=True), pd.Series(overlap_bp)], axis=1)
+        out.to_csv(path_to_files+"DMG_"+tag+"_"+direction+"_"+str(cutoff)+"_"+feature+"_list.txt", sep='\t', header=False, index=False)
+
+def stage_dmg():
 
     print ("*---------------*")
     print ("|Identifying DMG|")
@@ -695,20 +1674,12 @@ if(command=='DMG' or command=='all' ):
         bed_form(path_to_files+"DMR_CHH_all_"+str(dmr_cut)+".txt")
         bed_form(path_to_files+"DMR_CHH_hyper_"+str(dmr_cut)+".txt")
         bed_form(path_to_files+"DMR_CHH_hypo_"+str(dmr_cut)+".txt")
-        dmg('CHH',path_to_files+"DMR_CHH_hyper_"+str(dmr_CHH_cut)+".txt.bed",'hyper', dmr_cut)
-        dmg('CHH',path_to_files+"DMR_CHH_hypo_"+str(dmr_CHH_cut)+".txt.bed", 'hypo',dmr_cut)
+        dmg('CHH',path_to_files+"DMR_CHH_hyper_"+str(dmr_cut)+".txt.bed",'hyper', dmr_cut)
+        dmg('CHH',path_to_files+"DMR_CHH_hypo_"+str(dmr_cut)+".txt.bed", 'hypo',dmr_cut)
         DMR_DMGPlot('CHH',dmr_cut)
 
-else:
-    pass
-
-#----------------------------------------------------------------------------------------------------------------------------------------------------------
 #####chrview
-if(command=='ChrView' or command=='all'):
-
-    chrview_exp= DMR_exp
-    chrview_ctrl= DMR_ctrl
-
+def stage_chrview():
 
     print ("*--------------------------*")
     print ("|Generating ChrView figures|")
@@ -718,52 +1689,21 @@ if(command=='ChrView' or command=='all'):
     #samples = pd.read_csv("samples_list.txt",header=None,sep="\t")
     #depth = 4
     #binSize = 100000000
-    for sample in samples.itertuples():
-        #print("Now reading " + sample[2])
-        CGmap = pd.read_csv(path_to_files+sample[2], compression='gzip',header=None,sep="\t",dtype = {0 :str})
-        chrs = CGmap[0].unique()
-        Position = 0
-        #print ("Position\tchromosome\tsRange\tmeanCG\tmeanCHG\tmeanCHH")
-        with open(path_to_files+"chrView_list.txt",'a') as f:
-            f.write(sample[1]+'\t'+sample[1]+"_"+str(binSize)+"_chrView.txt"+'\n')
-
-        #savefile=pd.DataFrame(columns=["Position","chromosome","sRange","meanCG","meanCHG","meanCHH"])
-        savefile=pd.DataFrame(columns=["Position","chromosome","start","end","meanCG","meanCHG","meanCHH"])
-        #mylist=[]
-        for chromosome in chrs:
-            subset = CGmap[(CGmap[7] >= depth) & (CGmap[0] == chromosome) ]
-            if subset.shape[0] == 0: continue 
-            subset = subset._convert(numeric=True)
-            maxPos = subset[2].max()
-            bins = range(0,maxPos,binSize)
-            groups = subset.groupby(pd.cut(subset[2], bins))
-
-
-
-            for sRange,sValues in groups:
-                Position += 1
-                start = sRange.left
-                end = sRange.right
-                meanCG = sValues[sValues[3] == 'CG'][5].mean(skipna=True)
-                meanCHG = sValues[sValues[3] == 'CHG'][5].mean(skipna=True)
-                meanCHH = sValues[sValues[3] == 'CHH'][5].mean(skipna=True)
-                out = map(str,[Position,chromosome,start,end,meanCG,meanCHG,meanCHH])
-
-                out = pd.Series([Position,chromosome,start,end,meanCG,meanCHG,meanCHH],index=["Position","chromosome","start","end","meanCG","meanCHG","meanCHH"])
-                savefile=savefile.append(out,ignore_index=True)
-        savefile.to_csv(path_to_files+sample[1]+"_tmpchrView.txt",sep='\t',index=None)
-    #sort chromosome
-    chrlist=pd.read_csv(path_to_files+"chrView_list.txt",header=None,sep='\t')
-    chrlist[2] = chrlist[0].map(samples.set_index(0)[2])
+    chrlist = pd.DataFrame({0: samples[0], 1: samples[0]+"_"+str(binSize)+"_chrView.txt", 2: samples[2]})
     chrlist.to_csv(path_to_files+"chrView_list.txt", sep ='\t',index=None, header=None)
 
-    for sample in chrlist[0]:
-        subprocess.call(''' (head -n 1 %s && tail -n +2 %s |sort -k2,2 -V -s) > %s '''%(path_to_files+sample+'_tmpchrView.txt',path_to_files+sample+'_tmpchrView.txt',path_to_files+sample+"_"+str(binSize)+'_chrView.txt'), shell = True)
-
-    subprocess.call('''rm %s*_tmpchrView.txt'''%(path_to_files),shell=True)
+    #one sample per worker process
+    jobs = [(x, path_to_files+y, depth, binSize) for x, y in zip(samples[1], chrlist[1])]
+    if workers > 1 and len(jobs) > 1:
+        with ProcessPoolExecutor(max_workers=min(workers, len(jobs)), mp_context=multiprocessing.get_context('fork')) as pool:
+            list(pool.map(chrview_sample, *zip(*jobs)))
+    else:
+        for job in jobs:
+            chrview_sample(*job)
+    count_rows(sum(CGmapStore(x).meta['rows'] for x in samples[1]))
 
-    #plotting
-    subprocess.call("Rscript --slave /MethylC-analyzer/scripts/chrView.R %s"%(path_to_files) , shell=True)
+    #plotting, while the delta is computed
+    plot = start_command("Rscript --slave /MethylC-analyzer/scripts/chrView.R %s"%(path_to_files))
     
 ############chrView_delta################################################
     chrlist=pd.read_csv(path_to_files +"chrView_list.txt",header=None,sep='\t')
@@ -819,83 +1759,101 @@ if(command=='ChrView' or command=='all'):
 
 
     #plotting chrview difference
-    subprocess.call("Rscript --slave /MethylC-analyzer/scripts/chrView_delta.R %s"%(path_to_files), shell=True)
-else:
-    pass
-
-
+    try:
+        call_command("Rscript --slave /MethylC-analyzer/scripts/chrView_delta.R %s"%(path_to_files))
+    finally:
+        finish_command(plot)
 
 #metaplot
-
-if(command=='Metaplot' or command=='all'):
-    metaplot_exp=DMR_exp
-    metaplot_ctrl=DMR_ctrl
-    
-    metaplot_gene_feature=str('Genebody')
-
+def stage_metaplot():
     print ("*--------------------*")
     print ("|Generating metaplots|")
     print ("*--------------------*")
 
-    #union to bw
-    #cgmap=pd.read_csv("union4.txt",sep='\t',dtype={0:str})
-    cgmap=union
+    #sites to bw and scale-regions profiles, one sample per worker process
     genebodybed=input_gene_name+"_"+metaplot_gene_feature+"_merge.bed"
-    bwheader=[]
-    for chr in cgmap.iloc[:,0].unique():
-        k=cgmap[cgmap.iloc[:,0]==chr]
-        maxPos=k.iloc[:,1].max()
-        bwheader.append((str(chr),int(maxPos)))
-
-    #3 first sample
-    for i in range(3,cgmap.shape[1]):
-        #print i
-        Samplename=cgmap.columns[i]
-        cgoutfile=path_to_files+Samplename+"_CG.bw"
-        chgoutfile=path_to_files+Samplename+"_CHG.bw"
-        chhoutfile=path_to_files+Samplename+"_CHH.bw"
-
-        bw_CG = pyBigWig.open(cgoutfile,"w")
-        bw_CG.addHeader(bwheader)
-        bw_CHG = pyBigWig.open(chgoutfile,"w")
-        bw_CHG.addHeader(bwheader)
-        bw_CHH = pyBigWig.open(chhoutfile,"w")
-        bw_CHH.addHeader(bwheader)
-
-        for chromosome in cgmap.iloc[:,0].unique():
-            k=cgmap[cgmap.iloc[:,0]==chromosome]
-            CG = k[(k.iloc[:,2] == 'CG') & (k.iloc[:,i] != np.nan)]
-            CHG = k[(k.iloc[:,2] == 'CHG') & (k.iloc[:,i] != np.nan)]
-            CHH = k[(k.iloc[:,2] == 'CHH') & (k.iloc[:,i] != np.nan)]
-
-            bw_CG.addEntries(str(chromosome),[x-1 for x in CG.iloc[:,1].tolist()],values=CG.iloc[:,i].astype(float).tolist(), span=1)
-            bw_CHG.addEntries(str(chromosome),[x-1 for x in CHG.iloc[:,1].tolist()],values=CHG.iloc[:,i].astype(float).tolist(), span=1)
-            bw_CHH.addEntries(str(chromosome),[x-1 for x in CHH.iloc[:,1].tolist()],values=CHH.iloc[:,i].astype(float).tolist(), span=1)
-
-        bw_CG.close()
-        bw_CHG.close()
-        bw_CHH.close()
-
-        #catch warninig 
-        devnull = open(os.devnull, 'w')
-           
-        subprocess.call('''computeMatrix scale-regions -S %s -R %s -a 2000 -b 2000 -m 4000 -bs 100 -out %s'''%(path_to_files+Samplename+"_CG.bw",genebodybed,path_to_files+Samplename+"_CG.matrix.gz"),shell=True,stdout=devnull, stderr=devnull)
-        subprocess.call('''computeMatrix scale-regions -S %s -R %s -a 2000 -b 2000 -m 4000 -bs 100 -out %s'''%(path_to_files+Samplename+"_CHG.bw",genebodybed,path_to_files+Samplename+"_CHG.matrix.gz"),shell=True,stdout=devnull, stderr=devnull)
-        subprocess.call('''computeMatrix scale-regions -S %s -R %s -a 2000 -b 2000 -m 4000 -bs 100 -out %s'''%(path_to_files+Samplename+"_CHH.bw",genebodybed,path_to_files+Samplename+"_CHH.matrix.gz"),shell=True,stdout=devnull, stderr=devnull)
-
-    #metaplot
-
-    subprocess.call("Rscript --slave /MethylC-analyzer/scripts/metaplot.R "+path_to_files+ ' '+metaplot_gene_feature,shell=True)
+    stores = open_stores(samples[1].tolist())
+    count_rows(sum(s.meta['rows'] for s in stores))
+    bwheader = bigwig_header(stores, depth)
+    regions, edges, minus = metaplot_regions(genebodybed, [x for x, size in bwheader])
+    names = samples[0].astype(str).tolist()
+    jobs = [(x, y, bwheader, depth, regions, edges, minus) for x, y in zip(samples[1], names)]
+    if workers > 1 and len(jobs) > 1:
+        with ProcessPoolExecutor(max_workers=min(workers, len(jobs)), mp_context=multiprocessing.get_context('fork')) as pool:
+            matrices = dict(zip(names, pool.map(metaplot_sample, *zip(*jobs))))
+    else:
+        matrices = {y: metaplot_sample(*job) for y, job in zip(names, jobs)}
+
+    #metaplot, while the delta files are generated
+
+    plot = start_command("Rscript --slave /MethylC-analyzer/scripts/metaplot.R "+path_to_files+ ' '+metaplot_gene_feature)
 
     ##generating delta files
-    Delta_Meta('CG')
-    Delta_Meta('CHG')
-    Delta_Meta('CHH')
-    #ploting delta meta
-    subprocess.call("Rscript --slave /MethylC-analyzer/scripts/metaplot_delta.R " +metaplot_exp+' '+metaplot_ctrl + ' '+path_to_files,shell=True)
+    try:
+        Delta_Meta('CG', regions, matrices)
+        Delta_Meta('CHG', regions, matrices)
+        Delta_Meta('CHH', regions, matrices)
+        #ploting delta meta
+        call_command("Rscript --slave /MethylC-analyzer/scripts/metaplot_delta.R " +metaplot_exp+' '+metaplot_ctrl + ' '+path_to_files)
+    finally:
+        finish_command(plot)
+
+
+def dmr_files(prefix, suffix):
+    return [path_to_files+prefix+context+'_'+d+'_'+str(dmr_cut)+suffix for d in ['all','hyper','hypo']]
+
+#the PDFs an R script writes to the work directory, outputs of its stage so a missing plot reruns it
+def plots(prefixes, suffix='.pdf', cxts=contexts):
+    return [path_to_files+prefix+cxt+suffix for prefix in prefixes for cxt in cxts]
+
+common_regions = [path_to_files+'CommonRegion_'+cxt+'.txt' for cxt in contexts]
+union_cache = [cache_file('Unionsite')] if cache_format != 'none' else []
+region_cache = [cache_file('CommonRegion')] if cache_format != 'none' else []
+
+add_stage('union', stage_union, [samples_list]+cgmaps, [path_to_files+'Unionsite.txt']+union_cache,
+          {'depth':depth, 'cache':cache_format})
+add_stage('common_region', stage_common_region, [path_to_files+'Unionsite.txt'], common_regions+region_cache+[region_bins_file()],
+          {'region':region, 'qualified':qualifiedSite, 'cache':cache_format}, after=['union'])
+add_stage('average_methylation', stage_average_methylation, [samples_list]+common_regions,
+          [path_to_files+'Average_methylation_levels.pdf'], {}, after=['common_region'])
+
+if(command=='Heatmap_PCA' or command=='all'):
+    add_stage('heatmap_pca', stage_heatmap_pca, [path_to_files+'CommonRegion_'+context+'.txt'], [path_to_files+'VariableRegion_'+context+'.bin']+plots(['Heatmap_', 'PCA_'], '_'+str(pca_heat_cut)+'.pdf', [context]),
+              {'context':context, 'cutoff':pca_heat_cut, 'max':pca_heat_max}, after=['common_region'])
+
+if(command=='DMR' or command=='all'):
+    add_stage('dmr', stage_dmr, [samples_list, path_to_files+'Unionsite.txt', region_bins_file()], dmr_files('DMR_', '.txt'),
+              {'context':context, 'cutoff':dmr_cut, 'test':testmethod, 'pvalue':pvalue, 'fdr':fdr,
+               'region':region, 'qualified':qualifiedSite, 'exp':DMR_exp, 'ctrl':DMR_ctrl}, after=['union', 'common_region'])
+
+add_stage('annotation', stage_annotation, [input_gtf_file],
+          annotation_beds+[input_gene_name+'_'+x+'_bed6.bed' for x in [gene, promoter, igr]],
+          {'promoter_size':promoter_size})
+
+if(command=='Fold_Enrichment' or command=='all'):
+    add_stage('enrichment', stage_enrichment, dmr_files('DMR_', '.txt')+annotation_beds+[path_to_files+'CommonRegion_'+context+'.txt'],
+              [path_to_files+context+'_Fold_Enrichment.pdf'], {'context':context, 'cutoff':dmr_cut}, after=['dmr', 'annotation', 'common_region'])
+
+if(command=='DMG' or command=='all' ):
+    add_stage('dmg', stage_dmg, dmr_files('DMR_', '.txt')+[input_gene_name+'_Genebody_bed6.bed', input_gene_name+'_Promoter_bed6.bed'],
+              [path_to_files+'DMG_'+context+'_'+d+'_'+str(dmr_cut)+'_'+f+'_list.txt' for d in ['hyper','hypo'] for f in ['Genebody','Promoter']],
+              {'context':context, 'cutoff':dmr_cut}, after=['dmr', 'annotation'])
+
+#union builds the CGmap stores chrView and metaplot read, they wait for it; a store found stale
+#after that (a CGmap touched since) is rebuilt once under its lock
+if(command=='ChrView' or command=='all'):
+    add_stage('chrview', stage_chrview, [samples_list]+cgmaps,
+              [path_to_files+x+'_'+str(binSize)+'_chrView.txt' for x in samples[0]]+[path_to_files+'chrView_delta.txt']+plots(['chrView_', 'chrView_delta_']),
+              {'depth':depth, 'bin_size':binSize, 'exp':chrview_exp, 'ctrl':chrview_ctrl}, after=['union'])
+
+if(command=='Metaplot' or command=='all'):
+    add_stage('metaplot', stage_metaplot, [samples_list, input_gene_name+'_'+metaplot_gene_feature+'_merge.bed']+cgmaps,
+              [path_to_files+'metaplot_delta_'+cxt+'.txt' for cxt in contexts]+plots(['metaplot_', 'metaplot_delta_']),
+              {'depth':depth, 'exp':metaplot_exp, 'ctrl':metaplot_ctrl}, after=['union', 'annotation'])
 
-else:
-    pass
+run_stages()
+write_profile()
+print_profile()
 
 
 #### output plotting log ###
@@ -906,7 +1864,7 @@ fp.close()
 if (command=='Heatmap_PCA' or command=='all'):
     fp = open(path_to_files +"plot.log", "a")
     print("#PCA & Heatmap:",file=fp)
-    print ("Rscript --slave /MethylC-analyzer/scripts/heatmap_PCA_all.R "+ path_to_files +"CommonRegion_"+context+".txt "+ str(pca_heat_cut)+ " "+str(path_to_files), file=fp)
+    print ("Rscript --slave /MethylC-analyzer/scripts/heatmap_PCA_all.R "+ path_to_files +"VariableRegion_"+context+".bin "+ str(pca_heat_cut)+ " "+str(path_to_files), file=fp)
     fp.close()
     
 if(command=='ChrView' or command=='all'):
@@ -0,0 +1,108 @@
+# coding=UTF-8
+
+# import packages
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import time
+from simulate_cgmap import simulate
+
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+commands = ["Heatmap_PCA", "DMR", "DMG", "Fold_Enrichment", "ChrView", "Metaplot"]
+
+
+def get_parser():
+    """
+    Create a parser and add arguments
+    """
+    parser = argparse.ArgumentParser(description="time MethylC.py commands on synthetic data of several sizes")
+    parser.add_argument("-o", "--output", default="benchmark.json", type=str, help="JSON file the results are written to")
+    parser.add_argument("-d", "--workdir", default="benchmark_data", type=str, help="directory the synthetic data sets are generated in")
+    group1 = parser.add_argument_group('Data')
+    group1.add_argument("-g", "--genome-sizes", default="1e6,1e7", type=str, help="comma separated genome sizes, one data set each")
+    group1.add_argument("-c", "--chromosomes", default=5, type=int, help="number of chromosomes")
+    group1.add_argument("-n", "--samples", default=2, type=int, help="samples per group")
+    group1.add_argument("--density", default=0.2, type=float, help="fraction of positions reported as a cytosine site")
+    group1.add_argument("--contexts", default="0.1,0.15,0.75", type=str, help="fractions of CG,CHG,CHH sites")
+    group1.add_argument("-f", "--format", default="cgmap", choices=["cgmap", "binary"], type=str, help="CGmap.gz or binary CGmap container samples")
+    group1.add_argument("--seed", default=1, type=int, help="random seed of the data sets")
+    group2 = parser.add_argument_group('Runs')
+    group2.add_argument("--commands", default=",".join(commands), type=str, help="comma separated MethylC.py commands, run in this order")
+    group2.add_argument("-w", "--workers", default=0, type=int, help="-w of MethylC.py, default = all CPUs")
+    group2.add_argument("-r", "--repeat", default=1, type=int, help="runs of every command")
+    group2.add_argument("--cold", action="store_true", help="run every command with -force, so the shared stages (union, common regions, annotation) are timed each time")
+    group2.add_argument("--keep", action="store_true", help="keep the generated data sets")
+    group2.add_argument("--methylc", default=os.path.join(SCRIPT_DIR, "MethylC.py"), type=str, help="MethylC.py to benchmark")
+    group2.add_argument("--args", default="", type=str, help="extra MethylC.py arguments, e.g. \"-r 200 -q 2\"")
+    return parser
+
+
+def run(cmd, workdir):
+    """
+    run a command in workdir; wall and CPU time, the largest RSS of the command or any process it waited for, and the exit code
+    """
+    start = time.time()
+    with open(os.path.join(workdir, "benchmark.log"), "a") as log:
+        log.write("$ " + " ".join(cmd) + "\n")
+        log.flush()
+        proc = subprocess.Popen(cmd, cwd=workdir, stdout=log, stderr=subprocess.STDOUT)
+        pid, status, usage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    return {"wall_s": round(time.time() - start, 3), "cpu_s": round(usage.ru_utime + usage.ru_stime, 3),
+            "max_rss_mb": round(usage.ru_maxrss / 1024.0, 1), "returncode": proc.returncode}
+
+
+def benchmark(args):
+    """
+    generate every data set, run every command on it and collect the results with the stage profile of each run
+    """
+    results = {"host": {"platform": platform.platform(), "python": platform.python_version(), "cpus": os.cpu_count()},
+               "parameters": vars(args), "datasets": [], "runs": []}
+    for size in [float(x) for x in args.genome_sizes.split(",")]:
+        datadir = os.path.abspath(os.path.join(args.workdir, "genome_%d" % size))
+        shutil.rmtree(datadir, ignore_errors=True)
+        start = time.time()
+        stats = simulate(datadir, size, args.chromosomes, args.density, args.contexts, samples=args.samples,
+                         fileformat=args.format, seed=args.seed)
+        stats["generate_s"] = round(time.time() - start, 3)
+        stats["dataset"] = os.path.basename(datadir)
+        results["datasets"].append(stats)
+        print("%(dataset)s: %(sites)d sites, %(rows)d CGmap rows, generated in %(generate_s).1f s" % stats)
+
+        for command in args.commands.split(","):
+            for repeat in range(args.repeat):
+                cmd = [sys.executable, args.methylc, "-a", "WT", "-b", "MT", "-w", str(args.workers)] + args.args.split()
+                cmd += (["-force"] if args.cold else []) + [command, "samples_list.txt", "genes.gtf", datadir + "/"]
+                result = {"dataset": stats["dataset"], "genome_size": stats["genome_size"], "sites": stats["sites"],
+                          "command": command, "repeat": repeat}
+                result.update(run(cmd, datadir))
+                try:
+                    with open(os.path.join(datadir, "profile.json")) as f:
+                        result["stages"] = json.load(f)["stages"]
+                except (IOError, ValueError, KeyError):
+                    result["stages"] = []
+                results["runs"].append(result)
+                print("  %-16s %8.1f s wall %8.1f s cpu %8.0f MB%s" % (command, result["wall_s"], result["cpu_s"], result["max_rss_mb"],
+                      "" if result["returncode"] == 0 else "  exit %d" % result["returncode"]))
+                with open(args.output, "w") as f:
+                    json.dump(results, f, indent=1)
+        if not args.keep:
+            shutil.rmtree(datadir, ignore_errors=True)
+    return results
+
+
+def main():
+    parser = get_parser()
+    args = parser.parse_args()
+    os.makedirs(args.workdir, exist_ok=True)
+    benchmark(args)
+    print("results written to " + args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,155 @@
+# coding=UTF-8
+
+"""
+Binary CGmap container: the CGmap columns MethylC-analyzer uses, stored as arrays
+with an index for random access to one chromosome, or one context of a chromosome.
+
+layout (little endian):
+    b"CGMAPBIN"
+    chunks, one or more per chromosome. A chunk holds its rows ordered by context, then position;
+    its columns follow each other, each padded to 8 bytes:
+        pos      uint32
+        context  uint8    (code into the index's context names)
+        ratio    float32  (CGmap ratios have at most 6 decimals, they are read back rounded to 6)
+        depth    uint16   (larger depths are stored as 65535)
+    JSON index {"version", "rows", "contexts", "chunks": [{"chr", "rows", "columns": {name: byte offset},
+                                                         "slices": {context: [first row, end row]}}]}
+    index length (uint64), b"CGMAPBIN"
+"""
+
+import json
+import os
+import struct
+import numpy as np
+
+
+MAGIC = b"CGMAPBIN"
+columns = [("pos", np.uint32), ("context", np.uint8), ("ratio", np.float32), ("depth", np.uint16)]
+
+
+def is_binary(filename):
+    """
+    whether a file is a binary CGmap container rather than a (gzipped) text CGmap
+    """
+    with open(filename, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+class Writer:
+    """
+    container written from CGmap rows in file order. Rows of one chromosome are buffered until
+    the chromosome changes, so memory is bounded by the largest chromosome; a chromosome that
+    comes back later in the input gets another chunk.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.out = open(filename + ".tmp", "wb")
+        self.out.write(MAGIC)
+        self.offset = len(MAGIC)
+        self.contexts = ["CG", "CHG", "CHH"]
+        self.chunks = []
+        self.chromosome = None
+        self.buffer = []
+
+    def write(self, chrs, pos, contexts, ratio, depth):
+        chrs = np.asarray(chrs, dtype=object)
+        names, inverse = np.unique(np.asarray(contexts, dtype=object), return_inverse=True)
+        for name in names.tolist():
+            if name not in self.contexts:
+                self.contexts.append(name)
+        codes = np.array([self.contexts.index(x) for x in names.tolist()], dtype=np.uint8)
+        arrays = {"pos": np.asarray(pos, dtype=np.int64),
+                  "context": codes[inverse.reshape(-1)] if len(names) else np.zeros(0, dtype=np.uint8),
+                  "ratio": np.asarray(ratio, dtype=np.float64),
+                  "depth": np.asarray(depth, dtype=np.int64)}
+        starts = np.flatnonzero(np.r_[True, chrs[1:] != chrs[:-1]]) if len(chrs) else np.zeros(0, dtype=np.int64)
+        for start, end in zip(starts.tolist(), np.r_[starts[1:], len(chrs)].tolist()):
+            if chrs[start] != self.chromosome:
+                self.flush()
+                self.chromosome = chrs[start]
+            self.buffer.append({name: x[start:end] for name, x in arrays.items()})
+
+    def flush(self):
+        if not self.buffer:
+            return
+        rows = {name: np.concatenate([x[name] for x in self.buffer]) for name, dtype in columns}
+        self.buffer = []
+        order = np.argsort((rows["context"].astype(np.int64) << 32) | rows["pos"], kind="stable")
+        rows = {"pos": rows["pos"][order].astype(np.uint32),
+                "context": rows["context"][order],
+                "ratio": rows["ratio"][order].astype(np.float32),
+                "depth": np.minimum(rows["depth"][order], 65535).astype(np.uint16)}
+        bounds = np.searchsorted(rows["context"], np.arange(len(self.contexts) + 1))
+        chunk = {"chr": self.chromosome, "rows": len(order), "columns": {},
+                 "slices": {self.contexts[i]: [int(bounds[i]), int(bounds[i+1])] for i in range(len(self.contexts)) if bounds[i+1] > bounds[i]}}
+        for name, dtype in columns:
+            data = rows[name].tobytes()
+            chunk["columns"][name] = self.offset
+            self.out.write(data + b"\0" * (-len(data) % 8))
+            self.offset += len(data) + (-len(data) % 8)
+        self.chunks.append(chunk)
+
+    def close(self):
+        self.flush()
+        index = json.dumps({"version": 1, "rows": sum(x["rows"] for x in self.chunks),
+                            "contexts": self.contexts, "chunks": self.chunks}).encode()
+        self.out.write(index + struct.pack("<Q", len(index)) + MAGIC)
+        self.out.close()
+        os.replace(self.filename + ".tmp", self.filename)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.out.close()
+            os.remove(self.filename + ".tmp")
+
+
+def read_index(filename):
+    """
+    the JSON index of a container
+    """
+    with open(filename, "rb") as f:
+        f.seek(-8 - len(MAGIC), os.SEEK_END)
+        length, magic = struct.unpack("<Q", f.read(8))[0], f.read(len(MAGIC))
+        if magic != MAGIC:
+            raise ValueError(filename + " is not a complete binary CGmap")
+        f.seek(-8 - len(MAGIC) - length, os.SEEK_END)
+        return json.loads(f.read(length))
+
+
+def read_chunk(filename, chunk, first=0, end=None):
+    """
+    rows [first, end) of one chunk, memory-mapped
+    """
+    end = chunk["rows"] if end is None else end
+    return {name: np.memmap(filename, dtype=dtype, mode="r", offset=chunk["columns"][name] + first * np.dtype(dtype).itemsize, shape=(end - first,))
+            if end > first else np.zeros(0, dtype=dtype) for name, dtype in columns}
+
+
+def read_slice(filename, chromosome, context=None, index=None):
+    """
+    rows of one chromosome, or of one context of it, reading only those rows
+    """
+    index = read_index(filename) if index is None else index
+    parts = []
+    for chunk in index["chunks"]:
+        if chunk["chr"] != chromosome:
+            continue
+        if context is None:
+            parts.append(read_chunk(filename, chunk))
+        elif context in chunk["slices"]:
+            parts.append(read_chunk(filename, chunk, *chunk["slices"][context]))
+    if not parts:
+        return {name: np.zeros(0, dtype=dtype) for name, dtype in columns}
+    return {name: np.concatenate([x[name] for x in parts]) for name, dtype in columns}
+
+
+def ratios(ratio):
+    """
+    stored float32 ratios as the float64 values of their CGmap text
+    """
+    return np.round(np.asarray(ratio, dtype=np.float64), 6)
@@ -5,6 +5,14 @@ import pandas as pd
 import numpy as np
 import traceback
 import argparse
+import sys
+import gzip
+import os
+import glob
+import time
+import cgmap_binary
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
 
 def get_parser():
@@ -13,26 +21,129 @@ def get_parser():
     """
     parser = argparse.ArgumentParser()
     group1 = parser.add_argument_group('Input format')
-    group1.add_argument("-n", "--filename", type=str, help="the file name that the users want to convert to CGMap format")
-    group1.add_argument("-f", "--format", default="bismark",choices=["bismark", "bsmap", "methimpute"], type=str, help="the type of file to CGmap")
+    group1.add_argument("-n", "--filename", type=str, nargs="+", help="the file names that the users want to convert to CGMap format, directories or glob patterns of such files")
+    group1.add_argument("-f", "--format", default="bismark",choices=["bismark", "bsmap", "methimpute", "cgmap"], type=str, help="the type of file to CGmap")
+    group1.add_argument("-o", "--output", default="cgmap",choices=["cgmap", "binary"], type=str, help="write CGmap.gz, or the binary CGmap container (CGmap.bin) MethylC.py also reads")
+    group2 = parser.add_argument_group('Performance')
+    group2.add_argument("-c", "--chunksize", default=1000000, type=int, help="rows read and converted at a time, bounds the memory used")
+    group2.add_argument("-t", "--threads", default=2, type=int, help="gzip compression threads per file")
+    group2.add_argument("-l", "--level", default=6, type=int, help="gzip compression level")
+    group2.add_argument("-p", "--processes", default=None, type=int, help="files converted at the same time, default = CPUs available / (1 + threads), one parser and its compression threads per file")
+    group2.add_argument("--force", action="store_true", help="convert files whose CGmap.gz is newer than the input too")
     return parser
 
 
-def readfile(filename):
+def node_cpus():
     """
-    read files: allow the format with or without gz compressed
+    CPUs this process may run on
     """
-    if filename[-3:] == ".gz":
-        inputfile = pd.read_csv(filename, header = None, sep="\t", compression='gzip')
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def has_header(filename):
+    """
+    the file with or without header can be properly processed: a header has no integer in its second column
+    """
+    opener = gzip.open if filename[-3:] == ".gz" else open
+    with opener(filename, "rt") as f:
+        first = f.readline().split("\t")
+    try:
+        int(first[1])
+        return False
+    except (IndexError, ValueError):
+        return True
+
+
+def readfile(filename, dtype, chunksize, header=True):
+    """
+    read files in chunks of rows: allow the format with or without gz compressed, and with or without header
+    """
+    return pd.read_csv(filename, header = None, sep="\t", usecols=list(dtype), dtype=dtype,
+                       skiprows=1 if header and has_header(filename) else 0, chunksize=chunksize,
+                       compression='gzip' if filename[-3:] == ".gz" else None)
+
+
+class GzipWriter:
+    """
+    gzip file written block by block: blocks are compressed by a pool of threads as separate
+    gzip members (concatenated members are one valid gzip stream) and written in order.
+    The output appears under its name only once it is complete.
+    """
+    def __init__(self, filename, threads=2, level=6):
+        self.filename = filename
+        self.level = level
+        self.threads = max(threads, 1)
+        self.out = open(filename + ".tmp", "wb")
+        self.pool = ThreadPoolExecutor(self.threads)
+        self.pending = deque()
+
+    def write(self, data):
+        self.pending.append(self.pool.submit(gzip.compress, data, self.level))
+        while len(self.pending) > 2 * self.threads:
+            self.out.write(self.pending.popleft().result())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            while self.pending:
+                block = self.pending.popleft()
+                if exc_type is None:
+                    self.out.write(block.result())
+        finally:
+            self.pool.shutdown()
+            self.out.close()
+        if exc_type is None:
+            os.replace(self.filename + ".tmp", self.filename)
+        else:
+            os.remove(self.filename + ".tmp")
+
+
+def write_cgmap(chunks, outname, threads, level):
+    """
+    write CGmap rows chunk by chunk to a gzip compressed file
+    """
+    with GzipWriter(outname, threads, level) as writer:
+        for cgmap_format in chunks:
+            writer.write(cgmap_format.to_csv(header = False, index = False, sep="\t").encode())
+
+
+def write_binary(chunks, outname):
+    """
+    write CGmap rows chunk by chunk to a binary CGmap container
+    """
+    with cgmap_binary.Writer(outname) as writer:
+        for cgmap_format in chunks:
+            writer.write(cgmap_format.iloc[:,0].to_numpy(), cgmap_format.iloc[:,2].astype(np.int64).to_numpy(), cgmap_format.iloc[:,3].to_numpy(),
+                         cgmap_format.iloc[:,5].astype("float").to_numpy(), cgmap_format.iloc[:,7].astype("float").astype(np.int64).to_numpy())
+
+
+def write_output(chunks, outname, output, threads, level):
+    if output == "binary":
+        write_binary(chunks, outname)
     else:
-        inputfile = pd.read_csv(filename, header = None, sep="\t")
-    return inputfile
+        write_cgmap(chunks, outname, threads, level)
 
 
+def output_name(filename, fileformat, output="cgmap"):
+    """
+    the CGmap.gz (or CGmap.bin) written for an input file
+    """
+    extension = "CGmap.bin" if output == "binary" else "CGmap.gz"
+    if fileformat == "bsmap":
+        return filename[:-3] + extension
+    if fileformat == "cgmap":
+        return filename[:filename.rindex("CGmap")] + extension
+    return filename + "." + extension
+
 
 def trinuc(threeletter):
     """
-    function to acquire the methylation context (CG, CHG, CHH) 
+    function to acquire the methylation context (CG, CHG, CHH)
     """
     if threeletter[1] == "G":
         context = "CG"
@@ -44,87 +155,139 @@ def trinuc(threeletter):
     return context
 
 
-def bismark2cgmap(bismarkfile):
+def bismark2cgmap(bismarkfile, chunksize=1000000, threads=2, level=6, output="cgmap"):
 	"""
 	CX report file to CGmap.gz
 	"""
 	name_bismark = bismarkfile
-	bismark = readfile(name_bismark)
-	try:
-		int(bismark.iloc[0,1])
-		header = "No"
-	except:
-		header = "Yes"
-	if header == "Yes":
-		bismark = bismark.iloc[1:,:]
-	print(bismark.head())
-	bismark["nuc"] = np.where(bismark[2]=="+","C","G")
-	bismark["dinuc"] = [i[:2] for i in list(bismark[6])]
-	bismark["mc_nc"] = bismark[3] + bismark[4]
-	bismark["ratio"] = np.round(bismark[3].astype("float")/(bismark[3] + bismark[4]).astype("float"),2)
-	cgmap_format = bismark[[0,"nuc",1,5,"dinuc","ratio",3,"mc_nc"]]
-	cgmap_format_finish = cgmap_format.loc[(cgmap_format["mc_nc"]!=0)]
-	cgmap_format_finish.to_csv(name_bismark + ".CGmap.gz", header = False, index = False, sep="\t", compression='gzip')
-
-
-def bsmap2cgmap(bsmapfile):
+	dtype = {0:str, 1:str, 2:str, 3:np.int64, 4:np.int64, 5:str, 6:str}
+	def convert(bismark):
+		bismark = bismark.loc[(bismark[3] + bismark[4]) != 0]
+		bismark = bismark.assign(nuc=np.where(bismark[2]=="+","C","G"), dinuc=bismark[6].str[:2], mc_nc=bismark[3] + bismark[4])
+		bismark["ratio"] = np.round(bismark[3].astype("float")/bismark["mc_nc"].astype("float"),2)
+		return bismark[[0,"nuc",1,5,"dinuc","ratio",3,"mc_nc"]]
+	write_output(map(convert, readfile(name_bismark, dtype, chunksize)), output_name(name_bismark, "bismark", output), output, threads, level)
+
+
+def bsmap2cgmap(bsmapfile, chunksize=1000000, threads=2, level=6, output="cgmap"):
 	"""
 	the methylation calls generated by methratio.py in BSMAP (v2.73) to CGmap.gz
 	"""
-	name_bsmap = bsmapfile 
-	bsmap = readfile(name_bsmap)
-	# the file with or without header can be properly processed
-	try:
-		int(bsmap.iloc[0,1])
-		header = "No"
-	except:
-		header = "Yes"
-	if header == "Yes":
-		bsmap = bsmap.iloc[1:,:]
-	# to get the items in CGmap
-	bsmap["nuc"] = np.where(bsmap[2]=="+","C","G")
-	bsmap["dinuc"] = [i[:2] for i in list(bsmap[3])]
-	cgmap_format = bsmap[[0,"nuc",1,3,"dinuc",4,6,5]]
-	cgmap_format_finish = cgmap_format.loc[(cgmap_format[5]!=0)]
-	cgmap_format_finish.to_csv(name_bsmap[:-3] + "CGmap.gz", header = False, index = False, sep="\t", compression='gzip')
-
-
-
-def methimpute2cgmap(methimputefile):
+	name_bsmap = bsmapfile
+	dtype = {0:str, 1:str, 2:str, 3:str, 4:str, 5:str, 6:str}
+	# to get the items in CGmap, numbers are passed through as written
+	def convert(bsmap):
+		bsmap = bsmap.loc[(bsmap[5].astype("float")!=0)]
+		bsmap = bsmap.assign(nuc=np.where(bsmap[2]=="+","C","G"), dinuc=bsmap[3].str[:2])
+		return bsmap[[0,"nuc",1,3,"dinuc",4,6,5]]
+	write_output(map(convert, readfile(name_bsmap, dtype, chunksize)), output_name(name_bsmap, "bsmap", output), output, threads, level)
+
+
+
+def methimpute2cgmap(methimputefile, chunksize=1000000, threads=2, level=6, output="cgmap"):
 	"""
 	TSV files exported from the methimpute to CGmap.gz
 	"""
 	name_methimpute = methimputefile
-	methimpute = readfile(name_methimpute)
-	methimpute["nuc"] = np.where(methimpute[2]=="+","C","G")
-	methimpute["dinuc"] = [i[:2] for i in list(methimpute[3])]
-	methimpute["ratio"] = round(methimpute[4].astype("float")/methimpute[5].astype("float"), 2)
-	cgmap_format = methimpute[[0, "nuc", 1, 3, "dinuc", "ratio", 4, 5]]
-	cgmap_format_finish = cgmap_format.loc[(cgmap_format["mc_nc"]!=0)]
-	cgmap_format_finish.to_csv(name_bismark + ".CGmap.gz", header = False, index = False, sep="\t", compression='gzip')
+	dtype = {0:str, 1:str, 2:str, 3:str, 4:np.int64, 5:np.int64}
+	def convert(methimpute):
+		methimpute = methimpute.loc[(methimpute[5]!=0)]
+		methimpute = methimpute.assign(nuc=np.where(methimpute[2]=="+","C","G"), dinuc=methimpute[3].str[:2])
+		methimpute["ratio"] = round(methimpute[4].astype("float")/methimpute[5].astype("float"), 2)
+		return methimpute[[0, "nuc", 1, 3, "dinuc", "ratio", 4, 5]]
+	write_output(map(convert, readfile(name_methimpute, dtype, chunksize)), output_name(name_methimpute, "methimpute", output), output, threads, level)
+
+
+def cgmap2binary(cgmapfile, chunksize=1000000, threads=2, level=6, output="binary"):
+	"""
+	CGmap(.gz) to the binary CGmap container
+	"""
+	if output != "binary":
+		raise ValueError("a CGmap is only converted to the binary container, use -o binary")
+	dtype = {0:str, 2:np.int64, 3:str, 5:np.float64, 7:np.int64}
+	chunks = (cgmap.reindex(columns=range(8)) for cgmap in readfile(cgmapfile, dtype, chunksize, header=False))
+	write_binary(chunks, output_name(cgmapfile, "cgmap", output))
 
 
+converters = {"bismark":bismark2cgmap, "bsmap":bsmap2cgmap, "methimpute":methimpute2cgmap, "cgmap":cgmap2binary}
+
+
+def convert(filename, args):
+    """
+    convert one file, a failure is reported and does not stop the other files; returns whether it succeeded
+    """
+    outname = output_name(filename, args.format, args.output)
+    try:
+        if not args.force and os.path.exists(outname) and os.path.getmtime(outname) >= os.path.getmtime(filename):
+            print("skipping " + filename + ": " + outname + " is up to date")
+            return True
+        start = time.time()
+        converters[args.format](filename, args.chunksize, args.threads, args.level, args.output)
+        size = os.path.getsize(filename) / 1e6
+        elapsed = max(time.time() - start, 1e-6)
+        print("converted %s: %.1f MB in %.1f s, %.1f MB/s" % (filename, size, elapsed, size / elapsed))
+        return True
+    except Exception as e:
+        print(filename + ": " + str(e))
+        print(traceback.format_exc())
+        print("please check the input format or the parameter, see methcalls2cgmap.py -h")
+        return False
+
+
+# names of the reports of each format, for directories and glob patterns
+report_suffixes = {"bismark": ("report.txt", "report.txt.gz"),
+                   "bsmap": (".txt", ".txt.gz", ".tsv", ".tsv.gz"),
+                   "methimpute": (".txt", ".txt.gz", ".tsv", ".tsv.gz"),
+                   "cgmap": ("CGmap.gz", "CGmap")}
+
+
+def input_files(names, fileformat):
+    """
+    files named directly, and the reports of the format among every file of a directory or the matches of a glob pattern;
+    other files, converted outputs among them, are ignored
+    """
+    files = []
+    for name in names:
+        if os.path.isdir(name):
+            found = [os.path.join(name, x) for x in sorted(os.listdir(name))]
+        elif any(c in name for c in "*?["):
+            found = sorted(glob.glob(name))
+        else:
+            files.append(name)
+            continue
+        for x in found:
+            if not os.path.isfile(x):
+                continue
+            if x.endswith(report_suffixes[fileformat]):
+                files.append(x)
+            else:
+                print("ignored " + x + ": not a " + fileformat + " report (" + ", ".join("*" + y for y in report_suffixes[fileformat]) + ")")
+    # largest files first, so the batch takes about as long as the largest file
+    files = list(dict.fromkeys(files))
+    return sorted(files, key=lambda x: os.path.getsize(x) if os.path.exists(x) else 0, reverse=True)
 
 
 def main():
 	parser = get_parser()
 	args = parser.parse_args()
-	try:
-		if args.format == "bismark":
-			bismark2cgmap(args.filename)
-		if args.format == "bsmap":
-			bsmap2cgmap(args.filename)
-		if args.format =="methimpute":
-			methimpute2cgmap(args.filename)
-	except Exception as e:
-		print(e)
-		print(traceback.format_exc())
-		print("please check the input format or the parameter, see methcalls2cgmap.py -h")
+	files = input_files(args.filename, args.format)
+	# every file busies a parser and its compression threads
+	processes = args.processes if args.processes is not None else max(1, node_cpus() // (1 + max(args.threads, 1)))
+	if processes <= 1 or len(files) <= 1:
+		converted = [convert(x, args) for x in files]
+	else:
+		with ProcessPoolExecutor(max_workers=min(processes, len(files))) as pool:
+			converted = list(pool.map(convert, files, [args] * len(files)))
+	# the batch fails if any file failed, with the failed files listed after the interleaved output
+	failed = [x for x, ok in zip(files, converted) if not ok]
+	if failed:
+		print("failed to convert %d of %d file(s):" % (len(failed), len(files)))
+		for x in failed:
+			print("  " + x)
+		sys.exit(1)
 
 
 
 
 if __name__ == '__main__':
     main()
-
-
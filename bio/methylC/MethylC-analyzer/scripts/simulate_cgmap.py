@@ -0,0 +1,165 @@
+# coding=UTF-8
+
+# import packages
+import pandas as pd
+import numpy as np
+import argparse
+import os
+import cgmap_binary
+from contextlib import ExitStack
+from methcalls2cgmap import GzipWriter
+
+
+def get_parser():
+    """
+    Create a parser and add arguments
+    """
+    parser = argparse.ArgumentParser(description="synthetic CGmaps, gene annotation and samples list for MethylC.py")
+    parser.add_argument("-o", "--outdir", required=True, type=str, help="directory the files are written to")
+    group1 = parser.add_argument_group('Genome')
+    group1.add_argument("-g", "--genome-size", default=10000000, type=float, help="total length of the chromosomes in bp")
+    group1.add_argument("-c", "--chromosomes", default=5, type=int, help="number of chromosomes")
+    group1.add_argument("--density", default=0.2, type=float, help="fraction of positions reported as a cytosine site")
+    group1.add_argument("--contexts", default="0.1,0.15,0.75", type=str, help="fractions of CG,CHG,CHH sites")
+    group1.add_argument("--genes-per-mb", default=30, type=float, help="genes per Mb of genome")
+    group2 = parser.add_argument_group('Samples')
+    group2.add_argument("-n", "--samples", default=2, type=int, help="samples per group")
+    group2.add_argument("--groups", default="WT,MT", type=str, help="names of the two groups")
+    group2.add_argument("--depth", default=10, type=float, help="mean read depth of a site")
+    group2.add_argument("--dmr", default=0.1, type=float, help="fraction of genes methylated differently in the second group")
+    group2.add_argument("-f", "--format", default="cgmap", choices=["cgmap", "binary"], type=str, help="write CGmap.gz or the binary CGmap container")
+    group2.add_argument("-t", "--threads", default=2, type=int, help="gzip compression threads per file")
+    group2.add_argument("--seed", default=1, type=int, help="random seed, the same seed gives the same files")
+    return parser
+
+
+def chromosome_sizes(genome_size, chromosomes, rng):
+    """
+    chromosome lengths adding up to the genome size, within +-20% of each other
+    """
+    weights = rng.uniform(0.8, 1.2, chromosomes)
+    sizes = np.floor(weights / weights.sum() * genome_size).astype(np.int64)
+    sizes[0] += int(genome_size) - sizes.sum()
+    return sizes
+
+
+def simulate_genes(chrom, size, genes_per_mb, rng, first_id):
+    """
+    non-overlapping genes of one transcript with 1-5 exons; returns the GTF lines and the gene intervals (0-based, half open)
+    """
+    count = int(round(size / 1e6 * genes_per_mb))
+    starts = np.sort(rng.integers(2500, max(size - 8000, 2501), count))
+    lines, spans, last_end = [], [], 0
+    for start in starts.tolist():
+        if start < last_end + 500:
+            continue
+        length = int(rng.integers(1000, 6000))
+        end = min(start + length, size - 2500)
+        if end - start < 600:
+            continue
+        strand = "+" if rng.random() < 0.5 else "-"
+        gene_id = "G%d" % (first_id + len(spans) + 1)
+        # exons and introns alternate, the CDS leaves a UTR at both ends
+        nexons = int(rng.integers(1, 6))
+        cuts = np.sort(rng.choice(np.arange(start + 100, end - 100), 2 * nexons - 2, replace=False)) if nexons > 1 else np.zeros(0, dtype=np.int64)
+        bounds = np.r_[start, cuts, end].tolist()
+        exons = [(bounds[i], bounds[i+1]) for i in range(0, len(bounds) - 1, 2)]
+        cds_start, cds_end = start + min(100, (end - start) // 4), end - min(100, (end - start) // 4)
+        attributes = 'gene_id "%s"; transcript_id "%s.1";' % (gene_id, gene_id)
+        for a, b in exons:
+            lines.append("%s\tsimulated\texon\t%d\t%d\t.\t%s\t.\t%s\n" % (chrom, a + 1, b, strand, attributes))
+            if min(b, cds_end) > max(a, cds_start):
+                lines.append("%s\tsimulated\tCDS\t%d\t%d\t.\t%s\t0\t%s\n" % (chrom, max(a, cds_start) + 1, min(b, cds_end), strand, attributes))
+        spans.append((start, end))
+        last_end = end
+    return lines, np.array(spans, dtype=np.int64).reshape(-1, 2)
+
+
+def simulate_levels(contexts, rng):
+    """
+    methylation level of every site shared by the samples: CG bimodal, CHG intermediate, CHH low
+    """
+    level = np.empty(len(contexts))
+    cg, chg, chh = contexts == 0, contexts == 1, contexts == 2
+    high = rng.random(cg.sum()) < 0.7
+    level[cg] = np.where(high, rng.beta(8, 2, cg.sum()), rng.beta(1, 9, cg.sum()))
+    level[chg] = rng.beta(2, 5, chg.sum())
+    level[chh] = rng.beta(1, 12, chh.sum())
+    return level
+
+
+def simulate(outdir, genome_size=10000000, chromosomes=5, density=0.2, contexts="0.1,0.15,0.75", genes_per_mb=30,
+             samples=2, groups="WT,MT", depth=10, dmr=0.1, fileformat="cgmap", threads=2, seed=1, chunk=1 << 22):
+    """
+    write <sample>.CGmap.gz (or .CGmap.bin) for two groups of samples, genes.gtf and samples_list.txt.
+    All samples report the same cytosines; sites without reads in a sample are left out of its CGmap.
+    Returns the number of sites and rows written.
+    """
+    os.makedirs(outdir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    mix = np.array([float(x) for x in contexts.split(",")])
+    mix = mix / mix.sum()
+    group_names = groups.split(",")
+    names = [(g.lower() + str(i + 1), g) for g in group_names for i in range(samples)]
+    extension = "CGmap.bin" if fileformat == "binary" else "CGmap.gz"
+    with open(os.path.join(outdir, "samples_list.txt"), "w") as f:
+        for name, group in names:
+            f.write("%s\t%s.%s\t%s\n" % (name, name, extension, group))
+
+    sizes = chromosome_sizes(genome_size, chromosomes, rng)
+    stats = {"genome_size": int(sizes.sum()), "chromosomes": chromosomes, "samples": len(names), "genes": 0, "sites": 0, "rows": 0}
+    with ExitStack() as stack:
+        writers = []
+        for name, group in names:
+            path = os.path.join(outdir, name + "." + extension)
+            writers.append(stack.enter_context(cgmap_binary.Writer(path) if fileformat == "binary" else GzipWriter(path, threads)))
+        with open(os.path.join(outdir, "genes.gtf"), "w") as gtf:
+            for c, size in enumerate(sizes.tolist()):
+                chrom = "chr%d" % (c + 1)
+                lines, spans = simulate_genes(chrom, size, genes_per_mb, rng, stats["genes"])
+                gtf.writelines(lines)
+                stats["genes"] += len(spans)
+                changed = spans[rng.random(len(spans)) < dmr]
+                shift = np.where(rng.random(len(changed)) < 0.5, -0.4, 0.4)
+                for a in range(0, size, chunk):
+                    b = min(a + chunk, size)
+                    pos = a + np.flatnonzero(rng.random(b - a) < density) + 1
+                    cxt = rng.choice(3, len(pos), p=mix)
+                    level = simulate_levels(cxt, rng)
+                    nuc = np.where(rng.random(len(pos)) < 0.5, "C", "G")
+                    dinuc = np.where(cxt == 0, "CG", np.array(["CA", "CC", "CT"])[rng.integers(0, 3, len(pos))])
+                    # the second group differs inside the changed genes
+                    effect = np.zeros(len(pos))
+                    if len(changed):
+                        gene = np.searchsorted(changed[:, 0], pos - 1, "right") - 1
+                        inside = (gene >= 0) & (pos - 1 < changed[np.maximum(gene, 0), 1])
+                        effect[inside] = shift[gene[inside]]
+                    stats["sites"] += len(pos)
+                    for (name, group), writer in zip(names, writers):
+                        p = level + rng.normal(0, 0.03, len(pos))
+                        if group != group_names[0]:
+                            p = p + effect
+                        reads = rng.poisson(depth, len(pos))
+                        mc = rng.binomial(reads, np.clip(p, 0, 1))
+                        keep = reads > 0
+                        ratio = np.round(mc[keep] / reads[keep], 2)
+                        stats["rows"] += int(keep.sum())
+                        if fileformat == "binary":
+                            writer.write(np.full(keep.sum(), chrom, dtype=object), pos[keep], np.array(["CG", "CHG", "CHH"])[cxt[keep]], ratio, reads[keep])
+                        else:
+                            cgmap_format = pd.DataFrame({0: chrom, 1: nuc[keep], 2: pos[keep], 3: np.array(["CG", "CHG", "CHH"])[cxt[keep]],
+                                                         4: dinuc[keep], 5: ratio, 6: mc[keep], 7: reads[keep]})
+                            writer.write(cgmap_format.to_csv(header=False, index=False, sep="\t").encode())
+    return stats
+
+
+def main():
+    parser = get_parser()
+    args = parser.parse_args()
+    stats = simulate(args.outdir, args.genome_size, args.chromosomes, args.density, args.contexts, args.genes_per_mb,
+                     args.samples, args.groups, args.depth, args.dmr, args.format, args.threads, args.seed)
+    print("%(samples)d samples, %(chromosomes)d chromosomes, %(genome_size)d bp, %(genes)d genes, %(sites)d sites, %(rows)d CGmap rows" % stats)
+
+
+if __name__ == '__main__':
+    main()
@@ -142,7 +142,24 @@ if [ "$IS_DIRECTORY" = true ]; then
     echo "$REPORT_FILES"
     echo ""
 
-    # Convert each report file to CGmap format
+    # Copy the reports to the working directory (keeping their mtime, so reports
+    # whose CGmap.gz is already up to date are not converted again)
+    CONVERT_FILES=()
+    for REPORT_FILE in $REPORT_FILES; do
+        cp -p "$REPORT_FILE" "$WORK_DIR/$(basename "$REPORT_FILE")"
+        CONVERT_FILES+=("$WORK_DIR/$(basename "$REPORT_FILE")")
+    done
+
+    # Convert all reports to CGmap format at once, as many at a time as the CPUs keep busy with their gzip threads
+    echo "[INFO] Converting ${#CONVERT_FILES[@]} report(s) to CGmap format..."
+    if ! python3 "$PROD_APPS_DIR/bio/methylC/MethylC-analyzer/scripts/methcalls2cgmap.py" \
+        -n "${CONVERT_FILES[@]}" \
+        -f bismark; then
+        echo "[ERROR] Conversion of the reports to CGmap format failed, see the errors above"
+        exit 1
+    fi
+    echo ""
+
     SAMPLE_INDEX=0
     > "$WORK_DIR/samples_list.txt"  # Clear samples list
 
@@ -154,21 +171,12 @@ if [ "$IS_DIRECTORY" = true ]; then
         echo "[INFO] Processing sample $SAMPLE_INDEX: $SAMPLE_NAME"
         echo "       Source: $REPORT_FILE"
 
-        # Copy report to working directory
-        cp "$REPORT_FILE" "$WORK_DIR/$REPORT_BASENAME"
-
-        # Convert to CGmap format
-        echo "       Converting to CGmap format..."
-        python3 "$PROD_APPS_DIR/bio/methylC/MethylC-analyzer/scripts/methcalls2cgmap.py" \
-            -n "$WORK_DIR/$REPORT_BASENAME" \
-            -f bismark
-
         # The conversion creates a file with .CGmap.gz appended
         CONVERTED_FILE="$WORK_DIR/${REPORT_BASENAME}.CGmap.gz"
         FINAL_CGMAP="$WORK_DIR/${SAMPLE_NAME}.CGmap.gz"
 
         if [ -f "$CONVERTED_FILE" ]; then
-            mv "$CONVERTED_FILE" "$FINAL_CGMAP"
+            ln -f "$CONVERTED_FILE" "$FINAL_CGMAP"
             echo "       ✓ Converted: $FINAL_CGMAP"
         else
             echo "[ERROR] Conversion failed for $REPORT_BASENAME"
@@ -215,9 +223,12 @@ else
         cp "$INPUT_FOUND" "$WORK_DIR/$INPUT_BASENAME"
 
         # Run conversion script
-        python3 "$PROD_APPS_DIR/bio/methylC/MethylC-analyzer/scripts/methcalls2cgmap.py" \
+        if ! python3 "$PROD_APPS_DIR/bio/methylC/MethylC-analyzer/scripts/methcalls2cgmap.py" \
             -n "$WORK_DIR/$INPUT_BASENAME" \
-            -f bismark
+            -f bismark; then
+            echo "[ERROR] Conversion of $INPUT_BASENAME to CGmap format failed, see the errors above"
+            exit 1
+        fi
 
         # The conversion creates a file with .CGmap.gz appended
         CONVERTED_FILE="$WORK_DIR/${INPUT_BASENAME}.CGmap.gz"
@@ -1,32 +1,268 @@
-import hashlib
 import sys
 import os
 import argparse
+import json
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from file_hash_generator import ALGORITHMS, BUFFER_SIZE, CACHE_NAME, Progress, cached_hashes, open_cache, parse_algorithms
 
 
-def calculate_hash(file_path, algorithm='sha256'):
+# Algorithm of a manifest named after it, e.g. data.sha256, SHA256SUMS or data.md5sum
+EXTENSIONS = {
+    'md5': 'md5', 'sha1': 'sha1', 'sha256': 'sha256', 'sha512': 'sha512',
+    'blake2b': 'blake2b', 'b2': 'blake2b', 'xxh64': 'xxh64', 'xxh3': 'xxh3', 'xxh128': 'xxh128',
+}
+
+# Algorithm of a checksum of this many hex digits when nothing else tells
+LENGTHS = {16: 'xxh64', 32: 'md5', 40: 'sha1', 64: 'sha256', 128: 'sha512'}
+
+GNU_LINE = re.compile(r'^(\\?)([0-9a-fA-F]+) [ *](.*)$')
+BSD_LINE = re.compile(r'^(\\?)([A-Za-z0-9-]+) ?\((.*)\) ?= ([0-9a-fA-F]+)$')
+REPORT_LINE = re.compile(r'^([A-Za-z0-9]+):\s+([0-9a-fA-F]+)$')
+
+
+def calculate_hash(file_path, algorithm='sha256', cache=None):
     """Calculate hash for a file using specified algorithm."""
-    if algorithm == 'md5':
-        hash_obj = hashlib.md5()
-    elif algorithm == 'sha1':
-        hash_obj = hashlib.sha1()
-    elif algorithm == 'sha256':
-        hash_obj = hashlib.sha256()
-    else:
+    if algorithm not in ALGORITHMS:
         raise ValueError(f"Unsupported algorithm: {algorithm}")
+    return cached_hashes(file_path, [algorithm], cache=cache)[0][algorithm]
+
+
+def detect_algorithm(checksum):
+    """Guess the algorithm of a checksum from its length."""
+    return LENGTHS.get(len(checksum))
+
+
+def manifest_algorithm(manifest_path):
+    """Algorithm named by the manifest file name, or None."""
+    name = os.path.basename(manifest_path).lower()
+    for part in [name.rsplit('.', 1)[-1]] + re.findall(r'(md5|sha1|sha256|sha512|b2|blake2b|xxh64|xxh3|xxh128)(?:sums?)?', name):
+        part = re.sub(r'sums?$', '', part)
+        if part in EXTENSIONS:
+            return EXTENSIONS[part]
+    return None
+
+
+def unescape(path):
+    """Undo the escaping sha256sum uses for backslashes and newlines in file names."""
+    return re.sub(r'\\(.)', lambda m: {'n': '\n', 'r': '\r'}.get(m.group(1), m.group(1)), path)
+
+
+def read_manifest(manifest_path, algorithm=None):
+    """Entries (path, algorithm, checksum, size or None) of a sha256sum/md5sum manifest,
+    a BSD-style (--tag) manifest or a file_hash_generator {filename}_hashes.txt report."""
+    default = algorithm or manifest_algorithm(manifest_path)
+    names = {label.lower(): name for name, (label, factory) in ALGORITHMS.items()}
+    entries = []
+    report_file = None
+    report_size = None
+    with open(manifest_path, encoding='utf-8', errors='surrogateescape') as f:
+        for number, line in enumerate(f, 1):
+            line = line.rstrip('\n')
+            if line.endswith('\r'):
+                line = line[:-1]
+            if not line.strip() or line.startswith('#'):
+                continue
+
+            # {filename}_hashes.txt written by file_hash_generator for a single file
+            if line.startswith('File: '):
+                report_file = line[len('File: '):]
+                continue
+            if line.startswith('Size: ') and report_file is not None:
+                report_size = int(line[len('Size: '):].split()[0].replace(',', ''))
+                continue
+            match = REPORT_LINE.match(line)
+            if match and report_file is not None:
+                name = algorithm or names.get(match.group(1).lower())
+                if name is None:
+                    raise ValueError(f"{manifest_path}:{number}: unknown algorithm {match.group(1)}")
+                entries.append((report_file, name, match.group(2).lower(), report_size))
+                continue
+
+            match = GNU_LINE.match(line)
+            if match:
+                escaped, checksum, path = match.groups()
+                name = default or detect_algorithm(checksum)
+            else:
+                match = BSD_LINE.match(line)
+                if not match:
+                    raise ValueError(f"{manifest_path}:{number}: not a checksum line: {line[:80]}")
+                escaped, tag, path, checksum = match.groups()
+                name = algorithm or names.get(tag.lower())
+            if name is None:
+                raise ValueError(f"{manifest_path}:{number}: cannot tell the algorithm of a {len(checksum)} character checksum, use -a")
+            entries.append((unescape(path) if escaped else path, name, checksum.lower(), None))
+    return entries
+
+
+def read_sizes(sizes_path):
+    """File sizes from a {name}.sizes file written by file_hash_generator."""
+    sizes = {}
+    with open(sizes_path, encoding='utf-8', errors='surrogateescape') as f:
+        for line in f:
+            match = GNU_LINE.match(line.rstrip('\n'))
+            if match:
+                escaped, size, path = match.groups()
+                sizes[unescape(path) if escaped else path] = int(size)
+    return sizes
+
+
+def check_entry(entry, base_dir):
+    """Existence and size of a manifest entry; a failed entry gets its status, others None."""
+    path, algorithm, expected, size = entry
+    full_path = os.path.join(base_dir, path)
+    try:
+        actual_size = os.stat(full_path).st_size
+    except OSError as e:
+        return {'path': path, 'algorithm': algorithm, 'expected': expected, 'actual': None,
+                'size': None, 'status': 'MISSING', 'message': e.strerror}
+    if size is not None and actual_size != size:
+        return {'path': path, 'algorithm': algorithm, 'expected': expected, 'actual': None,
+                'size': actual_size, 'status': 'FAILED', 'message': f"size {actual_size:,} bytes, expected {size:,}"}
+    return None
 
-    chunk_size = 8192
-    with open(file_path, 'rb') as f:
-        while True:
-            chunk = f.read(chunk_size)
-            if not chunk:
-                break
-            hash_obj.update(chunk)
 
-    return hash_obj.hexdigest()
+def verify_entries(groups, base_dir, threads, buffer_size, interval, stop, fail_fast=False, cache=None):
+    """Hash every file once for all of its checksums, on a pool of threads."""
+    total = sum(size for path, size, checks in groups)
+    progress = Progress(len(groups), total, interval)
 
+    def work(group):
+        path, size, checks = group
+        results = []
+        if stop.is_set():
+            for algorithm, expected in checks:
+                results.append({'path': path, 'algorithm': algorithm, 'expected': expected, 'actual': None,
+                                'size': size, 'status': 'SKIPPED', 'message': 'stopped after an earlier failure'})
+            return results
+        cached = False
+        try:
+            hashes, cached = cached_hashes(os.path.join(base_dir, path), list(dict.fromkeys(x[0] for x in checks)), buffer_size, progress, cache)
+        except OSError as e:
+            hashes = None
+            message = e.strerror
+        for algorithm, expected in checks:
+            if hashes is None:
+                status = 'ERROR'
+            else:
+                status = 'PASSED' if hashes[algorithm] == expected else 'FAILED'
+                message = '' if status == 'PASSED' else 'checksum mismatch'
+            if status != 'PASSED' and fail_fast:
+                stop.set()
+            results.append({'path': path, 'algorithm': algorithm, 'expected': expected,
+                            'actual': hashes[algorithm] if hashes else None, 'size': size, 'status': status, 'message': message,
+                            'cached': cached})
+        progress.add(0, files=1)
+        return results
 
-def verify_checksum(file_path, expected_checksum, output_dir):
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        results = [x for group in pool.map(work, groups) for x in group]
+    progress.report()
+    return results
+
+
+def verify_manifest(manifest_path, base_dir, output_dir, algorithm=None, sizes_path=None,
+                    threads=8, buffer_size=BUFFER_SIZE, interval=5.0, fail_fast=False, cache=None):
+    """Verify every file listed in a checksum manifest and write a pass/fail report."""
+    manifest_name = os.path.basename(manifest_path)
+    entries = read_manifest(manifest_path, algorithm)
+    print(f"Verifying manifest: {manifest_name}")
+    print(f"Entries: {len(entries):,}")
+    print(f"Files are resolved relative to: {base_dir}")
+
+    # Sizes from the manifest's {name}.sizes file, when file_hash_generator wrote one
+    if sizes_path is None:
+        candidate = os.path.splitext(manifest_path)[0] + '.sizes'
+        sizes_path = candidate if os.path.isfile(candidate) and candidate != manifest_path else None
+    if sizes_path:
+        sizes = read_sizes(sizes_path)
+        entries = [(path, name, expected, size if size is not None else sizes.get(path)) for path, name, expected, size in entries]
+        print(f"Sizes checked against: {sizes_path}")
+
+    # Missing files and wrong sizes fail before anything is read
+    start = time.time()
+    results = []
+    groups = {}
+    for entry in entries:
+        failed = check_entry(entry, base_dir)
+        if failed is not None:
+            results.append(failed)
+            continue
+        path, name, expected, size = entry
+        if path not in groups:
+            groups[path] = (path, os.path.getsize(os.path.join(base_dir, path)), [])
+        groups[path][2].append((name, expected))
+    if results:
+        print(f"{len(results):,} file(s) missing or of the wrong size")
+
+    stop = threading.Event()
+    if fail_fast and results:
+        stop.set()
+    if groups:
+        print(f"Calculating checksums of {len(groups):,} file(s)...")
+        results += verify_entries(list(groups.values()), base_dir, threads, buffer_size, interval, stop, fail_fast, cache)
+    elapsed = time.time() - start
+
+    order = {path: i for i, (path, name, expected, size) in enumerate(entries)}
+    results.sort(key=lambda x: order.get(x['path'], 0))
+    counts = {}
+    for result in results:
+        counts[result['status']] = counts.get(result['status'], 0) + 1
+    passed = counts.get('PASSED', 0) == len(results) and len(results) > 0
+    verified_bytes = sum(groups[path][1] for path in {x['path'] for x in results if x['actual'] is not None})
+    cached_files = len({x['path'] for x in results if x.get('cached')})
+
+    # Structured report for tools, readable summary for people
+    report = {
+        'manifest': manifest_path,
+        'base_dir': base_dir,
+        'verification': 'PASSED' if passed else 'FAILED',
+        'entries': len(results),
+        'counts': counts,
+        'bytes': verified_bytes,
+        'cached_files': cached_files,
+        'seconds': round(elapsed, 3),
+        'results': results,
+    }
+    report_file = os.path.join(output_dir, f"{manifest_name}_verification.json")
+    with open(report_file + '.tmp', 'w', encoding='utf-8', errors='surrogateescape') as f:
+        json.dump(report, f, indent=1)
+    os.replace(report_file + '.tmp', report_file)
+
+    output_file = os.path.join(output_dir, f"{manifest_name}_verification.txt")
+    failures = [x for x in results if x['status'] != 'PASSED']
+    with open(output_file, 'w', encoding='utf-8', errors='surrogateescape') as f:
+        f.write(f"Manifest: {manifest_name}\n")
+        f.write(f"Entries: {len(results):,}\n")
+        for status in sorted(counts):
+            f.write(f"{status.capitalize()}: {counts[status]:,}\n")
+        f.write(f"\n")
+        f.write(f"Verification: {'PASSED' if passed else 'FAILED'}\n")
+        if failures:
+            f.write(f"\n")
+            for x in failures:
+                f.write(f"{x['status']}: {x['path']} ({x['algorithm']}) {x['message']}\n")
+
+    print(f"\n{'='*60}")
+    print(f"VERIFICATION {'PASSED' if passed else 'FAILED'}")
+    print(", ".join(f"{status.lower()}: {counts[status]:,}" for status in sorted(counts)))
+    for x in failures[:20]:
+        print(f"  {x['status']}: {x['path']} ({x['algorithm']}) {x['message']}")
+    if len(failures) > 20:
+        print(f"  ... and {len(failures) - 20:,} more, see the report")
+    print(f"{'='*60}")
+    print(f"\nVerified {verified_bytes / (1024**2):,.1f} MB in {elapsed:.1f} s")
+    if cache is not None:
+        print(f"Unchanged files taken from the hash cache: {cached_files:,} ({cache.path})")
+    print(f"Results saved to: {output_file}")
+    print(f"Report saved to: {report_file}")
+
+    return passed
+
+
+def verify_checksum(file_path, expected_checksum, output_dir, cache=None):
     """Verify file integrity by comparing checksums."""
     file_name = os.path.basename(file_path)
     file_size = os.path.getsize(file_path)
@@ -55,7 +291,7 @@ def verify_checksum(file_path, expected_checksum, output_dir):
 
     # Calculate actual checksum
     print(f"Calculating {algo_name} hash...")
-    actual_checksum = calculate_hash(file_path, algorithm)
+    actual_checksum = calculate_hash(file_path, algorithm, cache)
     print(f"Actual checksum:   {actual_checksum}")
 
     # Compare checksums
@@ -94,11 +330,30 @@ def verify_checksum(file_path, expected_checksum, output_dir):
 
 
 def main():
-    parser = argparse.ArgumentParser(description='Verify file integrity using checksums')
-    parser.add_argument('input_file', help='Path to the input file')
-    parser.add_argument('checksum', help='Expected checksum (MD5, SHA1, or SHA256)')
+    parser = argparse.ArgumentParser(description='Verify file integrity using checksums, for one file or every file of a checksum manifest')
+    parser.add_argument('input_file', help='Path to the input file, or to a manifest (sha256sum/md5sum output, a file_hash_generator manifest or {filename}_hashes.txt) when no checksum is given')
+    parser.add_argument('checksum', nargs='?', default=None,
+                        help='Expected checksum (MD5, SHA1, or SHA256); leave out to verify a manifest')
     parser.add_argument('-o', '--output-dir', default='./',
                         help='Output directory for verification results (default: ./)')
+    parser.add_argument('-d', '--base-dir', default=None,
+                        help='Directory the manifest paths are relative to (default: directory of the manifest)')
+    parser.add_argument('-a', '--algorithm', default=None,
+                        help=f"Algorithm of the manifest checksums (default: from the manifest name or checksum length; available: {', '.join(ALGORITHMS)})")
+    parser.add_argument('--sizes', default=None,
+                        help='File sizes written by file_hash_generator (default: {manifest name}.sizes next to the manifest, if any)')
+    parser.add_argument('-j', '--threads', type=int, default=8,
+                        help='Files verified at the same time (default: 8)')
+    parser.add_argument('-b', '--buffer-size', type=int, default=BUFFER_SIZE // (1024 * 1024),
+                        help=f"Read buffer per file in megabytes (default: {BUFFER_SIZE // (1024 * 1024)})")
+    parser.add_argument('--fail-fast', action='store_true',
+                        help='Stop at the first missing, wrong-sized or mismatched file')
+    parser.add_argument('--progress-interval', type=float, default=5.0,
+                        help='Seconds between progress lines (default: 5)')
+    parser.add_argument('--cache', default=None,
+                        help=f"Hash cache of files that did not change since an earlier run (default: {CACHE_NAME} in the output directory)")
+    parser.add_argument('--no-cache', action='store_true',
+                        help='Read and hash every file again, without using or updating the cache')
 
     args = parser.parse_args()
 
@@ -121,8 +376,26 @@ def main():
     # Create output directory if it doesn't exist
     os.makedirs(args.output_dir, exist_ok=True)
 
-    # Verify checksum
-    match = verify_checksum(input_path, args.checksum, args.output_dir)
+    if args.threads <= 0 or args.buffer_size <= 0:
+        print(f"Error: Threads and buffer size must be positive")
+        sys.exit(1)
+
+    cache = None if args.no_cache else open_cache(args.cache or os.path.join(args.output_dir, CACHE_NAME))
+    try:
+        if args.checksum:
+            # Verify checksum
+            match = verify_checksum(input_path, args.checksum, args.output_dir, cache)
+        else:
+            base_dir = os.path.expanduser(args.base_dir) if args.base_dir else (os.path.dirname(input_path) or '.')
+            algorithm = parse_algorithms(args.algorithm)[0] if args.algorithm else None
+            match = verify_manifest(input_path, base_dir, args.output_dir, algorithm, args.sizes, args.threads,
+                                    args.buffer_size * 1024 * 1024, args.progress_interval, args.fail_fast, cache)
+    except (ValueError, OSError) as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+    finally:
+        if cache is not None:
+            cache.close()
 
     print("\nChecksum verification completed!")
 
@@ -131,4 +404,4 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
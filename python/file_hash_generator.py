@@ -2,49 +2,284 @@ import hashlib
 import sys
 import os
 import argparse
+import glob
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
 
-def calculate_hashes(file_path):
-    """Calculate MD5, SHA1, and SHA256 hashes for a file."""
-    md5_hash = hashlib.md5()
-    sha1_hash = hashlib.sha1()
-    sha256_hash = hashlib.sha256()
 
-    # Read file in chunks to handle large files
-    chunk_size = 8192
-    file_size = os.path.getsize(file_path)
-    bytes_read = 0
+# Digests that can be requested with -a, in the order they are reported
+ALGORITHMS = {
+    'md5': ('MD5', hashlib.md5),
+    'sha1': ('SHA1', hashlib.sha1),
+    'sha256': ('SHA256', hashlib.sha256),
+    'sha512': ('SHA512', hashlib.sha512),
+    'blake2b': ('BLAKE2b', hashlib.blake2b),
+    'xxh64': ('XXH64', lambda: xxhash.xxh64()),
+    'xxh3': ('XXH3', lambda: xxhash.xxh3_64()),
+    'xxh128': ('XXH128', lambda: xxhash.xxh3_128()),
+}
 
-    with open(file_path, 'rb') as f:
+BUFFER_SIZE = 4 * 1024 * 1024
+CACHE_NAME = '.hash_cache.sqlite'
+
+
+def parse_algorithms(names):
+    """Check a comma separated list of digest names."""
+    algorithms = [x.strip().lower() for x in names.split(',') if x.strip()]
+    for name in algorithms:
+        if name not in ALGORITHMS:
+            raise ValueError(f"Unsupported algorithm: {name} (choose from {', '.join(ALGORITHMS)})")
+        if name.startswith('xxh') and xxhash is None:
+            raise ValueError(f"{name} needs the xxhash package (pip install xxhash)")
+    if not algorithms:
+        raise ValueError("No hash algorithm selected")
+    return list(dict.fromkeys(algorithms))
+
+
+def calculate_hashes(file_path, algorithms=('md5', 'sha1', 'sha256'), buffer_size=BUFFER_SIZE, progress=None):
+    """Calculate all requested hashes for a file from a single read."""
+    digests = {name: ALGORITHMS[name][1]() for name in algorithms}
+    buffer = bytearray(buffer_size)
+    view = memoryview(buffer)
+
+    # Unbuffered reads straight into one large buffer; hashlib releases the GIL
+    # while it hashes it, so other files are read and hashed at the same time
+    with open(file_path, 'rb', buffering=0) as f:
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
         while True:
-            chunk = f.read(chunk_size)
-            if not chunk:
+            n = f.readinto(buffer)
+            if not n:
                 break
-            md5_hash.update(chunk)
-            sha1_hash.update(chunk)
-            sha256_hash.update(chunk)
-            bytes_read += len(chunk)
+            chunk = view[:n]
+            for digest in digests.values():
+                digest.update(chunk)
+            if progress is not None:
+                progress.add(n)
+
+    return {name: digest.hexdigest() for name, digest in digests.items()}
+
+
+class HashCache:
+    """Digests of files that have not changed since they were hashed, kept in a SQLite file.
+    A file counts as unchanged while its path, size, mtime_ns and inode are the same."""
+
+    def __init__(self, cache_path):
+        self.path = cache_path
+        self.lock = threading.Lock()
+        self.pending = 0
+        # The default rollback journal, not WAL: the cache may sit on a network file system
+        self.db = sqlite3.connect(cache_path, timeout=60, check_same_thread=False)
+        self.db.execute('CREATE TABLE IF NOT EXISTS hashes (path BLOB NOT NULL, algorithm TEXT NOT NULL, '
+                        'size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, inode INTEGER NOT NULL, '
+                        'digest TEXT NOT NULL, PRIMARY KEY (path, algorithm))')
+        self.db.commit()
+
+    def get(self, path, stat, algorithms):
+        with self.lock:
+            rows = self.db.execute('SELECT algorithm, digest FROM hashes WHERE path = ? AND size = ? AND mtime_ns = ? AND inode = ?',
+                                   (os.fsencode(path), stat.st_size, stat.st_mtime_ns, stat.st_ino)).fetchall()
+        return {algorithm: digest for algorithm, digest in rows if algorithm in algorithms}
+
+    def put(self, path, stat, hashes):
+        with self.lock:
+            self.db.executemany('INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?)',
+                                [(os.fsencode(path), algorithm, stat.st_size, stat.st_mtime_ns, stat.st_ino, digest)
+                                 for algorithm, digest in hashes.items()])
+            self.pending += 1
+            if self.pending >= 1000:
+                self.db.commit()
+                self.pending = 0
+
+    def close(self):
+        with self.lock:
+            self.db.commit()
+            self.db.close()
+
+
+def open_cache(cache_path):
+    """Open the hash cache, or go on without one if it cannot be used."""
+    try:
+        return HashCache(cache_path)
+    except sqlite3.Error as e:
+        print(f"Warning: Hash cache {cache_path} not used: {e}")
+        return None
+
+
+def cached_hashes(file_path, algorithms, buffer_size=BUFFER_SIZE, progress=None, cache=None):
+    """Hashes of a file, taken from the cache while the file is unchanged; also tells whether they all came from it."""
+    if cache is None:
+        return calculate_hashes(file_path, algorithms, buffer_size, progress), False
+    key = os.path.realpath(file_path)
+    before = os.stat(file_path)
+    hashes = cache.get(key, before, algorithms)
+    missing = [x for x in algorithms if x not in hashes]
+    if not missing:
+        if progress is not None:
+            progress.add(before.st_size)
+        return hashes, True
+
+    hashes.update(calculate_hashes(file_path, missing, buffer_size, progress))
+    after = os.stat(file_path)
+    # Not cached if the file changed while it was read, or so recently that
+    # another change within the same timestamp tick would go unnoticed
+    unchanged = (before.st_size, before.st_mtime_ns, before.st_ino) == (after.st_size, after.st_mtime_ns, after.st_ino)
+    if unchanged and time.time_ns() - after.st_mtime_ns > 2 * 10**9:
+        cache.put(key, after, {x: hashes[x] for x in missing})
+    return {x: hashes[x] for x in algorithms}, False
+
+
+class Progress:
+    """Bytes and files hashed so far, printed at most once per interval."""
+
+    def __init__(self, total_files, total_bytes, interval=5.0):
+        self.total_files = total_files
+        self.total_bytes = total_bytes
+        self.interval = interval
+        self.files = 0
+        self.bytes = 0
+        self.start = time.time()
+        self.last = self.start
+        self.lock = threading.Lock()
+
+    def add(self, n, files=0):
+        with self.lock:
+            self.bytes += n
+            self.files += files
+            now = time.time()
+            if now - self.last < self.interval:
+                return
+            self.last = now
+        self.report()
+
+    def report(self):
+        elapsed = max(time.time() - self.start, 1e-6)
+        percent = self.bytes / self.total_bytes * 100 if self.total_bytes else 100.0
+        print(f"Progress: {self.files:,}/{self.total_files:,} files, "
+              f"{self.bytes / (1024**2):,.1f}/{self.total_bytes / (1024**2):,.1f} MB ({percent:.1f}%), "
+              f"{self.bytes / (1024**2) / elapsed:,.1f} MB/s", flush=True)
+
+
+def find_files(input_path):
+    """Files of a file, directory or glob pattern, and the directory manifest paths are relative to."""
+    if os.path.isfile(input_path):
+        return os.path.dirname(input_path) or '.', [input_path]
+    if os.path.isdir(input_path):
+        base = input_path
+        files = []
+        for root, dirs, names in os.walk(input_path):
+            dirs.sort()
+            files += [os.path.join(root, name) for name in sorted(names)]
+    elif glob.has_magic(input_path):
+        # Paths are written relative to the directory before the first wildcard
+        parts = input_path.split(os.sep)
+        fixed = []
+        for part in parts:
+            if glob.has_magic(part):
+                break
+            fixed.append(part)
+        base = os.sep.join(fixed) or ('/' if input_path.startswith(os.sep) else '.')
+        files = sorted(glob.glob(input_path, recursive=True))
+    else:
+        return None, []
+
+    return base, [x for x in files if os.path.isfile(x)]
+
 
-            # Print progress for large files
-            if file_size > 1024 * 1024:  # > 1 MB
-                progress = (bytes_read / file_size) * 100
-                print(f"Progress: {progress:.1f}%", end='\r')
+def manifest_line(digest, path):
+    """One line in the format of sha256sum, with its escaping of backslashes and newlines."""
+    if '\\' in path or '\n' in path or '\r' in path:
+        path = path.replace('\\', '\\\\').replace('\n', '\\n').replace('\r', '\\r')
+        return f"\\{digest}  {path}\n"
+    return f"{digest}  {path}\n"
 
-    if file_size > 1024 * 1024:
-        print()  # New line after progress
 
-    return {
-        'md5': md5_hash.hexdigest(),
-        'sha1': sha1_hash.hexdigest(),
-        'sha256': sha256_hash.hexdigest()
-    }
+def write_manifests(results, base, algorithms, output_dir, name):
+    """Write one sha256sum-style manifest per algorithm, e.g. {name}.sha256, and the file sizes to {name}.sizes."""
+    outputs = []
+    for algorithm in algorithms + ['sizes']:
+        output_file = os.path.join(output_dir, f"{name}.{algorithm}")
+        with open(output_file + '.tmp', 'w', encoding='utf-8', errors='surrogateescape') as f:
+            for path, size, hashes in results:
+                if hashes is not None:
+                    f.write(manifest_line(str(size) if algorithm == 'sizes' else hashes[algorithm], os.path.relpath(path, base)))
+        os.replace(output_file + '.tmp', output_file)
+        outputs.append(output_file)
+    return outputs
+
+
+def size_of(path):
+    """Size of a file, 0 if it cannot be read; only used for progress totals."""
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+def hash_files(files, algorithms, threads, buffer_size, interval, cache=None):
+    """Hash files on a pool of threads; returns (path, size, hashes or None) in input order, the errors
+    and the number of files found in the cache."""
+    progress = Progress(len(files), sum(size_of(x) for x in files), interval)
+    errors = []
+    hits = []
+
+    def work(path):
+        # A file removed or made unreadable since it was listed fails on its own
+        size = 0
+        try:
+            size = os.path.getsize(path)
+            hashes, cached = cached_hashes(path, algorithms, buffer_size, progress, cache)
+            if cached:
+                hits.append(path)
+        except OSError as e:
+            errors.append(f"{path}: {e}")
+            hashes = None
+        progress.add(0, files=1)
+        return path, size, hashes
+
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        results = list(pool.map(work, files))
+    progress.report()
+    return results, errors, len(hits)
+
+
+def write_report(output_file, file_name, file_size, algorithms, hashes):
+    """Write the hash report of a single file."""
+    width = max(len(ALGORITHMS[x][0]) for x in algorithms) + 2
+    with open(output_file, 'w') as f:
+        f.write(f"File: {file_name}\n")
+        f.write(f"Size: {file_size:,} bytes\n")
+        f.write(f"\n")
+        for algorithm in algorithms:
+            f.write(f"{(ALGORITHMS[algorithm][0] + ':').ljust(width)}{hashes[algorithm]}\n")
 
 
 def main():
-    parser = argparse.ArgumentParser(description='Generate MD5, SHA1, and SHA256 hashes for files')
-    parser.add_argument('input_file', help='Path to the input file')
+    parser = argparse.ArgumentParser(description='Generate MD5, SHA1, SHA256 and other hashes for a file, a directory or a glob pattern')
+    parser.add_argument('input_file', help='Path to the input file, a directory (hashed recursively) or a glob pattern such as "data/**/*.fastq.gz"')
     parser.add_argument('-o', '--output-dir', default='./',
                         help='Output directory for hash results (default: ./)')
+    parser.add_argument('-a', '--algorithms', default='md5,sha1,sha256',
+                        help=f"Comma separated hash algorithms (default: md5,sha1,sha256; available: {', '.join(ALGORITHMS)})")
+    parser.add_argument('-n', '--name', default=None,
+                        help='Base name of the manifest files (default: name of the input)')
+    parser.add_argument('-j', '--threads', type=int, default=min(32, (os.cpu_count() or 1) + 4),
+                        help='Files hashed at the same time (default: CPUs + 4, at most 32)')
+    parser.add_argument('-b', '--buffer-size', type=int, default=BUFFER_SIZE // (1024 * 1024),
+                        help=f"Read buffer per file in megabytes (default: {BUFFER_SIZE // (1024 * 1024)})")
+    parser.add_argument('--progress-interval', type=float, default=5.0,
+                        help='Seconds between progress lines (default: 5)')
+    parser.add_argument('--cache', default=None,
+                        help=f"Hash cache of files that did not change since an earlier run (default: {CACHE_NAME} in the output directory)")
+    parser.add_argument('--no-cache', action='store_true',
+                        help='Read and hash every file again, without using or updating the cache')
 
     args = parser.parse_args()
 
@@ -56,45 +291,81 @@ def main():
     input_path = os.path.expanduser(args.input_file)
     print(f"Expanded input_path: {input_path}")
 
-    if not os.path.exists(input_path):
-        print(f"Error: File not found at: {input_path}")
+    try:
+        algorithms = parse_algorithms(args.algorithms)
+    except ValueError as e:
+        print(f"Error: {e}")
         sys.exit(1)
 
-    if not os.path.isfile(input_path):
-        print(f"Error: Path is not a file: {input_path}")
+    if args.threads <= 0 or args.buffer_size <= 0:
+        print(f"Error: Threads and buffer size must be positive")
         sys.exit(1)
 
     # Create output directory if it doesn't exist
     os.makedirs(args.output_dir, exist_ok=True)
 
-    # Get file info
-    file_name = os.path.basename(input_path)
-    file_size = os.path.getsize(input_path)
-    print(f"\nCalculating hashes for: {file_name}")
-    print(f"File size: {file_size:,} bytes")
+    base, files = find_files(input_path)
+    if base is None:
+        print(f"Error: File not found at: {input_path}")
+        sys.exit(1)
 
-    # Calculate hashes
-    print("Calculating hashes...")
-    hashes = calculate_hashes(input_path)
+    # Manifests are named after the input file or directory; earlier manifests are not hashed
+    if os.path.isfile(input_path):
+        name = args.name or os.path.basename(input_path)
+    else:
+        name = args.name or os.path.basename(os.path.abspath(base))
+    cache_path = args.cache or os.path.join(args.output_dir, CACHE_NAME)
+    outputs = {os.path.realpath(os.path.join(args.output_dir, f"{name}.{x}")) for x in algorithms + ['sizes']}
+    outputs |= {os.path.realpath(cache_path + x) for x in ('', '-journal')}
+    files = [x for x in files if os.path.realpath(x) not in outputs]
+    if not files:
+        print(f"Error: No files found at: {input_path}")
+        sys.exit(1)
 
-    # Write results to output file
-    output_file = os.path.join(args.output_dir, f"{file_name}_hashes.txt")
-    with open(output_file, 'w') as f:
-        f.write(f"File: {file_name}\n")
-        f.write(f"Size: {file_size:,} bytes\n")
-        f.write(f"\n")
-        f.write(f"MD5:    {hashes['md5']}\n")
-        f.write(f"SHA1:   {hashes['sha1']}\n")
-        f.write(f"SHA256: {hashes['sha256']}\n")
-
-    # Print results to console
-    print(f"\nHash Results:")
-    print(f"MD5:    {hashes['md5']}")
-    print(f"SHA1:   {hashes['sha1']}")
-    print(f"SHA256: {hashes['sha256']}")
-    print(f"\nResults saved to: {output_file}")
+    total_size = sum(size_of(x) for x in files)
+    print(f"\nCalculating {', '.join(ALGORITHMS[x][0] for x in algorithms)} hashes for {len(files):,} file(s)")
+    print(f"Total size: {total_size:,} bytes")
+
+    cache = None if args.no_cache else open_cache(cache_path)
+    start = time.time()
+    try:
+        results, errors, hits = hash_files(files, algorithms, args.threads, args.buffer_size * 1024 * 1024, args.progress_interval, cache)
+    finally:
+        if cache is not None:
+            cache.close()
+    elapsed = max(time.time() - start, 1e-6)
+    total_size = sum(size for path, size, hashes in results if hashes is not None)
+    outputs = write_manifests(results, base, algorithms, args.output_dir, name)
+
+    # A single file also gets the readable report
+    if os.path.isfile(input_path) and results[0][2] is not None:
+        file_name = os.path.basename(input_path)
+        path, file_size, hashes = results[0]
+        output_file = os.path.join(args.output_dir, f"{file_name}_hashes.txt")
+        write_report(output_file, file_name, file_size, algorithms, hashes)
+        outputs.insert(0, output_file)
+
+        print(f"\nHash Results:")
+        width = max(len(ALGORITHMS[x][0]) for x in algorithms) + 2
+        for algorithm in algorithms:
+            print(f"{(ALGORITHMS[algorithm][0] + ':').ljust(width)}{hashes[algorithm]}")
+
+    print(f"\nHashed {len(files) - len(errors):,} file(s), {total_size / (1024**2):,.1f} MB in {elapsed:.1f} s "
+          f"({total_size / (1024**2) / elapsed:,.1f} MB/s)")
+    if cache is not None:
+        print(f"Unchanged files taken from the hash cache: {hits:,} ({cache_path})")
+    print(f"Manifest paths are relative to: {base}")
+    print(f"Results saved to:")
+    for output_file in outputs:
+        print(f"  {output_file}")
+
+    if errors:
+        print(f"\nError: {len(errors)} file(s) could not be read:")
+        for error in errors:
+            print(f"  {error}")
+        sys.exit(1)
     print("Hash generation completed!")
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
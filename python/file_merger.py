@@ -1,16 +1,22 @@
 import sys
 import os
 import argparse
+import errno
+import json
 import re
+from concurrent.futures import ThreadPoolExecutor
+from file_hash_generator import ALGORITHMS, BUFFER_SIZE
+from file_splitter import copy_range
 
 
-def merge_chunks(chunk_pattern, output_file):
-    """Merge file chunks back together."""
-    print(f"Current working directory: {os.getcwd()}")
-    print(f"Chunk pattern: {chunk_pattern}")
-    print(f"Output file: {output_file}")
+def chunk_order(name):
+    """Sort key of a chunk: its numeric suffix, so part1000 comes after part999."""
+    match = re.search(r'(\d+)$', name)
+    return (0, int(match.group(1)), name) if match else (1, 0, name)
+
 
-    # Find all chunk files matching the pattern
+def find_chunks(chunk_pattern):
+    """Chunk files matching the pattern, in the order of their numeric suffix."""
     directory = os.path.dirname(chunk_pattern) or './'
     base_pattern = os.path.basename(chunk_pattern)
 
@@ -21,45 +27,155 @@ def merge_chunks(chunk_pattern, output_file):
     print(f"\nSearching for chunks in: {directory}")
     print(f"Pattern: {base_pattern}")
 
+    # Split manifests and unfinished files are not chunks
+    chunk_files = [f for f in os.listdir(directory) if re.match(regex_pattern, f)
+                   and not re.search(r'\.split\.[A-Za-z0-9]+$|\.tmp$', f)]
+    return directory, sorted(chunk_files, key=chunk_order)
+
+
+def split_manifest(chunk_pattern):
+    """The manifest file_splitter wrote next to the chunks of a {file}.part* pattern, if there is one."""
+    if chunk_pattern.endswith('.split.json'):
+        return chunk_pattern
+    match = re.match(r'^(.*)\.part\*?$', os.path.basename(chunk_pattern))
+    if match:
+        candidate = os.path.join(os.path.dirname(chunk_pattern), f"{match.group(1)}.split.json")
+        if os.path.isfile(candidate):
+            return candidate
+    return None
+
+
+def preallocate(fd, size):
+    """Reserve the space of the whole output up front, where the file system supports it."""
+    if size and hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(fd, 0, size)
+            return
+        except OSError as e:
+            if e.errno not in (errno.EOPNOTSUPP, errno.EINVAL, errno.ENOSYS):
+                raise
+    os.ftruncate(fd, size)
+
+
+def copy_chunk(chunk_path, output_tmp, offset, size):
+    """Copy one chunk to its offset of the output; every thread writes through its own descriptor."""
+    src_fd = os.open(chunk_path, os.O_RDONLY)
     try:
-        # Find all matching chunk files
-        all_files = os.listdir(directory)
-        chunk_files = [f for f in all_files if re.match(regex_pattern, f)]
+        dst_fd = os.open(output_tmp, os.O_WRONLY)
+        try:
+            copy_range(src_fd, dst_fd, 0, size, offset)
+        finally:
+            os.close(dst_fd)
+    finally:
+        os.close(src_fd)
 
-        if not chunk_files:
-            print(f"Error: No chunk files found matching pattern: {base_pattern}")
-            sys.exit(1)
 
-        # Sort chunk files to ensure correct order
-        chunk_files.sort()
+def merge_chunks(chunk_pattern, output_file, manifest_file=None, threads=4, algorithm=None, verify=True):
+    """Merge file chunks back together."""
+    print(f"Current working directory: {os.getcwd()}")
+    print(f"Chunk pattern: {chunk_pattern}")
+    print(f"Output file: {output_file}")
+
+    output_tmp = output_file + '.tmp'
+    try:
+        # The split manifest gives the chunk order, sizes and hashes; otherwise the chunk names give the order
+        manifest_file = manifest_file or split_manifest(chunk_pattern)
+        expected_hash = None
+        if manifest_file:
+            print(f"\nUsing split manifest: {manifest_file}")
+            with open(manifest_file) as f:
+                manifest = json.load(f)
+            directory = os.path.dirname(manifest_file) or './'
+            chunk_files = [part['name'] for part in manifest['parts']]
+            expected_sizes = [part['size'] for part in manifest['parts']]
+            expected_parts = [part.get('hash') for part in manifest['parts']]
+            if verify and manifest.get('algorithm'):
+                algorithm = manifest['algorithm']
+                expected_hash = manifest.get('hash')
+            missing = [f for f in chunk_files if not os.path.isfile(os.path.join(directory, f))]
+            if missing:
+                print(f"Error: {len(missing)} chunk(s) listed in the manifest are missing: {', '.join(missing[:10])}")
+                sys.exit(1)
+        else:
+            directory, chunk_files = find_chunks(chunk_pattern)
+            expected_sizes = [None] * len(chunk_files)
+            expected_parts = [None] * len(chunk_files)
+            if not chunk_files:
+                print(f"Error: No chunk files found matching pattern: {os.path.basename(chunk_pattern)}")
+                sys.exit(1)
 
         print(f"\nFound {len(chunk_files)} chunk(s):")
-        for chunk in chunk_files:
+        layout = []
+        total_bytes = 0
+        for chunk, expected_size in zip(chunk_files, expected_sizes):
             chunk_path = os.path.join(directory, chunk)
             chunk_size = os.path.getsize(chunk_path)
             print(f"  - {chunk} ({chunk_size:,} bytes)")
+            # A truncated or oversized chunk fails before anything is copied
+            if expected_size is not None and chunk_size != expected_size:
+                print(f"Error: {chunk} is {chunk_size:,} bytes, the manifest expects {expected_size:,}")
+                sys.exit(1)
+            layout.append((chunk, chunk_path, total_bytes, chunk_size))
+            total_bytes += chunk_size
 
         # Merge chunks
-        total_bytes = 0
         print(f"\nMerging chunks to: {output_file}")
-
-        with open(output_file, 'wb') as outfile:
-            for chunk_num, chunk_file in enumerate(chunk_files, 1):
-                chunk_path = os.path.join(directory, chunk_file)
-
-                print(f"Processing chunk {chunk_num}/{len(chunk_files)}: {chunk_file}")
-
-                with open(chunk_path, 'rb') as infile:
-                    chunk_data = infile.read()
-                    outfile.write(chunk_data)
-                    total_bytes += len(chunk_data)
+        fd = os.open(output_tmp, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        failures = []
+        actual_hash = None
+        try:
+            preallocate(fd, total_bytes)
+            whole = ALGORITHMS[algorithm][1]() if algorithm else None
+            buffer = bytearray(BUFFER_SIZE)
+            view = memoryview(buffer)
+            with ThreadPoolExecutor(max_workers=max(threads, 1)) as pool:
+                futures = [pool.submit(copy_chunk, chunk_path, output_tmp, offset, size)
+                           for chunk, chunk_path, offset, size in layout]
+                # Chunks are hashed in order as they land in the output, while later ones are still copied
+                for chunk_num, (future, (chunk, chunk_path, offset, size), expected) in enumerate(zip(futures, layout, expected_parts), 1):
+                    future.result()
+                    print(f"Processing chunk {chunk_num}/{len(layout)}: {chunk}")
+                    if whole is None:
+                        continue
+                    part = ALGORITHMS[algorithm][1]()
+                    done = 0
+                    while done < size:
+                        n = os.preadv(fd, [view[:min(BUFFER_SIZE, size - done)]], offset + done)
+                        if not n:
+                            raise IOError(f"Output ended inside chunk {chunk}")
+                        whole.update(view[:n])
+                        part.update(view[:n])
+                        done += n
+                    if expected and part.hexdigest() != expected:
+                        failures.append(f"{chunk}: {ALGORITHMS[algorithm][0]} {part.hexdigest()}, expected {expected}")
+            if whole is not None:
+                actual_hash = whole.hexdigest()
+                if expected_hash and actual_hash != expected_hash:
+                    failures.append(f"{os.path.basename(output_file)}: {ALGORITHMS[algorithm][0]} {actual_hash}, expected {expected_hash}")
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+        if failures:
+            os.remove(output_tmp)
+            print(f"\nError: Verification failed, the merged file was not kept:")
+            for failure in failures:
+                print(f"  {failure}")
+            sys.exit(1)
+        os.replace(output_tmp, output_file)
 
         print(f"\nFile merging complete!")
         print(f"Merged {len(chunk_files)} chunk(s)")
         print(f"Output file: {output_file}")
         print(f"Total size: {total_bytes:,} bytes ({total_bytes / (1024**2):.2f} MB)")
+        if actual_hash:
+            print(f"{ALGORITHMS[algorithm][0]}: {actual_hash}")
+            if expected_hash:
+                print(f"Verification: PASSED ({len(layout)} chunk hash(es) and the whole-file hash match the manifest)")
 
     except Exception as e:
+        if os.path.exists(output_tmp):
+            os.remove(output_tmp)
         print(f"Error: Failed to merge chunks: {e}")
         sys.exit(1)
 
@@ -69,9 +185,17 @@ def main():
         description='Merge file chunks back together',
         epilog='Example: file_merger.py "myfile.txt.part*" -o myfile.txt'
     )
-    parser.add_argument('chunk_pattern', help='Pattern matching chunk files (e.g., "file.part*")')
+    parser.add_argument('chunk_pattern', help='Pattern matching chunk files (e.g., "file.part*"), or the file.split.json manifest of file_splitter')
     parser.add_argument('-o', '--output', required=True,
                         help='Output file name for merged file')
+    parser.add_argument('-m', '--manifest', default=None,
+                        help='Split manifest with the chunk order and hashes (default: {file}.split.json next to the chunks, if any)')
+    parser.add_argument('-j', '--threads', type=int, default=4,
+                        help='Chunks copied at the same time (default: 4)')
+    parser.add_argument('-a', '--algorithm', default=None, choices=list(ALGORITHMS),
+                        help='Hash of the merged file to print when there is no manifest')
+    parser.add_argument('--no-verify', action='store_true',
+                        help='Do not check the chunk and whole-file hashes of the manifest')
 
     args = parser.parse_args()
 
@@ -84,10 +208,10 @@ def main():
         os.makedirs(output_dir, exist_ok=True)
 
     # Merge chunks
-    merge_chunks(chunk_pattern, args.output)
+    merge_chunks(chunk_pattern, args.output, args.manifest, args.threads, args.algorithm, not args.no_verify)
 
     print("\nFile merging completed!")
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -1,9 +1,133 @@
 import sys
 import os
 import argparse
+import errno
+import json
+from concurrent.futures import ThreadPoolExecutor
+from file_hash_generator import ALGORITHMS, BUFFER_SIZE, manifest_line
 
 
-def split_file(input_file, chunk_size_mb, output_dir):
+COPY_BUFFER = 4 * 1024 * 1024
+# Errors meaning "not supported for these files", after which the next way of copying is tried
+FALLBACK_ERRORS = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP, errno.EBADF, errno.ETXTBSY}
+
+
+def copy_range(src_fd, dst_fd, offset, count, dst_offset=0):
+    """Copy count bytes at offset of one file to dst_offset of another inside the kernel."""
+    copied = 0
+
+    # copy_file_range (Linux) copies or even reflinks without the data entering user space
+    if hasattr(os, 'copy_file_range'):
+        try:
+            while copied < count:
+                n = os.copy_file_range(src_fd, dst_fd, count - copied, offset + copied, dst_offset + copied)
+                if n == 0:
+                    break
+                copied += n
+        except OSError as e:
+            if e.errno not in FALLBACK_ERRORS:
+                raise
+
+    # sendfile writes at the file position of dst_fd, so dst_fd must not be shared between threads
+    if copied < count and hasattr(os, 'sendfile') and sys.platform.startswith('linux'):
+        try:
+            os.lseek(dst_fd, dst_offset + copied, os.SEEK_SET)
+            while copied < count:
+                n = os.sendfile(dst_fd, src_fd, offset + copied, count - copied)
+                if n == 0:
+                    break
+                copied += n
+        except OSError as e:
+            if e.errno not in FALLBACK_ERRORS:
+                raise
+
+    # Plain positional reads and writes
+    while copied < count:
+        data = os.pread(src_fd, min(COPY_BUFFER, count - copied), offset + copied)
+        if not data:
+            break
+        view = memoryview(data)
+        while view:
+            n = os.pwrite(dst_fd, view, dst_offset + copied)
+            view = view[n:]
+            copied += n
+
+    if copied < count:
+        raise IOError(f"File ended after {offset + copied:,} bytes, expected {offset + count:,}")
+    return copied
+
+
+def is_fastq_record(lines):
+    """Whether four lines are a FASTQ record: @name, sequence, +, qualities of the same length."""
+    return (len(lines) >= 4 and lines[0][:1] == b'@' and lines[2][:1] == b'+'
+            and len(lines[1].rstrip(b'\r')) == len(lines[3].rstrip(b'\r')))
+
+
+def record_start(fd, offset, file_size, mode):
+    """First offset at or after offset where a line (mode 'lines') or a FASTQ record (mode 'fastq') starts."""
+    if offset <= 0:
+        return 0
+    if offset >= file_size:
+        return file_size
+    window = 64 * 1024
+    while True:
+        # One byte before offset tells whether offset itself starts a line
+        data = os.pread(fd, window, offset - 1)
+        at_end = offset - 1 + len(data) >= file_size
+        start = data.find(b'\n') + 1
+        while start:
+            if start == len(data):
+                if at_end:
+                    return file_size
+                break
+            if mode == 'lines':
+                return offset - 1 + start
+            # A quality line can begin with '@' too, so the whole record is checked
+            lines = data[start:].split(b'\n', 4)
+            if len(lines) < 5 and not at_end:
+                break
+            if is_fastq_record(lines):
+                return offset - 1 + start
+            start = data.find(b'\n', start) + 1
+        if not start and at_end:
+            return file_size
+        if window >= 64 * 1024 * 1024:
+            raise ValueError(f"No {'FASTQ record' if mode == 'fastq' else 'line'} starts within 64 MB after byte {offset:,}")
+        window *= 2
+
+
+def plan_parts(input_file, file_size, chunk_size, mode):
+    """Offsets and sizes of the parts: every chunk_size bytes, or at the next line or FASTQ record after that."""
+    starts = [0] if file_size else []
+    if mode == 'bytes':
+        starts = list(range(0, file_size, chunk_size))
+    elif starts:
+        fd = os.open(input_file, os.O_RDONLY)
+        try:
+            while True:
+                start = record_start(fd, starts[-1] + chunk_size, file_size, mode)
+                if start >= file_size:
+                    break
+                starts.append(start)
+        finally:
+            os.close(fd)
+    return [(start, end - start) for start, end in zip(starts, starts[1:] + [file_size])]
+
+
+def write_part(input_file, chunk_path, offset, size):
+    """Copy one part to its file inside the kernel."""
+    src_fd = os.open(input_file, os.O_RDONLY)
+    try:
+        dst_fd = os.open(chunk_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            copy_range(src_fd, dst_fd, offset, size)
+        finally:
+            os.close(dst_fd)
+    finally:
+        os.close(src_fd)
+
+
+def split_file(input_file, chunk_size_mb, output_dir, mode='bytes', threads=4, algorithm='sha256'):
     """Split a large file into smaller chunks."""
     print(f"Current working directory: {os.getcwd()}")
     print(f"Input file: {input_file}")
@@ -19,6 +143,10 @@ def split_file(input_file, chunk_size_mb, output_dir):
         print(f"Error: Path is not a file: {input_file}")
         sys.exit(1)
 
+    if mode != 'bytes' and input_file.endswith('.gz'):
+        print(f"Error: Line and FASTQ modes need an uncompressed file, use the bytes mode for {input_file}")
+        sys.exit(1)
+
     # Get file info
     file_size = os.path.getsize(input_file)
     file_name = os.path.basename(input_file)
@@ -27,34 +155,71 @@ def split_file(input_file, chunk_size_mb, output_dir):
     print(f"File size: {file_size:,} bytes ({file_size / (1024**2):.2f} MB)")
 
     # Convert chunk size to bytes
-    chunk_size = chunk_size_mb * 1024 * 1024
-
-    # Calculate number of chunks
-    num_chunks = (file_size + chunk_size - 1) // chunk_size
-    print(f"Will create {num_chunks} chunk(s)")
+    chunk_size = max(int(chunk_size_mb * 1024 * 1024), 1)
 
     try:
-        with open(input_file, 'rb') as f:
-            chunk_num = 0
-
-            while True:
-                chunk_data = f.read(chunk_size)
-                if not chunk_data:
-                    break
-
-                chunk_num += 1
-                chunk_filename = f"{file_name}.part{chunk_num:03d}"
-                chunk_path = os.path.join(output_dir, chunk_filename)
+        # Calculate the chunks; in line and FASTQ modes they end where a line or record ends
+        parts = plan_parts(input_file, file_size, chunk_size, mode)
+        num_chunks = len(parts)
+        print(f"Will create {num_chunks} chunk(s)" + (f", split at {'line' if mode == 'lines' else 'FASTQ record'} boundaries" if mode != 'bytes' else ''))
 
-                print(f"\nCreating chunk {chunk_num}/{num_chunks}: {chunk_filename}")
-                print(f"  Chunk size: {len(chunk_data):,} bytes")
+        chunk_names = [f"{file_name}.part{n:03d}" for n in range(1, num_chunks + 1)]
+        fd = os.open(input_file, os.O_RDONLY)
+        try:
+            # The whole-file hash goes in the manifest too, so the merge can be verified end to end
+            whole = ALGORITHMS[algorithm][1]() if algorithm else None
+            buffer = bytearray(BUFFER_SIZE)
+            view = memoryview(buffer)
+            with ThreadPoolExecutor(max_workers=max(threads, 1)) as pool:
+                futures = [pool.submit(write_part, input_file, os.path.join(output_dir, name), offset, size)
+                           for name, (offset, size) in zip(chunk_names, parts)]
+                # One sequential read of the input, part by part, feeds both the part and the whole-file hash
+                # while later parts are still copied
+                hashes = []
+                for chunk_num, (future, name, (offset, size)) in enumerate(zip(futures, chunk_names, parts), 1):
+                    part = ALGORITHMS[algorithm][1]() if algorithm else None
+                    done = 0
+                    while part is not None and done < size:
+                        n = os.preadv(fd, [view[:min(BUFFER_SIZE, size - done)]], offset + done)
+                        if not n:
+                            raise IOError(f"Input ended inside chunk {name}")
+                        whole.update(view[:n])
+                        part.update(view[:n])
+                        done += n
+                    future.result()
+                    hashes.append(part.hexdigest() if part else None)
+                    print(f"Created chunk {chunk_num}/{num_chunks}: {name} ({size:,} bytes)")
+            file_hash = whole.hexdigest() if whole else None
+        finally:
+            os.close(fd)
 
-                with open(chunk_path, 'wb') as chunk_file:
-                    chunk_file.write(chunk_data)
+        # Manifest of the parts, written last: it is only there once every part is complete
+        manifest = {
+            'file': file_name,
+            'size': file_size,
+            'mode': mode,
+            'chunk_size': chunk_size,
+            'algorithm': algorithm,
+            'hash': file_hash,
+            'parts': [{'name': name, 'offset': offset, 'size': size, 'hash': part_hash}
+                      for name, (offset, size), part_hash in zip(chunk_names, parts, hashes)],
+        }
+        manifest_file = os.path.join(output_dir, f"{file_name}.split.json")
+        with open(manifest_file + '.tmp', 'w') as f:
+            json.dump(manifest, f, indent=1)
+        os.replace(manifest_file + '.tmp', manifest_file)
+        if algorithm:
+            # The same part hashes as a sha256sum-style list for file_checksum_verifier or sha256sum -c
+            with open(os.path.join(output_dir, f"{file_name}.split.{algorithm}"), 'w') as f:
+                for part in manifest['parts']:
+                    f.write(manifest_line(part['hash'], part['name']))
 
         print(f"\nFile splitting complete!")
-        print(f"Created {chunk_num} chunk(s) in: {output_dir}")
-        print(f"\nTo merge the chunks back, use the file-merger app with the base filename: {file_name}")
+        print(f"Created {num_chunks} chunk(s) in: {output_dir}")
+        if algorithm:
+            print(f"{ALGORITHMS[algorithm][0]} of {file_name}: {file_hash}")
+        print(f"Manifest: {manifest_file}")
+        print(f"\nTo merge the chunks back, use the file-merger app with the manifest or the base filename: {file_name}")
 
     except Exception as e:
         print(f"Error: Failed to split file: {e}")
@@ -64,10 +229,16 @@ def split_file(input_file, chunk_size_mb, output_dir):
 def main():
     parser = argparse.ArgumentParser(description='Split large files into smaller chunks')
     parser.add_argument('input_file', help='Path to the file to split')
-    parser.add_argument('-s', '--chunk-size', type=int, default=10,
+    parser.add_argument('-s', '--chunk-size', type=float, default=10,
                         help='Chunk size in megabytes (default: 10 MB)')
     parser.add_argument('-o', '--output-dir', default='./',
                         help='Output directory for chunks (default: ./)')
+    parser.add_argument('-m', '--mode', choices=['bytes', 'lines', 'fastq'], default='bytes',
+                        help='Split at exactly every chunk size (bytes), or at the next line (lines) or FASTQ record (fastq) after it (default: bytes)')
+    parser.add_argument('-j', '--threads', type=int, default=4,
+                        help='Chunks written at the same time (default: 4)')
+    parser.add_argument('-a', '--algorithm', default='sha256', choices=list(ALGORITHMS) + ['none'],
+                        help='Hash of every chunk and of the whole file in the manifest, or none (default: sha256)')
 
     args = parser.parse_args()
 
@@ -83,10 +254,11 @@ def main():
         sys.exit(1)
 
     # Split file
-    split_file(input_path, args.chunk_size, args.output_dir)
+    split_file(input_path, args.chunk_size, args.output_dir, args.mode, args.threads,
+               None if args.algorithm == 'none' else args.algorithm)
 
     print("\nFile splitting completed!")
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()